@@ -1,3 +1,5 @@
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Form, Request, status
 from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
@@ -7,29 +9,46 @@ import uvicorn
 from _version import __version__
 
 PORT = 80
+SYNCIOT_ASYNC = os.getenv("SYNCIOT_ASYNC", "false").lower() in ["1", "true", "yes"]
 
 # ------------------------------------------------------------------------------
 # Start SyncIoT thread
 # ------------------------------------------------------------------------------
 if True:
-    from synciot import SyncIoT
+    if SYNCIOT_ASYNC:
+        # asyncio engine, started in the FastAPI event loop (see lifespan)
+        from synciot_async import AsyncSyncIoT
+        synciot = AsyncSyncIoT()
+    else:
+        from synciot import SyncIoT
+        synciot = SyncIoT()
 
-    synciot = SyncIoT()
     if not synciot.init():
         print("Failed to initialize SyncIoT")
         exit(1)
 
-    synciot.start_thread()
-    print("SyncIoT thread started successfully.")
+    if not SYNCIOT_ASYNC:
+        synciot.start_thread()
+        print("SyncIoT thread started successfully.")
 else:
     PORT = 8081
+    SYNCIOT_ASYNC = False
     print("SyncIoT thread not started. Set the condition to True to start it.")
 
 # ------------------------------------------------------------------------------
 # FastAPI application
 # ------------------------------------------------------------------------------
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if SYNCIOT_ASYNC:
+        synciot.start_task()
+        print("SyncIoT task started successfully.")
+    yield
+    if SYNCIOT_ASYNC:
+        await synciot.stop_task()
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
@@ -52,6 +71,14 @@ async def index(request: Request):
     print(f"Request for index page received event_count={event_count} event_time={event_time}")
     return templates.TemplateResponse('index.html', {"request": request, "event_count": event_count, "event_time": event_time, "synciot_version": __version__})
 
+@app.get("/metrics")
+async def metrics():
+    try:
+        return synciot.get_metrics()
+    except Exception as e:
+        print(f"Error getting metrics: {e}")
+        return {}
+
 @app.get('/favicon.ico')
 async def favicon():
     file_name = 'favicon.ico'
@@ -8,8 +8,8 @@ class Counter:
         self.name = name
         self.value = 0
 
-    def inc(self):
-        self.value += 1
+    def inc(self, value=1):
+        self.value += value
 
     def dec(self):
         self.value -= 1
@@ -20,6 +20,24 @@ class Counter:
     def log_value(self):
         logger.info(f"{self.name}: {self.value}")
 
+class Gauge:
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def set_max(self, value):
+        if value > self.value:
+            self.value = value
+
+    def get_value(self):
+        return self.value
+
+    def log_value(self):
+        logger.info(f"{self.name}: {self.value}")
+
 class Metrics:
     def __init__(self):
         self.metrics = {}
@@ -29,12 +47,20 @@ class Metrics:
         self.metrics[name] = counter
         return counter
 
+    def add_gauge(self, name) -> Gauge:
+        gauge = Gauge(name)
+        self.metrics[name] = gauge
+        return gauge
+
     def get_metric(self, name):
         return self.metrics.get(name, None)
 
     def get_all_metrics(self):
         return self.metrics
 
+    def get_values(self) -> dict:
+        return {name: metric.get_value() for name, metric in self.metrics.items()}
+
     def log_values(self):
         for name, counter in self.metrics.items():
             counter.log_value()
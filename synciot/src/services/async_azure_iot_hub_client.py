@@ -0,0 +1,132 @@
+"""
+Asynchronous Azure IoT Hub client (azure.eventhub.aio) used by the asyncio engine (synciot_async.py).
+
+The events are put into the asyncio queue of their partition as a tuple (body, partition_id, sequence_number, queued time (monotonic)).
+queue.put() is awaited: when a partition queue is full, the receiver of this partition waits
+(backpressure) instead of buffering more events; the wait is recorded as a stall.
+"""
+import sys
+import os
+import time
+import asyncio
+from azure.eventhub.aio import EventHubConsumerClient
+
+# Add the parent directory to the system path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tools.logger import get_logger
+from metrics import Metrics
+
+logger = get_logger("AsyncIoTHub")
+
+# -----------------------------------------------------------------------------
+#
+class AsyncAzureIoTHubClient:
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self):
+        self.client = None
+        self.partition_queues = None
+        self.set_metrics(Metrics())
+
+    # -------------------------------------------------------------------------
+    #
+    def set_metrics(self, metrics: Metrics) -> None:
+        self.queue_depth = metrics.add_gauge("queue_depth")
+        self.stall_total = metrics.add_counter("stall_total")
+        self.stall_seconds_total = metrics.add_counter("stall_seconds_total")
+        self.last_stall_seconds = metrics.add_gauge("last_stall_seconds")
+
+    # -------------------------------------------------------------------------
+    #
+    def init(self, connection_string, consumer_group = "$Default") -> bool:
+        """
+        Initialize the Azure IoT Hub client with the provided connection string.
+        """
+        try:
+            self.client = EventHubConsumerClient.from_connection_string(conn_str=connection_string, consumer_group=consumer_group)
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to initialize Azure IoT Hub client: {e}")
+            return False
+
+    # -------------------------------------------------------------------------
+    #
+    async def get_partition_ids(self) -> list:
+        """
+        Return the partition ids of the IoT Hub (Event Hub compatible endpoint).
+        """
+        try:
+            return await self.client.get_partition_ids()
+
+        except Exception as e:
+            logger.error(f"Failed to get partition ids: {e}")
+            return None
+
+    # -------------------------------------------------------------------------
+    #
+    async def receive(self, partition_queues, start_position, start_position_inclusive=False) -> None:
+        """
+        Receive device-to-cloud messages until the client is closed.
+        partition_queues: partition_id -> asyncio.Queue
+        """
+        try:
+            logger.info(f"Start receive event with start_position({start_position})")
+
+            self.partition_queues = partition_queues
+
+            await self.client.receive_batch(
+                on_event_batch=self.on_event_batch,
+                starting_position=start_position,
+                starting_position_inclusive=start_position_inclusive
+            )
+
+        except Exception as e:
+            logger.error(f"Error while receiving messages: {e}")
+
+    # -------------------------------------------------------------------------
+    #
+    async def on_event_batch(self, partition_context, events):
+        """
+        Receive and queue events from the Azure IoT Hub.
+        """
+        try:
+            if events is None:
+                return
+
+            logger.debug("Rx Events count({})".format(len(events)))
+
+            partition_id = partition_context.partition_id
+            event_queue = self.partition_queues[partition_id]
+
+            for event in events:
+                if event is None:
+                    continue
+                item = (event.body_as_str(), partition_id, event.sequence_number, time.monotonic())
+                try:
+                    event_queue.put_nowait(item)
+                except asyncio.QueueFull:
+                    start = time.monotonic()
+                    await event_queue.put(item)
+                    stall = time.monotonic() - start
+                    self.stall_total.inc()
+                    self.stall_seconds_total.inc(stall)
+                    self.last_stall_seconds.set(round(stall, 3))
+
+            self.queue_depth.set(sum(partition_queue.qsize() for partition_queue in self.partition_queues.values()))
+
+        except Exception as e:
+            logger.error(f"Error while receiving event: {e}")
+
+    # -------------------------------------------------------------------------
+    #
+    async def disconnect(self):
+        """
+        Disconnect from the Azure IoT Hub.
+        """
+        try:
+            await self.client.close()
+            logger.info("Disconnected from Azure IoT Hub.")
+        except Exception as e:
+            logger.error(f"Failed to disconnect: {e}")
@@ -0,0 +1,214 @@
+"""
+pip install asyncpg
+
+Asynchronous PostgreSQL client used by the asyncio engine (synciot_async.py).
+It exposes the same operations as PostgresClient with an asyncpg connection pool.
+
+Batches are written with executemany() in a single transaction: asyncpg pipelines the
+statements (no round trip per row). Bulk batches are streamed with COPY (copy_records_to_table)
+into a temporary staging table merged with INSERT ... SELECT ... ON CONFLICT.
+
+Transient errors (connection lost, server unavailable) are retried up to POSTGRES_MAX_RETRY times
+on a new connection; DatabaseConnectionException is raised when all retries fail.
+"""
+import os
+import sys
+import asyncio
+import datetime
+import asyncpg
+
+# Add the parent directory to the system path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tools.logger import get_logger
+from services.postgres_client import DatabaseConnectionException, POOL_MIN_CONN, POOL_MAX_CONN, MAX_RETRY, RETRY_INTERVAL_SEC
+
+logger = get_logger("AsyncPostgres")
+
+TRANSIENT_ERRORS = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.InterfaceError,
+    asyncpg.CannotConnectNowError,
+    ConnectionError,
+    OSError,
+    asyncio.TimeoutError,
+)
+
+# Errors raised by the rows of a batch (ex: invalid uuid or JSON data, constraint violation).
+# The connection errors are raised as DatabaseConnectionException by _run().
+DATA_ERRORS = (asyncpg.PostgresError, ValueError)
+
+# -------------------------------------------------------------------------------------------------
+#
+class AsyncPostgresClient:
+    # ---------------------------------------------------------------------------------------------
+    #
+    def __init__(self):
+        self.pool = None
+        self.min_conn = POOL_MIN_CONN
+        self.max_conn = POOL_MAX_CONN
+        self.max_retry = MAX_RETRY
+        self.retry_interval_sec = RETRY_INTERVAL_SEC
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    async def connect(self, info:dict) -> bool:
+        try:
+            self.min_conn = int(info.get("pool_min_conn", self.min_conn))
+            self.max_conn = max(self.min_conn, int(info.get("pool_max_conn", self.max_conn)), 1)
+
+            ssl = info.get("sslmode", None)
+            if ssl == "disable":
+                ssl = False
+
+            self.pool = await asyncpg.create_pool(
+                host=info["host"],
+                database=info["database"],
+                user=info["user"],
+                password=info["password"],
+                port=int(info["port"]),
+                ssl=ssl,
+                min_size=self.min_conn,
+                max_size=self.max_conn
+            )
+
+            logger.info(f"PostgreSQL connection pool created min_conn({self.min_conn}) max_conn({self.max_conn})")
+
+            return True
+
+        except Exception as e:
+            logger.error(f"Error connecting to PostgreSQL database: {e}")
+            raise
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+            logger.info("PostgreSQL connection pool closed")
+
+    # ---------------------------------------------------------------------------------------------
+    # Run await operation(connection) with a pooled connection.
+    # Transient errors are retried on a new connection; other errors are raised to the caller.
+    async def _run(self, operation):
+        if not self.pool:
+            raise Exception("Connection not established. Call connect() first.")
+
+        retry = 0
+
+        while True:
+            try:
+                async with self.pool.acquire() as connection:
+                    return await operation(connection)
+
+            except TRANSIENT_ERRORS as e:
+                # asyncpg.DataError (invalid query argument) is also an InterfaceError: it is not transient
+                if isinstance(e, ValueError):
+                    raise
+
+                retry += 1
+                if retry > self.max_retry:
+                    raise DatabaseConnectionException(f"PostgreSQL database unavailable after {self.max_retry} retries: {e}") from e
+
+                logger.warning(f"Transient database error, retry({retry}/{self.max_retry}): {e}")
+
+            await asyncio.sleep(self.retry_interval_sec * retry)
+
+    # ---------------------------------------------------------------------------------------------
+    # rows is a list of (device, uuid, timestamp, data)
+    # The rows are pipelined with executemany() and committed once
+    async def insert_batch_with_uuid(self, table, rows, on_conflict = 'ON CONFLICT ("uuid") DO NOTHING') -> bool:
+        if rows is None or len(rows) == 0:
+            return True
+
+        query = f'INSERT INTO {table} ("device", "uuid", "timestamp", "data") VALUES ($1, $2::uuid, TO_TIMESTAMP($3), $4::jsonb) {on_conflict}'
+        args = [(device, uuid, float(timestamp), data) for device, uuid, timestamp, data in rows]
+
+        async def operation(connection):
+            async with connection.transaction():
+                await connection.executemany(query, args)
+            logger.debug("%d rows inserted into %s table", len(rows), table)
+            return True
+
+        try:
+            return await self._run(operation)
+
+        except Exception as e:
+            logger.error(f"Error inserting {len(rows)} rows into {table} table: {e}")
+            raise
+
+    # ---------------------------------------------------------------------------------------------
+    # rows is a list of (device, uuid, timestamp, data)
+    # Bulk path: COPY into a temporary staging table merged with INSERT ... SELECT ... ON CONFLICT
+    async def copy_batch_with_uuid(self, table, rows, on_conflict = 'ON CONFLICT ("uuid") DO NOTHING') -> bool:
+        if rows is None or len(rows) == 0:
+            return True
+
+        staging = "synciot_staging"
+        columns = '"device", "uuid", "timestamp", "data"'
+        create_query = f'CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT "device", "uuid"::text AS "uuid", "timestamp", "data"::text AS "data" FROM {table} WITH NO DATA'
+        merge_query = f'INSERT INTO {table} ({columns}) SELECT "device", "uuid"::uuid, "timestamp", "data"::jsonb FROM {staging} {on_conflict}'
+        records = [
+            (device, uuid, datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc), data)
+            for device, uuid, timestamp, data in rows
+        ]
+
+        async def operation(connection):
+            async with connection.transaction():
+                await connection.execute(create_query)
+                await connection.copy_records_to_table(staging, records=records, columns=["device", "uuid", "timestamp", "data"])
+                status = await connection.execute(merge_query)
+            logger.debug("%d rows copied into %s table (%s)", len(rows), table, status)
+            return True
+
+        try:
+            return await self._run(operation)
+
+        except Exception as e:
+            logger.error(f"Error copying {len(rows)} rows into {table} table: {e}")
+            raise
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    async def read_config(self, table, key):
+        query = f"SELECT * FROM {table} WHERE key = $1"
+        logger.debug(query)
+
+        async def operation(connection):
+            result = await connection.fetchrow(query, key)
+
+            if result:
+                logger.info(f"Record found: {tuple(result)}")
+                return tuple(result)
+
+            logger.info(f"No record found for key: {key}")
+            return None
+
+        try:
+            return await self._run(operation)
+
+        except Exception as e:
+            logger.error(f"Error reading record from config table: {e}")
+            raise
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    async def upsert_config(self, table, key, data):
+        query = f'''
+        INSERT INTO {table} (key, data)
+        VALUES ($1, $2)
+        ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data
+        '''
+
+        async def operation(connection):
+            await connection.execute(query, key, data)
+            logger.info(f"Record upserted into config table with key: {key}")
+            return True
+
+        try:
+            return await self._run(operation)
+
+        except Exception as e:
+            logger.error(f"Error upserting record into config table: {e}")
+            raise
@@ -19,6 +19,8 @@ In Built-in endpoints, Event Hub compatible endpoint,
 """
 import sys
 import os
+import time
+import queue
 import threading
 from azure.eventhub import EventHubConsumerClient
 
@@ -26,25 +28,51 @@ from azure.eventhub import EventHubConsumerClient
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from tools.logger import get_logger
+from metrics import Metrics
 
 logger = get_logger("IoTHub")
 
+RECEIVE_MAX_BATCH_SIZE = int(os.getenv("RECEIVE_MAX_BATCH_SIZE", 300))
+RECEIVE_PREFETCH = int(os.getenv("RECEIVE_PREFETCH", 300))
+FLOW_CONTROL_INTERVAL_SEC = float(os.getenv("FLOW_CONTROL_INTERVAL_SEC", 10))
+FLOW_CONTROL_CHECK_SEC = 1.0
+
+# Receive settings by queue fill level: (maximum queue fill ratio, factor applied to max_batch_size and prefetch)
+FLOW_CONTROL_LEVELS = [(0.5, 1.0), (0.8, 0.25), (None, 0.05)]
+
 # -----------------------------------------------------------------------------
 #
 class AzureIoTHubClient:
     # -------------------------------------------------------------------------
     #
     def __init__(self):
+        self.client = None
         self.queue = None
+        self.partition_queues = None
+        self.start_position_inclusive = False
+        self.connection_string = None
+        self.consumer_group = None
+        self.max_batch_size = RECEIVE_MAX_BATCH_SIZE
+        self.prefetch = RECEIVE_PREFETCH
+        self.flow_control_interval_sec = FLOW_CONTROL_INTERVAL_SEC
+        self.receive_level = 0
+        self.level_candidate = None
+        self.level_candidate_time = 0
+        self.last_sequence_numbers = {}  # partition_id -> sequence number of the last queued event
+        self.set_metrics(Metrics())
 
     # -------------------------------------------------------------------------
     #
-    def init(self, connection_string, consumer_group = "$Default") -> bool:
+    def init(self, connection_string, consumer_group = "$Default", max_batch_size = None, prefetch = None) -> bool:
         """
         Initialize the Azure IoT Hub client with the provided connection string.
         """
         try:
-            self.client = EventHubConsumerClient.from_connection_string(conn_str=connection_string, consumer_group=consumer_group)
+            self.connection_string = connection_string
+            self.consumer_group = consumer_group
+            self.max_batch_size = max(1, int(max_batch_size or self.max_batch_size))
+            self.prefetch = max(1, int(prefetch or self.prefetch))
+            self.client = self._create_client()
             return True
 
         except Exception as e:
@@ -53,16 +81,55 @@ class AzureIoTHubClient:
 
     # -------------------------------------------------------------------------
     #
-    def subscribe_to_events(self, queue, start_position="@latest"):
+    def _create_client(self) -> EventHubConsumerClient:
+        return EventHubConsumerClient.from_connection_string(conn_str=self.connection_string, consumer_group=self.consumer_group)
+
+    # -------------------------------------------------------------------------
+    #
+    def set_metrics(self, metrics: Metrics) -> None:
+        """
+        Flow control metrics: queue depth and fill level, receive settings and stalls
+        (time spent waiting for room in a full queue in the receive callback).
+        """
+        self.queue_depth = metrics.add_gauge("queue_depth")
+        self.queue_fill_percent = metrics.add_gauge("queue_fill_percent")
+        self.receive_max_batch_size = metrics.add_gauge("receive_max_batch_size")
+        self.receive_prefetch = metrics.add_gauge("receive_prefetch")
+        self.stall_total = metrics.add_counter("stall_total")
+        self.stall_seconds_total = metrics.add_counter("stall_seconds_total")
+        self.last_stall_seconds = metrics.add_gauge("last_stall_seconds")
+
+    # -------------------------------------------------------------------------
+    #
+    def get_partition_ids(self) -> list:
+        """
+        Return the partition ids of the IoT Hub (Event Hub compatible endpoint).
+        """
+        try:
+            return self.client.get_partition_ids()
+
+        except Exception as e:
+            logger.error(f"Failed to get partition ids: {e}")
+            return None
+
+    # -------------------------------------------------------------------------
+    #
+    def subscribe_to_events(self, queue, start_position="@latest", start_position_inclusive=False, partition_queues=None):
         """
         Subscribe to device-to-cloud messages.
+        The events are put into the queue as a tuple (body, partition_id, sequence_number, queued time (monotonic)).
+        start_position and start_position_inclusive can be a dict (partition_id -> value).
+        If partition_queues (partition_id -> queue) is provided, the events are put into the queue of their partition.
         """
         try:
             logger.info(f"Listening for events from Azure IoT Hub with start_position({start_position})")
 
             self.queue = queue
+            self.partition_queues = partition_queues
             self.start_position = start_position
+            self.start_position_inclusive = start_position_inclusive
             threading.Thread(target=self._listen, daemon=True).start()
+            threading.Thread(target=self._flow_control, daemon=True).start()
             logger.info("Event listening started.")
 
         except Exception as e:
@@ -73,17 +140,138 @@ class AzureIoTHubClient:
     def _listen(self):
         """
         Start listening for events from the Azure IoT Hub.
+        When the flow control changes the receive settings, the client is closed (receive_batch returns)
+        and the receive is restarted right after the last queued event of each partition.
+        """
+        while True:
+            try:
+                max_batch_size, prefetch = self._get_receive_settings()
+                self.receive_max_batch_size.set(max_batch_size)
+                self.receive_prefetch.set(prefetch)
+
+                logger.info(f"Start receive event with start_position({self.start_position}) max_batch_size({max_batch_size}) prefetch({prefetch})")
+
+                self.client.receive_batch(
+                    on_event_batch=self.on_event_batch,
+                    starting_position=self.start_position,
+                    starting_position_inclusive=self.start_position_inclusive,
+                    max_batch_size=max_batch_size,
+                    prefetch=prefetch
+                )
+
+                if self.client is None:
+                    return
+
+                self.client = self._create_client()
+                self._set_restart_position()
+
+            except Exception as e:
+                logger.error(f"Error while receiving messages: {e}")
+                return
+
+    # -------------------------------------------------------------------------
+    #
+    def _get_receive_settings(self) -> tuple [int, int]:
+        factor = FLOW_CONTROL_LEVELS[self.receive_level][1]
+        return max(1, int(self.max_batch_size * factor)), max(1, int(self.prefetch * factor))
+
+    # -------------------------------------------------------------------------
+    #
+    def _set_restart_position(self) -> None:
+        """
+        Restart each partition after its last queued event (exclusive); the other partitions
+        restart from their initial start position.
+        """
+        start_positions = {}
+        start_positions_inclusive = {}
+
+        for partition_id in self.get_partition_ids() or []:
+            if partition_id in self.last_sequence_numbers:
+                start_positions[partition_id] = self.last_sequence_numbers[partition_id]
+                start_positions_inclusive[partition_id] = False
+            elif type(self.start_position) is dict:
+                start_positions[partition_id] = self.start_position.get(partition_id)
+                start_positions_inclusive[partition_id] = self.start_position_inclusive.get(partition_id, False)
+            else:
+                start_positions[partition_id] = self.start_position
+                start_positions_inclusive[partition_id] = self.start_position_inclusive
+
+        self.start_position = start_positions
+        self.start_position_inclusive = start_positions_inclusive
+
+    # -------------------------------------------------------------------------
+    #
+    def _get_queues(self) -> list:
+        if self.partition_queues is not None:
+            return list(self.partition_queues.values())
+        return [self.queue]
+
+    # -------------------------------------------------------------------------
+    #
+    def _flow_control(self):
+        """
+        Update the queue metrics and select the receive settings from the queue fill level
+        (the fullest queue in partition mode). A new level must be stable for flow_control_interval_sec
+        before the receive is restarted with the new settings.
+        """
+        while self.client is not None:
+            try:
+                time.sleep(FLOW_CONTROL_CHECK_SEC)
+
+                depth = 0
+                fill = 0.0
+                for event_queue in self._get_queues():
+                    size = event_queue.qsize()
+                    depth += size
+                    if event_queue.maxsize > 0:
+                        fill = max(fill, size / event_queue.maxsize)
+
+                self.queue_depth.set(depth)
+                self.queue_fill_percent.set(round(fill * 100, 1))
+
+                level = 0
+                while FLOW_CONTROL_LEVELS[level][0] is not None and fill >= FLOW_CONTROL_LEVELS[level][0]:
+                    level += 1
+
+                if level == self.receive_level:
+                    self.level_candidate = None
+                    continue
+
+                now = time.monotonic()
+                if level != self.level_candidate:
+                    self.level_candidate = level
+                    self.level_candidate_time = now
+                    continue
+
+                if now - self.level_candidate_time >= self.flow_control_interval_sec:
+                    logger.info(f"Queue fill({fill:.2f}): receive level {self.receive_level} -> {level}")
+                    self.receive_level = level
+                    self.level_candidate = None
+                    # receive_batch returns and _listen restarts it with the new settings
+                    self.client.close()
+
+            except Exception as e:
+                logger.error(f"Flow control error: {e}")
+
+    # -------------------------------------------------------------------------
+    #
+    def _put(self, event_queue, item) -> None:
+        """
+        Put an event into a queue; the time spent waiting for a full queue is recorded as a stall.
         """
         try:
-            logger.info(f"Start receive event with start_position({self.start_position})")
+            event_queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
 
-            self.client.receive_batch(
-                on_event_batch=self.on_event_batch,
-                starting_position=self.start_position
-            )
+        start = time.monotonic()
+        event_queue.put(item)
+        stall = time.monotonic() - start
 
-        except Exception as e:
-            logger.error(f"Error while receiving messages: {e}")
+        self.stall_total.inc()
+        self.stall_seconds_total.inc(stall)
+        self.last_stall_seconds.set(round(stall, 3))
 
     # -------------------------------------------------------------------------
     #
@@ -95,7 +283,8 @@ class AzureIoTHubClient:
             if event is None:
                 return
 
-            self.queue.put(event.body_as_str())
+            self._put(self.queue, (event.body_as_str(), partition_context.partition_id, event.sequence_number, time.monotonic()))
+            self.last_sequence_numbers[partition_context.partition_id] = event.sequence_number
             # print(f"Partition: {partition_context.partition_id}")
             # print(f"Partition: {partition_context.consumer_group}")
             # print(f"Partition: {partition_context.eventhub_name}")
@@ -113,12 +302,20 @@ class AzureIoTHubClient:
             if events is None:
                 return
 
-            logger.info("Rx Events count({})".format(len(events)))
+            logger.info("Rx Events count(%d)", len(events))
+
+            partition_id = partition_context.partition_id
+
+            if self.partition_queues is not None:
+                event_queue = self.partition_queues[partition_id]
+            else:
+                event_queue = self.queue
 
             for event in events:
                 if event is None:
                     continue
-                self.queue.put(event.body_as_str())
+                self._put(event_queue, (event.body_as_str(), partition_id, event.sequence_number, time.monotonic()))
+                self.last_sequence_numbers[partition_id] = event.sequence_number
 
             # print(f"Partition: {partition_context.partition_id}")
             # print(f"Partition: {partition_context.consumer_group}")
@@ -134,7 +331,9 @@ class AzureIoTHubClient:
         Disconnect from the Azure IoT Hub.
         """
         try:
-            self.client.close()
+            client = self.client
+            self.client = None
+            client.close()
             logger.info("Disconnected from Azure IoT Hub.")
         except Exception as e:
             logger.error(f"Failed to disconnect: {e}")
@@ -0,0 +1,164 @@
+"""
+BatchWriter groups the events by destination table and writes each group to PostgreSQL
+with a multi-row INSERT ... ON CONFLICT ("uuid") DO NOTHING and a single commit.
+
+A batch is flushed when it holds max_batch_size rows or when max_batch_delay_sec
+has elapsed since its first row was added.
+
+In bulk mode (backlog catch-up), batches hold up to bulk_batch_size rows and are written
+with COPY FROM STDIN into a staging table merged with INSERT ... SELECT ... ON CONFLICT.
+
+When a batch is rejected because of its data (ex: invalid uuid or JSON), its rows are inserted one at a time:
+the rejected rows are logged, counted (rejected_events) and skipped, so a bad event cannot block the partition.
+"""
+import os
+import sys
+import time
+
+# Add the parent directory to the system path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tools.logger import get_logger
+from services.postgres_client import DatabaseConnectionException, DATA_ERRORS
+
+logger = get_logger("BatchWriter")
+
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 100))
+BATCH_MAX_DELAY_SEC = float(os.getenv("BATCH_MAX_DELAY_SEC", 1.0))
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", 1000))
+
+# -------------------------------------------------------------------------------------------------
+#
+class BatchWriter:
+    # ---------------------------------------------------------------------------------------------
+    #
+    def __init__(self, postgres_client, max_batch_size = BATCH_SIZE, max_batch_delay_sec = BATCH_MAX_DELAY_SEC):
+        self.postgres_client = postgres_client
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_batch_delay_sec = float(max_batch_delay_sec)
+        self.bulk_batch_size = BULK_BATCH_SIZE
+        self.bulk_mode = False
+        self.batches = {}  # table -> list of (device, uuid, timestamp, data)
+        self.count = 0
+        self.first_row_time = 0
+        self.rejected_events = None  # Counter of the rows rejected by the database
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def add(self, table, device, uuid, timestamp, data) -> None:
+        if self.count == 0:
+            self.first_row_time = time.monotonic()
+
+        rows = self.batches.get(table, None)
+        if rows is None:
+            rows = []
+            self.batches[table] = rows
+
+        rows.append((device, uuid, timestamp, data))
+        self.count += 1
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def set_bulk_mode(self, enable: bool) -> None:
+        if enable != self.bulk_mode:
+            logger.info(f"bulk_mode({enable}) pending rows({self.count})")
+            self.bulk_mode = enable
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def is_due(self) -> bool:
+        """
+        Return True if the pending rows must be written to the database.
+        """
+        if self.count == 0:
+            return False
+
+        max_batch_size = self.bulk_batch_size if self.bulk_mode else self.max_batch_size
+
+        if self.count >= max_batch_size:
+            return True
+
+        return time.monotonic() - self.first_row_time >= self.max_batch_delay_sec
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def take(self) -> dict:
+        """
+        Return the pending batches (table -> rows) and start new ones.
+        Used when the rows are written by the caller (asynchronous engine).
+        """
+        batches = self.batches
+        self.batches = {}
+        self.count = 0
+        return batches
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def flush(self) -> bool:
+        """
+        Write all pending rows, one INSERT and one commit per table.
+        Tables written with success are removed from the pending batches.
+        A batch rejected because of its data is inserted one row at a time, the rejected rows are skipped.
+        Return False if the database is unavailable; the rows are kept for the next flush.
+        Other errors are raised to the caller.
+        """
+        try:
+            if self.count == 0:
+                return True
+
+            for table in list(self.batches.keys()):
+                rows = self.batches[table]
+
+                try:
+                    if self.bulk_mode:
+                        result = self.postgres_client.copy_batch_with_uuid(table, rows)
+                    else:
+                        result = self.postgres_client.insert_batch_with_uuid(table, rows)
+
+                except DATA_ERRORS as e:
+                    logger.warning(f"Batch rejected by table({table}) rows({len(rows)}): {e}, inserting the rows one at a time")
+                    result = self._insert_rows(table, rows)
+
+                if not result:
+                    logger.error(f"Failed to insert batch into table({table}) rows({len(rows)})")
+                    return False
+
+                logger.debug(f"Batch of {len(rows)} rows inserted into table({table})")
+
+                del self.batches[table]
+                self.count -= len(rows)
+
+            return True
+
+        except DatabaseConnectionException as e:
+            logger.error(f"Failed to flush batch, {self.count} rows kept: {e}")
+            return False
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def _insert_rows(self, table, rows) -> bool:
+        """
+        Insert the rows one at a time (one commit per row), skipping the rows rejected by the database.
+        The rows written or rejected are removed from rows, so the remaining rows are kept
+        when DatabaseConnectionException is raised.
+        """
+        done = 0
+
+        try:
+            for row in rows:
+                try:
+                    self.postgres_client.insert_batch_with_uuid(table, [row])
+
+                except DATA_ERRORS as e:
+                    device, uuid, timestamp, data = row
+                    logger.error(f"Row rejected by table({table}) device({device}) uuid({uuid}): {e} data({str(data):.300})")
+                    if self.rejected_events is not None:
+                        self.rejected_events.inc()
+
+                done += 1
+
+            return True
+
+        finally:
+            del rows[:done]
+            self.count -= done
@@ -7,15 +7,26 @@ https://learn.microsoft.com/en-us/azure/postgresql/flexible-server/concepts-iden
 https://learn.microsoft.com/en-us/azure/postgresql/flexible-server/concepts-azure-ad-authentication
 https://learn.microsoft.com/en-us/azure/postgresql/flexible-server/how-to-configure-sign-in-azure-ad-authentication
 
+Connections are taken from a ThreadedConnectionPool, so several threads can share the client.
+A connection is checked (SELECT 1) before use when it was idle for more than HEALTH_CHECK_INTERVAL_SEC.
+Transient errors (connection lost, server unavailable) are retried up to POSTGRES_MAX_RETRY times
+on a new connection; DatabaseConnectionException is raised when all retries fail.
+
 TODO: Store credentials in Azure Key Vault
 
 """
 import os
+import io
+import csv
 import sys
 import time
 import json
+import datetime
+import threading
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 # Add the parent directory to the system path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -24,19 +35,44 @@ from tools.logger import get_logger
 
 logger = get_logger("Postgres")
 
+POOL_MIN_CONN = int(os.getenv("POSTGRES_POOL_MIN_CONN", 1))
+POOL_MAX_CONN = int(os.getenv("POSTGRES_POOL_MAX_CONN", 4))
+MAX_RETRY = int(os.getenv("POSTGRES_MAX_RETRY", 5))
+RETRY_INTERVAL_SEC = float(os.getenv("POSTGRES_RETRY_INTERVAL_SEC", 1.0))
+HEALTH_CHECK_INTERVAL_SEC = float(os.getenv("POSTGRES_HEALTH_CHECK_INTERVAL_SEC", 30))
+
+# Errors raised by the rows of a batch (ex: invalid uuid or JSON data, constraint violation)
+DATA_ERRORS = (psycopg2.Error, ValueError)
+
+# -------------------------------------------------------------------------------------------------
+# Raised when the database cannot be reached after all retries
+class DatabaseConnectionException(Exception):
+    pass
+
 # -------------------------------------------------------------------------------------------------
 #
 class PostgresClient:
     # ---------------------------------------------------------------------------------------------
     #
     def __init__(self):
-        self.connection = None
+        self.pool = None
+        self.semaphore = None
+        self.last_used = {}  # connection id -> last use time (monotonic)
+        self.min_conn = POOL_MIN_CONN
+        self.max_conn = POOL_MAX_CONN
+        self.max_retry = MAX_RETRY
+        self.retry_interval_sec = RETRY_INTERVAL_SEC
 
     # ---------------------------------------------------------------------------------------------
     #
     def connect(self, info:dict) -> bool:
         try:
-            self.connection = psycopg2.connect(
+            self.min_conn = int(info.get("pool_min_conn", self.min_conn))
+            self.max_conn = max(self.min_conn, int(info.get("pool_max_conn", self.max_conn)), 1)
+
+            self.pool = ThreadedConnectionPool(
+                self.min_conn,
+                self.max_conn,
                 host=info["host"],
                 database=info["database"],
                 user=info["user"],
@@ -44,6 +80,10 @@ class PostgresClient:
                 port=int(info["port"]),
                 sslmode=info["sslmode"]
             )
+            # ThreadedConnectionPool raises PoolError when exhausted; callers wait on the semaphore instead
+            self.semaphore = threading.BoundedSemaphore(self.max_conn)
+
+            logger.info(f"PostgreSQL connection pool created min_conn({self.min_conn}) max_conn({self.max_conn})")
 
             return True
 
@@ -54,42 +94,119 @@ class PostgresClient:
     # ---------------------------------------------------------------------------------------------
     #
     def close(self):
-        if self.connection:
-            self.connection.close()
-            logger.info("PostgreSQL connection closed")
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
+            logger.info("PostgreSQL connection pool closed")
+
+    # ---------------------------------------------------------------------------------------------
+    # Get a healthy connection from the pool
+    def _get_connection(self):
+        connection = self.pool.getconn()
+
+        try:
+            if connection.closed:
+                raise psycopg2.InterfaceError("connection already closed")
+
+            last_used = self.last_used.get(id(connection), 0)
+            if time.monotonic() - last_used > HEALTH_CHECK_INTERVAL_SEC:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                connection.rollback()
+
+            return connection
+
+        except Exception:
+            self._put_connection(connection, close=True)
+            raise
 
     # ---------------------------------------------------------------------------------------------
     #
-    def check_and_create_schema(self, schema_name) -> bool:
-        if not self.connection:
+    def _put_connection(self, connection, close=False):
+        try:
+            if close:
+                self.last_used.pop(id(connection), None)
+            else:
+                self.last_used[id(connection)] = time.monotonic()
+
+            self.pool.putconn(connection, close=close)
+
+        except Exception as e:
+            logger.error(f"Error returning connection to the pool: {e}")
+
+    # ---------------------------------------------------------------------------------------------
+    # Run operation(connection) with a pooled connection.
+    # Transient errors (OperationalError, InterfaceError) are retried on a new connection.
+    # Other errors roll back the transaction and are raised to the caller.
+    def _run(self, operation):
+        if not self.pool:
             raise Exception("Connection not established. Call connect() first.")
 
+        retry = 0
+
+        while True:
+            self.semaphore.acquire()
+            try:
+                connection = None
+
+                try:
+                    connection = self._get_connection()
+                    result = operation(connection)
+                    self._put_connection(connection)
+                    return result
+
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    if connection is not None:
+                        self._put_connection(connection, close=True)
+
+                    retry += 1
+                    if retry > self.max_retry:
+                        raise DatabaseConnectionException(f"PostgreSQL database unavailable after {self.max_retry} retries: {e}") from e
+
+                    logger.warning(f"Transient database error, retry({retry}/{self.max_retry}): {e}")
+
+                except Exception:
+                    if connection is not None:
+                        try:
+                            connection.rollback()
+                        except Exception:
+                            pass
+                        self._put_connection(connection)
+                    raise
+
+            finally:
+                self.semaphore.release()
+
+            time.sleep(self.retry_interval_sec * retry)
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def check_and_create_schema(self, schema_name) -> bool:
         check_schema_query = sql.SQL("SELECT schema_name FROM information_schema.schemata WHERE schema_name = %s")
         create_schema_query = sql.SQL("CREATE SCHEMA {schema_name}").format(schema_name=sql.Identifier(schema_name))
 
-        try:
-            with self.connection.cursor() as cursor:
+        def operation(connection):
+            with connection.cursor() as cursor:
                 cursor.execute(check_schema_query, (schema_name,))
                 if not cursor.fetchone():
                     cursor.execute(create_schema_query)
-                    self.connection.commit()
+                    connection.commit()
                     print(f"Schema '{schema_name}' created")
                 else:
                     print(f"Schema '{schema_name}' already exists")
 
                 return True
 
+        try:
+            return self._run(operation)
+
         except Exception as e:
-            self.connection.rollback()
             print(f"Error checking/creating schema '{schema_name}': {e}")
             raise
 
     # ---------------------------------------------------------------------------------------------
     #
     def check_and_create_table(self, schema_name, table_name, table_definition) -> bool:
-        if not self.connection:
-            raise Exception("Connection not established. Call connect() first.")
-
         check_table_query = sql.SQL(
             "SELECT table_name FROM information_schema.tables WHERE table_schema = %s AND table_name = %s"
         )
@@ -99,87 +216,151 @@ class PostgresClient:
             table_definition=sql.SQL(table_definition)
         )
 
-        try:
-            with self.connection.cursor() as cursor:
+        def operation(connection):
+            with connection.cursor() as cursor:
                 cursor.execute(check_table_query, (schema_name, table_name))
                 if not cursor.fetchone():
                     cursor.execute(create_table_query)
-                    self.connection.commit()
+                    connection.commit()
                     print(f"Table '{schema_name}.{table_name}' created")
                 else:
                     print(f"Table '{schema_name}.{table_name}' already exists")
 
                 return True
 
+        try:
+            return self._run(operation)
+
         except Exception as e:
-            self.connection.rollback()
             print(f"Error checking/creating table '{schema_name}.{table_name}': {e}")
             raise
 
     # ---------------------------------------------------------------------------------------------
     #
     def insert_data(self, table, device, timestamp, data, on_conflict = "") -> bool:
-        if not self.connection:
-            raise Exception("Connection not established. Call connect() first.")
-
         query = f'INSERT INTO {table} ("device", "timestamp", "data") VALUES (%s, TO_TIMESTAMP(%s), %s) {on_conflict}'
         # logger.info(query)
         insert_query = sql.SQL(query)
 
-        try:
-            with self.connection.cursor() as cursor:
+        def operation(connection):
+            with connection.cursor() as cursor:
                 cursor.execute(insert_query, (device, timestamp, data))
-                self.connection.commit()
-                logger.debug(f"Row inserted into {table} table")
-                return True
+            connection.commit()
+            logger.debug("Row inserted into %s table", table)
+            return True
+
+        try:
+            return self._run(operation)
 
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error inserting row into {table} table: {e}")
             raise
 
     # ---------------------------------------------------------------------------------------------
     #
     def insert_data_with_uuid(self, table, device, uuid, timestamp, data, on_conflict = 'ON CONFLICT ("uuid") DO NOTHING') -> bool:
-        if not self.connection:
-            raise Exception("Connection not established. Call connect() first.")
-
         query = f'INSERT INTO {table} ("device", "uuid", "timestamp", "data") VALUES (%s, %s, TO_TIMESTAMP(%s), %s) {on_conflict}'
         # logger.info(query)
         insert_query = sql.SQL(query)
 
-        try:
-            with self.connection.cursor() as cursor:
+        def operation(connection):
+            with connection.cursor() as cursor:
                 cursor.execute(insert_query, (device, uuid, timestamp, data))
-                self.connection.commit()
-                logger.debug(f"Row inserted into {table} table")
-                return True
+            connection.commit()
+            logger.debug("Row inserted into %s table", table)
+            return True
+
+        try:
+            return self._run(operation)
 
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error inserting row into {table} table: {e}")
             raise
 
+    # ---------------------------------------------------------------------------------------------
+    # rows is a list of (device, uuid, timestamp, data)
+    # All rows are sent in a single multi-row INSERT and committed once
+    def insert_batch_with_uuid(self, table, rows, on_conflict = 'ON CONFLICT ("uuid") DO NOTHING') -> bool:
+        if rows is None or len(rows) == 0:
+            return True
+
+        query = f'INSERT INTO {table} ("device", "uuid", "timestamp", "data") VALUES %s {on_conflict}'
+        template = "(%s, %s, TO_TIMESTAMP(%s), %s)"
+
+        def operation(connection):
+            with connection.cursor() as cursor:
+                execute_values(cursor, query, rows, template=template, page_size=len(rows))
+            connection.commit()
+            logger.debug("%d rows inserted into %s table", len(rows), table)
+            return True
+
+        try:
+            return self._run(operation)
+
+        except Exception as e:
+            logger.error(f"Error inserting {len(rows)} rows into {table} table: {e}")
+            raise
+
+    # ---------------------------------------------------------------------------------------------
+    # rows is a list of (device, uuid, timestamp, data)
+    # Bulk path used to catch up a backlog: rows are streamed with COPY FROM STDIN (CSV) into a
+    # temporary staging table, then merged into the table with INSERT ... SELECT ... ON CONFLICT.
+    # The staging table is dropped at commit (one commit per batch).
+    def copy_batch_with_uuid(self, table, rows, on_conflict = 'ON CONFLICT ("uuid") DO NOTHING') -> bool:
+        if rows is None or len(rows) == 0:
+            return True
+
+        staging = "synciot_staging"
+        columns = '"device", "uuid", "timestamp", "data"'
+        create_query = f'CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {columns} FROM {table} WITH NO DATA'
+        copy_query = f'COPY {staging} ({columns}) FROM STDIN WITH (FORMAT csv)'
+        merge_query = f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} {on_conflict}'
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for device, uuid, timestamp, data in rows:
+            tm = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).isoformat()
+            writer.writerow((device, uuid, tm, data))
+
+        def operation(connection):
+            buffer.seek(0)
+            with connection.cursor() as cursor:
+                cursor.execute(create_query)
+                cursor.copy_expert(copy_query, buffer)
+                cursor.execute(merge_query)
+                inserted = cursor.rowcount
+            connection.commit()
+            logger.debug("%d rows copied into %s table (%s new)", len(rows), table, inserted)
+            return True
+
+        try:
+            return self._run(operation)
+
+        except Exception as e:
+            logger.error(f"Error copying {len(rows)} rows into {table} table: {e}")
+            raise
+
     # ---------------------------------------------------------------------------------------------
     #
     def read_config(self, table, key):
-        if not self.connection:
-            raise Exception("Connection not established. Call connect() first.")
-
         query = sql.SQL(f"SELECT * FROM {table} WHERE key = %s")
         logger.debug(query)
 
-        try:
-            with self.connection.cursor() as cursor:
+        def operation(connection):
+            with connection.cursor() as cursor:
                 cursor.execute(query, (key,))
                 result = cursor.fetchone()
+            connection.rollback()
 
-                if result:
-                    logger.info(f"Record found: {result}")
-                else:
-                    logger.info(f"No record found for key: {key}")
+            if result:
+                logger.info(f"Record found: {result}")
+            else:
+                logger.info(f"No record found for key: {key}")
+
+            return result
 
-                return result
+        try:
+            return self._run(operation)
 
         except Exception as e:
             logger.error(f"Error reading record from config table: {e}")
@@ -188,9 +369,6 @@ class PostgresClient:
     # ---------------------------------------------------------------------------------------------
     #
     def upsert_config(self, table, key, data):
-        if not self.connection:
-            raise Exception("Connection not established. Call connect() first.")
-
         query = f'''
         INSERT INTO {table} (key, data)
         VALUES (%s, %s)
@@ -198,15 +376,17 @@ class PostgresClient:
         '''
         upsert_query = sql.SQL(query)
 
-        try:
-            with self.connection.cursor() as cursor:
+        def operation(connection):
+            with connection.cursor() as cursor:
                 cursor.execute(upsert_query, (key, data))
-                self.connection.commit()
-                logger.info(f"Record upserted into config table with key: {key}")
-                return True
+            connection.commit()
+            logger.info(f"Record upserted into config table with key: {key}")
+            return True
+
+        try:
+            return self._run(operation)
 
         except Exception as e:
-            self.connection.rollback()
             logger.error(f"Error upserting record into config table: {e}")
             raise
 
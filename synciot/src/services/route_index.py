@@ -0,0 +1,160 @@
+"""
+RouteIndex resolves the destination table and action of an event from the routes of the configuration file.
+
+The routes are compiled once:
+- routes with a single equality filter are indexed in a hash table (attribute -> value -> route);
+- the other routes (several filters or no filter) are kept in a list and matched linearly.
+The first matching route in the configuration file order wins, as before.
+
+The resolved (table, action) is cached per tuple of the values of the attributes referenced by the routes.
+"""
+import os
+import sys
+
+# Add the parent directory to the system path
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tools.logger import get_logger
+
+logger = get_logger("RouteIndex")
+
+ROUTE_CACHE_SIZE = int(os.getenv("ROUTE_CACHE_SIZE", 4096))
+
+# -------------------------------------------------------------------------------------------------
+#
+class RouteIndex:
+    # ---------------------------------------------------------------------------------------------
+    #
+    def __init__(self, routes, default_schema, default_table, default_action, cache_size = ROUTE_CACHE_SIZE):
+        self.default_schema = default_schema
+        self.default_table = f"{default_schema}.{default_table}"
+        self.default_action = default_action
+        self.cache_size = max(0, int(cache_size))
+        self.cache = {}
+        self.index = {}         # attribute -> value -> (position, route)
+        self.linear_routes = [] # (position, route, [(attribute, value), ...])
+        self.targets = {}       # id(route) -> (table, action)
+        self.attributes = ()    # attributes referenced by the routes (cache key)
+        self._compile(routes)
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def _compile(self, routes) -> None:
+        attributes = set()
+
+        for position, route in enumerate(routes):
+            filters = route.get("filters")
+
+            if filters is None:
+                logger.error(f"Route {route} does not contain filters")
+                continue
+
+            conditions = []
+            for filter in filters:
+                attr = filter.get("attribute", None)
+                value = filter.get("value", None)
+
+                if attr == None or value == None:
+                    logger.error(f"Route {route} contains an invalid filter {filter}; route ignored")
+                    conditions = None
+                    break
+
+                conditions.append((attr, value))
+
+            if conditions is None:
+                continue
+
+            schema = route.get("schema", self.default_schema)
+            table = route.get("table", self.default_table)
+            self.targets[id(route)] = (f"{schema}.{table}", route.get("action", self.default_action))
+
+            for attr, value in conditions:
+                attributes.add(attr)
+
+            if len(conditions) == 1 and self._is_hashable(conditions[0][1]):
+                attr, value = conditions[0]
+                values = self.index.setdefault(attr, {})
+                # Keep the first route of the configuration file for a given value
+                if value not in values:
+                    values[value] = (position, route)
+            else:
+                self.linear_routes.append((position, route, conditions))
+
+        self.attributes = tuple(sorted(attributes))
+
+        logger.info(f"Routes compiled: indexed({sum(len(values) for values in self.index.values())}) linear({len(self.linear_routes)})")
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def _is_hashable(self, value) -> bool:
+        try:
+            hash(value)
+            return True
+        except TypeError:
+            return False
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def get_route(self, cloud_event) -> dict:
+        """
+        Return the first route matching the event, or None.
+        """
+        position = None
+        route = None
+
+        for attr, values in self.index.items():
+            try:
+                item = values.get(cloud_event.get(attr, None), None)
+            except TypeError:
+                # Unhashable event value: cannot match an indexed route
+                continue
+
+            if item is not None and (position is None or item[0] < position):
+                position, route = item
+
+        for linear_position, linear_route, conditions in self.linear_routes:
+            if position is not None and linear_position > position:
+                break
+
+            match = True
+            for attr, value in conditions:
+                if cloud_event.get(attr, None) != value:
+                    match = False
+                    break
+
+            if match:
+                return linear_route
+
+        return route
+
+    # ---------------------------------------------------------------------------------------------
+    #
+    def get_table(self, cloud_event) -> tuple [str, str]:
+        """
+        Return the (table, action) of the event; the default table and action if no route matches.
+        """
+        key = tuple(cloud_event.get(attr, None) for attr in self.attributes)
+
+        try:
+            target = self.cache.get(key, None)
+        except TypeError:
+            # Unhashable attribute value: not cached
+            key = None
+            target = None
+
+        if target is not None:
+            return target
+
+        route = self.get_route(cloud_event)
+
+        if route is None:
+            target = (self.default_table, self.default_action)
+        else:
+            target = self.targets[id(route)]
+
+        if key is not None and self.cache_size > 0:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[key] = target
+
+        return target
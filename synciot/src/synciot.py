@@ -28,13 +28,17 @@ import requests
 
 from services.azure_iot_hub_client import AzureIoTHubClient
 from services.postgres_client import PostgresClient
+from services.route_index import RouteIndex, ROUTE_CACHE_SIZE
+from services.batch_writer import BatchWriter, BATCH_SIZE, BATCH_MAX_DELAY_SEC, BULK_BATCH_SIZE
 
 from metrics import Metrics
-from tools.logger import get_logger
+from tools.logger import get_logger, flush_logs
+from tools import fast_json
 from _version import __version__
 
 logger = get_logger("SyncIoT")
 logger.info(f'SyncIoT version({__version__})')
+logger.info(f'JSON parser({fast_json.backend()})')
 
 SYNCIOT_CONFIG_FILENAME = "./config/synciot.json"
 SYNCIOT_CONFIG_FILENAME = os.getenv("SYNCIOT_CONFIG_FILENAME", SYNCIOT_CONFIG_FILENAME)
@@ -43,9 +47,131 @@ CONFIG_KEY = os.getenv("CONFIG_KEY", "synciot_config")
 MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 900))
 UPDATE_CONFIG_INTERVAL_SEC = int(os.getenv("UPDATE_CONFIG_INTERVAL_SEC", 300))
 BACKLOG_INTERVAL_SEC = int(os.getenv("BACKLOG_INTERVAL_SEC", 30))
+BULK_QUEUE_THRESHOLD = int(os.getenv("BULK_QUEUE_THRESHOLD", MAX_QUEUE_SIZE // 2))
+BULK_SWITCH_SEC = float(os.getenv("BULK_SWITCH_SEC", 5))
+EVENT_LOG_SAMPLE = int(os.getenv("EVENT_LOG_SAMPLE", 50))
+PARTITION_WORKERS = os.getenv("PARTITION_WORKERS", "false").lower() in ["1", "true", "yes"]
+PARTITION_QUEUE_SIZE = int(os.getenv("PARTITION_QUEUE_SIZE", MAX_QUEUE_SIZE))
 DEFAULT_ACTION = "insert"
 CLOUD_HOSTED_DABATASE=False
 
+# -----------------------------------------------------------------------------
+# Drain a queue of events and write them to PostgreSQL with its own BatchWriter.
+# Queue items are tuples (body, partition_id, sequence_number, queued time (monotonic)).
+# The sequence numbers are committed as checkpoints only once the events are written.
+class EventWorker(threading.Thread):
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self, synciot, name, event_queue):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.synciot = synciot
+        self.queue = event_queue
+        self.batch_writer = synciot.create_batch_writer()
+        self.bulk_switch_time = None
+        self.sequence_numbers = {}  # partition_id -> last sequence number added to the batch
+
+    # -------------------------------------------------------------------------
+    #
+    def run(self) -> None:
+        try:
+            logger.info(f"{self.name} worker started")
+
+            while True:
+                # Retry pending events first when the database was unavailable (no new events are read meanwhile)
+                if self.batch_writer.is_due() and not self._flush_events():
+                    continue
+
+                while not self.queue.empty():
+                    event, partition_id, sequence_number, queued_time = self.queue.get(block=False)
+                    self.synciot.observe_time_in_queue(time.monotonic() - queued_time)
+                    self.synciot.total_events.inc()
+                    self.synciot._handle_event(event, self.batch_writer)
+                    # Skipped events (invalid, no route) are checkpointed too: there is no reason to read them again
+                    self.sequence_numbers[partition_id] = sequence_number
+                    self.queue.task_done()
+
+                    self._update_bulk_mode()
+
+                    if self.batch_writer.is_due() and not self._flush_events():
+                        break
+
+                self._update_bulk_mode()
+
+                # Skipped events (invalid, no route) do not fill the batch: their checkpoints are committed
+                # once the batch is empty, i.e. all the events read before them are written
+                if self.batch_writer.count == 0:
+                    self._commit_checkpoints()
+
+                    # Update the configuration data (and checkpoints) in PostgreSQL database after a few events
+                    if self.synciot.total_events.get_value() > 10:
+                        self.synciot.save_config_data()
+
+                time.sleep(0.1)
+
+        except Exception as e:
+            # A worker thread cannot exit the process: SyncIoT.run() does it
+            self.synciot.set_fatal_error(f"{self.name} worker failed: {e}")
+
+    # -------------------------------------------------------------------------
+    #
+    def _flush_events(self) -> bool:
+        """
+        Write the pending events to the PostgreSQL database (one multi-row insert and one commit per table).
+        The checkpoints (sequence numbers) are saved only once the events are committed, so a restart
+        resumes right after the last committed event without inserting duplicates.
+        Return False if the database is unavailable (transient errors are retried by PostgresClient);
+        the events are kept and written on the next call. The events rejected by the database
+        (invalid data) are skipped by the batch writer and checkpointed.
+        """
+        try:
+            if not self.batch_writer.flush():
+                logger.error(f"{self.name} PostgreSQL database unavailable, {self.batch_writer.count} pending events kept")
+                return False
+
+        except Exception as e:
+            raise Exception(f"Failed to insert batch into PostgreSQL database: {e}")
+
+        # The checkpoints of the written events are saved right away (same as AsyncSyncIoT),
+        # so a restart does not read the events of this batch again
+        if len(self.sequence_numbers) > 0:
+            self._commit_checkpoints()
+            self.synciot.save_config_data(force=True)
+
+        return True
+
+    # -------------------------------------------------------------------------
+    #
+    def _commit_checkpoints(self) -> None:
+        if len(self.sequence_numbers) > 0:
+            self.synciot.commit_checkpoints(self.sequence_numbers)
+            self.sequence_numbers = {}
+
+    # -------------------------------------------------------------------------
+    #
+    def _update_bulk_mode(self) -> None:
+        """
+        Switch the batch writer to bulk mode (COPY) when the queue depth stays above
+        bulk_queue_threshold for BULK_SWITCH_SEC (backlog catch-up), and back to
+        normal mode when it stays below the threshold for the same delay.
+        """
+        above = self.queue.qsize() >= self.synciot.bulk_queue_threshold
+
+        if above == self.batch_writer.bulk_mode:
+            self.bulk_switch_time = None
+            return
+
+        now = time.monotonic()
+
+        if self.bulk_switch_time is None:
+            self.bulk_switch_time = now
+            return
+
+        if now - self.bulk_switch_time >= BULK_SWITCH_SEC:
+            logger.info(f"{self.name} queue depth({self.queue.qsize()}) bulk_queue_threshold({self.synciot.bulk_queue_threshold}): bulk mode({above})")
+            self.batch_writer.set_bulk_mode(above)
+            self.bulk_switch_time = None
+
 # -----------------------------------------------------------------------------
 #
 class SyncIoT:
@@ -55,8 +181,18 @@ class SyncIoT:
     def __init__(self):
         self.iot_hub_client = AzureIoTHubClient()
         self.postgres_client = PostgresClient()
+        self.batch_size = BATCH_SIZE
+        self.batch_max_delay_sec = BATCH_MAX_DELAY_SEC
+        self.bulk_batch_size = BULK_BATCH_SIZE
+        self.bulk_queue_threshold = BULK_QUEUE_THRESHOLD
+        self.partition_workers = PARTITION_WORKERS
+        self.event_log_sample = EVENT_LOG_SAMPLE
+        self.workers = []
+        self.config_lock = threading.Lock()
+        self.fatal_error = threading.Event()
         self.queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
         self.config = None
+        self.route_index = None
         self.config_table = CONFIG_TABLE
         self.config_key = CONFIG_KEY
         self.update_config_interval_sec = UPDATE_CONFIG_INTERVAL_SEC
@@ -65,11 +201,48 @@ class SyncIoT:
         self.config_data = {"timestamp": 0} # Last timestamp of IoT Hub received data
         self.metrics = Metrics()
         self.total_events = self.metrics.add_counter("total_events")
+        self.rejected_events = self.metrics.add_counter("rejected_events")
+        self.time_in_queue_seconds = self.metrics.add_gauge("time_in_queue_seconds")
+        self.time_in_queue_avg_seconds = self.metrics.add_gauge("time_in_queue_avg_seconds")
+        self.iot_hub_client.set_metrics(self.metrics)
         self.last_event_time: datetime.datetime = None
 
     # -------------------------------------------------------------------------
     #
     def init(self) -> bool:
+        try:
+            if not self._load_config():
+                return False
+
+            # Initialize IoT Hub client
+            if not self.iot_hub_client.init(
+                connection_string=self.iothub.get("connection_string"),
+                consumer_group=self.iothub.get("consumer_group"),
+                max_batch_size=self.iothub.get("max_batch_size", None),
+                prefetch=self.iothub.get("prefetch", None)
+            ):
+                logger.error(f"Failed to initialize IoT Hub client")
+                return False
+
+            if not self.postgres_client.connect(self.postgresql):
+                logger.error(f"Failed to initialize PostgreSQL client and connect to database")
+                return False
+
+            if not self.load_config_data():
+                logger.error(f"Failed to load configuration data from PostgreSQL database")
+                return False
+
+            return True
+        except Exception as e:
+            logger.error(f"Failed to initialize SyncIoT: {e}")
+            return False
+
+    # -------------------------------------------------------------------------
+    #
+    def _load_config(self) -> bool:
+        """
+        Load the configuration file (routes, options and secrets).
+        """
         try:
             with open(SYNCIOT_CONFIG_FILENAME, "r") as f:
                 self.config = json.load(f)
@@ -90,34 +263,47 @@ class SyncIoT:
                 logger.error(f"Failed to load configuration from {SYNCIOT_CONFIG_FILENAME}")
                 return False
 
+            self.compile_routes()
+
             self.config_data["timestamp"] = int(time.time())
             self.config_table = self.postgresql.get("config_table", self.config_table)
             self.config_key = self.postgresql.get("config_key", self.config_key)
             self.update_config_interval_sec = self.postgresql.get("update_config_interval_sec", self.update_config_interval_sec)
             logger.info(f"config_table({self.config_table}) config_key({self.config_key}) update_config_interval_sec({self.update_config_interval_sec})")
 
-            if not self._update_secrets():
-                logger.error(f"Failed to update secrets")
-                return False
-
-            # Initialize IoT Hub client
-            if not self.iot_hub_client.init(connection_string=self.iothub.get("connection_string"), consumer_group=self.iothub.get("consumer_group")):
-                logger.error(f"Failed to initialize IoT Hub client")
-                return False
+            self.batch_size = int(self.postgresql.get("batch_size", self.batch_size))
+            self.batch_max_delay_sec = float(self.postgresql.get("batch_max_delay_sec", self.batch_max_delay_sec))
+            self.bulk_batch_size = int(self.postgresql.get("bulk_batch_size", self.bulk_batch_size))
+            self.bulk_queue_threshold = int(self.postgresql.get("bulk_queue_threshold", self.bulk_queue_threshold))
+            logger.info(f"batch_size({self.batch_size}) batch_max_delay_sec({self.batch_max_delay_sec})")
+            logger.info(f"bulk_batch_size({self.bulk_batch_size}) bulk_queue_threshold({self.bulk_queue_threshold})")
 
-            if not self.postgres_client.connect(self.postgresql):
-                logger.error(f"Failed to initialize PostgreSQL client and connect to database")
-                return False
+            self.partition_workers = bool(self.iothub.get("partition_workers", self.partition_workers))
+            logger.info(f"partition_workers({self.partition_workers})")
 
-            if not self.load_config_data():
-                logger.error(f"Failed to load configuration data from PostgreSQL database")
+            if not self._update_secrets():
+                logger.error(f"Failed to update secrets")
                 return False
 
             return True
         except Exception as e:
-            logger.error(f"Failed to initialize SyncIoT: {e}")
+            logger.error(f"Failed to load configuration: {e}")
             return False
 
+    # -------------------------------------------------------------------------
+    #
+    def compile_routes(self) -> None:
+        """
+        Compile the routes into a RouteIndex (hash index on single-attribute routes).
+        """
+        self.route_index = RouteIndex(
+            self.routes,
+            self.postgresql.get("default_schema"),
+            self.postgresql.get("default_table"),
+            DEFAULT_ACTION,
+            self.postgresql.get("route_cache_size", ROUTE_CACHE_SIZE)
+        )
+
     # -------------------------------------------------------------------------
     #
     def _update_secrets(self) -> bool:
@@ -215,6 +401,18 @@ class SyncIoT:
     def get_event_count(self) -> int:
         return self.total_events.get_value()
 
+    # -------------------------------------------------------------------------
+    #
+    def get_metrics(self) -> dict:
+        return self.metrics.get_values()
+
+    # -------------------------------------------------------------------------
+    # Time between the reception of an event and its processing (last value and moving average)
+    def observe_time_in_queue(self, seconds) -> None:
+        self.time_in_queue_seconds.set(round(seconds, 3))
+        average = self.time_in_queue_avg_seconds.get_value()
+        self.time_in_queue_avg_seconds.set(round(average + (seconds - average) * 0.01, 4))
+
     # -------------------------------------------------------------------------
     #
     def get_last_event_time(self) -> str:
@@ -243,43 +441,134 @@ class SyncIoT:
         try:
             logger.info("Starting SyncIoT...")
 
-            start_position_epoch = self.config_data.get("timestamp", 0)
-            if start_position_epoch == 0:
-                start_position_epoch = int(time.time()) - BACKLOG_INTERVAL_SEC
-
-            start_position = datetime.datetime.fromtimestamp(start_position_epoch)
-
-            logger.info(f"Starting SyncIoT from position datetime({start_position}) epoch({start_position_epoch})")
-
-            self.iot_hub_client.subscribe_to_events(self.queue, start_position)
+            start_time = self._get_start_time()
 
-            logger.info("Event listening started.")
+            if self.partition_workers:
+                self._run_partitions(start_time)
+            else:
+                start_positions, start_positions_inclusive = self._get_start_positions(self.iot_hub_client.get_partition_ids(), start_time)
 
-            while True:
-                while not self.queue.empty():
-                    event = self.queue.get(block=False)
-                    if event:
-                        self.total_events.inc()
-                        self._handle_event(event)
-                    else:
-                        logger.warning("Received None event")
-                    self.queue.task_done()
+                self.iot_hub_client.subscribe_to_events(self.queue, start_positions, start_positions_inclusive)
 
-                # Update the configuration data in PostgreSQL database after a few events
-                if self.total_events.get_value() > 10:
-                    self.save_config_data()
+                logger.info("Event listening started.")
 
-                time.sleep(0.1)
+                EventWorker(self, "SyncIoT", self.queue).run()
 
         except KeyboardInterrupt:
             logger.warning("Message listening stopped.")
+            return
         except Exception as e:
             logger.error(f"Failed to run SyncIoT: {e}")
             self.iot_hub_client.disconnect()
+            return
+
+        if self.fatal_error.is_set():
+            self._exit_on_fatal_error()
+
+    # -------------------------------------------------------------------------
+    #
+    def set_fatal_error(self, message) -> None:
+        """
+        Report an error that stops the ingestion (ex: a worker cannot write its events).
+        SyncIoT.run() exits the process.
+        """
+        logger.error(message)
+        self.fatal_error.set()
+
+    # -------------------------------------------------------------------------
+    #
+    def _exit_on_fatal_error(self) -> None:
+        """
+        Exit the process: run() is executed in a thread (start_thread) where exit() only stops the thread.
+        The events not committed are read again from the checkpoints on restart.
+        """
+        logger.critical("SyncIoT stopped on a fatal error, exiting")
+        self.iot_hub_client.disconnect()
+        flush_logs()
+        os._exit(1)
+
+    # -------------------------------------------------------------------------
+    #
+    def _run_partitions(self, start_time) -> None:
+        """
+        One bounded queue and one writer worker per Event Hub partition.
+        Each partition resumes from its own checkpoint (sequence number) when available,
+        otherwise from start_time.
+        """
+        partition_ids = self.iot_hub_client.get_partition_ids()
+        if partition_ids is None or len(partition_ids) == 0:
+            raise Exception("No partition found in IoT Hub")
+
+        start_positions, start_positions_inclusive = self._get_start_positions(partition_ids, start_time)
+        partition_queues = {}
+
+        for partition_id in partition_ids:
+            partition_queues[partition_id] = queue.Queue(maxsize=PARTITION_QUEUE_SIZE)
+            self.workers.append(EventWorker(self, f"Partition-{partition_id}", partition_queues[partition_id]))
+
+        for worker in self.workers:
+            worker.start()
+
+        self.iot_hub_client.subscribe_to_events(None, start_positions, start_positions_inclusive, partition_queues)
+
+        logger.info(f"Event listening started on {len(partition_ids)} partitions.")
+
+        # The workers run until a fatal error
+        self.fatal_error.wait()
+
+    # -------------------------------------------------------------------------
+    #
+    def _get_start_positions(self, partition_ids, start_time) -> tuple [dict, dict]:
+        """
+        Return the start position of each partition: the event following the checkpoint (last committed
+        sequence number, exclusive) or start_time (inclusive) if the partition has no checkpoint.
+        If the partition ids are unknown, all partitions start from start_time.
+        """
+        if partition_ids is None or len(partition_ids) == 0:
+            logger.warning("Partition ids unknown, starting all partitions from the saved timestamp")
+            return start_time, True
+
+        checkpoints = self.config_data.get("partitions", {})
+        start_positions = {}
+        start_positions_inclusive = {}
+
+        for partition_id in partition_ids:
+            sequence_number = checkpoints.get(partition_id, {}).get("sequence_number", None)
+            if sequence_number is not None:
+                start_positions[partition_id] = int(sequence_number)
+                start_positions_inclusive[partition_id] = False
+            else:
+                start_positions[partition_id] = start_time
+                start_positions_inclusive[partition_id] = True
+
+            logger.info(f"Partition({partition_id}) start_position({start_positions[partition_id]}) inclusive({start_positions_inclusive[partition_id]})")
+
+        return start_positions, start_positions_inclusive
+
+    # -------------------------------------------------------------------------
+    #
+    def _get_start_time(self) -> datetime.datetime:
+        start_position_epoch = self.config_data.get("timestamp", 0)
+        if start_position_epoch == 0:
+            start_position_epoch = int(time.time()) - BACKLOG_INTERVAL_SEC
+
+        start_position = datetime.datetime.fromtimestamp(start_position_epoch)
+
+        logger.info(f"Starting SyncIoT from position datetime({start_position}) epoch({start_position_epoch})")
+
+        return start_position
+
+    # -------------------------------------------------------------------------
+    #
+    def create_batch_writer(self) -> BatchWriter:
+        batch_writer = BatchWriter(self.postgres_client, self.batch_size, self.batch_max_delay_sec)
+        batch_writer.bulk_batch_size = self.bulk_batch_size
+        batch_writer.rejected_events = self.rejected_events
+        return batch_writer
 
     # -------------------------------------------------------------------------
     #
-    def _handle_event(self, event) -> None:
+    def _handle_event(self, event, batch_writer: BatchWriter) -> None:
         try:
             """
             Handle the event received from Azure IoT Hub.
@@ -290,14 +579,14 @@ class SyncIoT:
                 logger.warning("Received None event")
                 return
 
-            ce = json.loads(event)
+            # The event body is parsed once; it is stored as received (no serialization)
+            ce = fast_json.loads(event)
 
-            if ce is None:
+            if type(ce) is not dict:
                 logger.warning("Received invalid event")
                 return
 
-            data = ce.get("data")
-            if data is None:
+            if ce.get("data") is None:
                 logger.warning("Received event does not contain 'data' field")
                 return
 
@@ -311,36 +600,34 @@ class SyncIoT:
                 logger.warning("Received event does not contain 'source' field")
                 return
 
-            try:
-                tm = ce.get("time", None)
-                if tm != None:
-                    self.last_event_time = datetime.datetime.fromisoformat(tm)
-            except Exception as e:
-                logger.error(f"Failed to parse event time: {e} ce({ce})")
-                self.last_event_time = None
+            tm = ce.get("time", None)
+            if tm != None:
+                try:
+                    event_time = datetime.datetime.fromisoformat(tm)
+                except Exception as e:
+                    logger.error("Failed to parse event time: %s id(%s)", e, uuid)
+                    event_time = None
 
-            sdata = json.dumps(data)
-            logger.info(f"Rx device {device} data: {sdata:.100}")
+                # Shared by the partition workers, read by _get_config_data()
+                with self.config_lock:
+                    self.last_event_time = event_time
 
-            now = int(time.time())
+            count = self.total_events.get_value()
+            if self.event_log_sample > 0 and count % self.event_log_sample == 0:
+                logger.info("Processed %d events; Rx device(%s) type(%s) event: %.100s", count, device, ce.get("type"), event)
+            else:
+                logger.debug("Rx device(%s) type(%s) id(%s)", device, ce.get("type"), uuid)
 
             table, action = self.get_table(ce)
             if table is None or action is None:
-                logger.warning(f"Received event does not match any route: {event}")
+                logger.warning("Received event does not match any route: %.300s", event)
                 return
 
             if action == "insert":
-                if not self.postgres_client.insert_data_with_uuid(table, device, uuid, now, event):
-                    logger.error(f"Failed to insert data into PostgreSQL database table({table}) device({device}) uuid({uuid}) event({event})")
-                    exit(1)
+                batch_writer.add(table, device, uuid, int(time.time()), event)
             else:
                 logger.error(f"Unknown action '{action}' for table '{table}'")
 
-            count = self.total_events.get_value()
-            if count > 0 and count % 50 == 0:
-                logger.info(f"Processed {count} events")
-                self.save_config_data()
-
         except Exception as e:
             logger.error(f"{e}")
 
@@ -353,24 +640,11 @@ class SyncIoT:
         The action is used to determine the type of operation to perform on the database.
         """
         try:
-            schema = self.postgresql.get("default_schema")
-            table = self.postgresql.get("default_table")
-            table = f"{schema}.{table}"
-            action = DEFAULT_ACTION
-
-            route = self.get_route(cloud_event)
-
-            if route != None:
-                schema = route.get("schema", schema)
-                table = route.get("table", table)
-                table = f"{schema}.{table}"
-                action = route.get("action", action)
+            return self.route_index.get_table(cloud_event)
 
         except Exception as e:
             logger.error(f"Failed to get table name and action: {e}")
-
-        finally:
-            return table, action
+            return None, None
 
     # -------------------------------------------------------------------------
     #
@@ -380,26 +654,7 @@ class SyncIoT:
         The route is used to determine the table name and action to perform on the database.
         """
         try:
-            for route in self.routes:
-                filters = route.get("filters")
-
-                if filters is None:
-                    logger.error(f"Route {route} does not contain filters")
-                    continue
-
-                match = True
-                for filter in filters:
-                    attr = filter.get("attribute", None)
-                    value = filter.get("value", None)
-
-                    if attr == None or value == None or cloud_event.get(attr, None) != value:
-                        match = False
-                        break
-
-                if match:
-                    return route
-
-            return None
+            return self.route_index.get_route(cloud_event)
 
         except Exception as e:
             logger.error(f"Failed to get route: {e}")
@@ -426,29 +681,36 @@ class SyncIoT:
                 logger.warning(f"Failed to load configuration data from PostgreSQL database table({self.config_table}) key({self.config_key})")
                 return self.save_config_data(force=True)
 
-            data = result[1]
-            if data is None:
-                logger.error(f"Failed to load configuration data from PostgreSQL database")
-                return False
+            return self._set_config_data(result)
 
-            if type(data) is str:
-                data = json.loads(data)
+        except Exception as e:
+            logger.error(f"Failed to get route: {e}")
+            return False
 
-            if data is None:
-                logger.error(f"Failed to load configuration data from PostgreSQL database")
-                return False
+    # -------------------------------------------------------------------------
+    #
+    def _set_config_data(self, result) -> bool:
+        """
+        Set config data from a config table record (key, data).
+        """
+        data = result[1]
+        if data is None:
+            logger.error(f"Failed to load configuration data from PostgreSQL database")
+            return False
 
-            self.config_data = data
+        if type(data) is str:
+            data = json.loads(data)
 
-            logger.info(f"Loaded configuration data({self.config_data}) from PostgreSQL database table({self.config_table}) key({self.config_key})")
-            self.last_config_data_update_sec = int(time.time())
+        if data is None:
+            logger.error(f"Failed to load configuration data from PostgreSQL database")
+            return False
 
-            return True
+        self.config_data = data
 
-        except Exception as e:
-            logger.error(f"Failed to get route: {e}")
-            return False
+        logger.info(f"Loaded configuration data({self.config_data}) from PostgreSQL database table({self.config_table}) key({self.config_key})")
+        self.last_config_data_update_sec = int(time.time())
 
+        return True
 
     # -------------------------------------------------------------------------
     #
@@ -457,9 +719,26 @@ class SyncIoT:
         Save config data to PostgreSQL database.
         """
         try:
+            data = self._get_config_data(force)
+            if data is None:
+                return True
+
+            return self.postgres_client.upsert_config(self.config_table, self.config_key, data)
+
+        except Exception as e:
+            logger.error(f"Failed to get route: {e}")
+            return False
+
+    # -------------------------------------------------------------------------
+    #
+    def _get_config_data(self, force = False) -> str:
+        """
+        Return the config data to save (JSON), or None if it was saved less than update_config_interval_sec ago.
+        """
+        with self.config_lock:
             now = int(time.time())
             if now - self.last_config_data_update_sec < self.update_config_interval_sec and not force:
-                return True
+                return None
 
             self.last_config_data_update_sec = now
 
@@ -468,11 +747,20 @@ class SyncIoT:
             else:
                 self.config_data["timestamp"] = now - BACKLOG_INTERVAL_SEC
 
-            return self.postgres_client.upsert_config(self.config_table, self.config_key, json.dumps(self.config_data))
+            return json.dumps(self.config_data)
 
-        except Exception as e:
-            logger.error(f"Failed to get route: {e}")
-            return False
+    # -------------------------------------------------------------------------
+    #
+    def commit_checkpoints(self, sequence_numbers: dict) -> None:
+        """
+        Record the sequence number of the last committed event of each partition.
+        The checkpoints are saved with the configuration data (config_data["partitions"]).
+        """
+        with self.config_lock:
+            partitions = self.config_data.setdefault("partitions", {})
+
+            for partition_id, sequence_number in sequence_numbers.items():
+                partitions[partition_id] = {"sequence_number": sequence_number}
 
 # -----------------------------------------------------------------------------
 #
@@ -0,0 +1,307 @@
+"""
+AsyncSyncIoT: asyncio engine of SyncIoT.
+
+It runs inside the FastAPI (uvicorn) event loop instead of a listener thread and a polling loop:
+- the events are received with azure.eventhub.aio.EventHubConsumerClient;
+- each partition has a bounded asyncio.Queue: the receiver waits when the queue is full (backpressure);
+- each partition has a writer task that groups the events in batches (BatchWriter) and writes them
+  with asyncpg (AsyncPostgresClient). Up to max_inflight_batches batches are written concurrently
+  (pipelined inserts) while the next batch is filled;
+- the checkpoints (sequence numbers) are committed in order, once their batch is written;
+- a batch rejected because of its data is written one row at a time, the rejected rows are skipped.
+
+Routing, event parsing and configuration data are shared with SyncIoT.
+
+Enable it with SYNCIOT_ASYNC=true (see main.py). Requires: pip install asyncpg
+"""
+import os
+import time
+import asyncio
+import collections
+
+from synciot import SyncIoT, PARTITION_QUEUE_SIZE
+from services.async_azure_iot_hub_client import AsyncAzureIoTHubClient
+from services.async_postgres_client import AsyncPostgresClient, DATA_ERRORS
+from services.postgres_client import DatabaseConnectionException
+from tools.logger import get_logger, flush_logs
+
+logger = get_logger("AsyncSyncIoT")
+
+MAX_INFLIGHT_BATCHES = int(os.getenv("MAX_INFLIGHT_BATCHES", 2))
+IDLE_WAIT_SEC = 0.1
+
+# -----------------------------------------------------------------------------
+#
+class AsyncSyncIoT(SyncIoT):
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self):
+        SyncIoT.__init__(self)
+        self.iot_hub_client = AsyncAzureIoTHubClient()
+        self.iot_hub_client.set_metrics(self.metrics)
+        self.postgres_client = AsyncPostgresClient()
+        self.max_inflight_batches = MAX_INFLIGHT_BATCHES
+        self.task = None
+
+    # -------------------------------------------------------------------------
+    # The PostgreSQL connection pool is created in run(), inside the event loop
+    def init(self) -> bool:
+        try:
+            if not self._load_config():
+                return False
+
+            self.max_inflight_batches = max(1, int(self.postgresql.get("max_inflight_batches", self.max_inflight_batches)))
+            logger.info(f"max_inflight_batches({self.max_inflight_batches})")
+
+            if not self.iot_hub_client.init(connection_string=self.iothub.get("connection_string"), consumer_group=self.iothub.get("consumer_group")):
+                logger.error(f"Failed to initialize IoT Hub client")
+                return False
+
+            return True
+        except Exception as e:
+            logger.error(f"Failed to initialize SyncIoT: {e}")
+            return False
+
+    # -------------------------------------------------------------------------
+    # Must be called from the event loop (ex: FastAPI lifespan)
+    def start_task(self) -> None:
+        logger.info("Starting SyncIoT task...")
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    # -------------------------------------------------------------------------
+    #
+    async def stop_task(self) -> None:
+        if self.task is None:
+            return
+
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+        self.task = None
+        logger.info("SyncIoT task stopped.")
+
+    # -------------------------------------------------------------------------
+    #
+    async def run(self) -> None:
+        writers = []
+        failed = False
+
+        try:
+            logger.info("Starting SyncIoT (asyncio)...")
+
+            await self.postgres_client.connect(self.postgresql)
+
+            if not await self.load_config_data():
+                raise Exception("Failed to load configuration data from PostgreSQL database")
+
+            partition_ids = await self.iot_hub_client.get_partition_ids()
+            if partition_ids is None or len(partition_ids) == 0:
+                raise Exception("No partition found in IoT Hub")
+
+            start_positions, start_positions_inclusive = self._get_start_positions(partition_ids, self._get_start_time())
+
+            partition_queues = {}
+            for partition_id in partition_ids:
+                partition_queues[partition_id] = asyncio.Queue(maxsize=PARTITION_QUEUE_SIZE)
+                writers.append(asyncio.create_task(self._write_events(partition_id, partition_queues[partition_id])))
+
+            logger.info(f"Event listening started on {len(partition_ids)} partitions.")
+
+            await asyncio.gather(self.iot_hub_client.receive(partition_queues, start_positions, start_positions_inclusive), *writers)
+
+        except asyncio.CancelledError:
+            logger.warning("Message listening stopped.")
+            raise
+        except Exception as e:
+            # Ex: a writer failed to write a batch (not database unavailability, which is retried)
+            logger.error(f"Failed to run SyncIoT: {e}")
+            failed = True
+
+        finally:
+            for writer in writers:
+                writer.cancel()
+            await self.iot_hub_client.disconnect()
+            await self.postgres_client.close()
+
+        # The ingestion stopped while FastAPI would keep serving: exit like the thread engine
+        if failed:
+            self._exit_on_fatal_error()
+
+    # -------------------------------------------------------------------------
+    #
+    def _exit_on_fatal_error(self) -> None:
+        """
+        Exit the process, the clients are closed by run().
+        The events not committed are read again from the checkpoints on restart.
+        """
+        logger.critical("SyncIoT stopped on a fatal error, exiting")
+        flush_logs()
+        os._exit(1)
+
+    # -------------------------------------------------------------------------
+    #
+    async def _write_events(self, partition_id, event_queue: asyncio.Queue) -> None:
+        """
+        Group the events of a partition in batches and write them to PostgreSQL.
+        """
+        batch_writer = self.create_batch_writer()
+        inflight = collections.deque()  # (task, sequence_numbers) in write order
+        sequence_numbers = {}
+
+        logger.info(f"Partition-{partition_id} writer started")
+
+        while True:
+            item = await self._get_event(event_queue, batch_writer, len(inflight) > 0)
+
+            if item is not None:
+                event, event_partition_id, sequence_number, queued_time = item
+                self.observe_time_in_queue(time.monotonic() - queued_time)
+                self.total_events.inc()
+                self._handle_event(event, batch_writer)
+                # Skipped events (invalid, no route) are checkpointed too: there is no reason to read them again
+                sequence_numbers[event_partition_id] = sequence_number
+
+            batch_writer.set_bulk_mode(event_queue.qsize() >= self.bulk_queue_threshold)
+
+            if batch_writer.is_due():
+                task = asyncio.create_task(self._write_batches(batch_writer.take(), batch_writer.bulk_mode))
+                inflight.append((task, sequence_numbers))
+                sequence_numbers = {}
+
+            await self._complete_batches(inflight)
+
+            if len(inflight) == 0 and batch_writer.count == 0 and self.total_events.get_value() > 10:
+                await self.save_config_data()
+
+    # -------------------------------------------------------------------------
+    #
+    async def _get_event(self, event_queue: asyncio.Queue, batch_writer, pending_writes: bool):
+        """
+        Return the next event, or None when the current batch is due or a pending write must be checked.
+        """
+        try:
+            return event_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+
+        if batch_writer.count > 0:
+            timeout = max(0, batch_writer.first_row_time + batch_writer.max_batch_delay_sec - time.monotonic())
+        elif pending_writes:
+            timeout = IDLE_WAIT_SEC
+        else:
+            return await event_queue.get()
+
+        try:
+            return await asyncio.wait_for(event_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    # -------------------------------------------------------------------------
+    #
+    async def _complete_batches(self, inflight: collections.deque) -> None:
+        """
+        Commit the checkpoints of the written batches, in order.
+        Wait for the oldest batch while max_inflight_batches batches are being written.
+        Errors other than database unavailability are raised (the writer stops).
+        """
+        while len(inflight) > 0:
+            task, sequence_numbers = inflight[0]
+
+            if not task.done() and len(inflight) < self.max_inflight_batches:
+                return
+
+            await task
+            inflight.popleft()
+
+            if len(sequence_numbers) > 0:
+                self.commit_checkpoints(sequence_numbers)
+                await self.save_config_data(force=True)
+
+    # -------------------------------------------------------------------------
+    #
+    async def _write_batches(self, batches: dict, bulk_mode: bool) -> None:
+        """
+        Write the batches (table -> rows), one transaction per table.
+        When the database is unavailable, the batch is retried until it is written:
+        meanwhile the partition queue fills up and the receiver waits.
+        A batch rejected because of its data is written one row at a time.
+        """
+        for table, rows in batches.items():
+            while True:
+                try:
+                    if bulk_mode:
+                        await self.postgres_client.copy_batch_with_uuid(table, rows)
+                    else:
+                        await self.postgres_client.insert_batch_with_uuid(table, rows)
+                    break
+
+                except DatabaseConnectionException as e:
+                    logger.error(f"PostgreSQL database unavailable, {len(rows)} rows kept for table({table}): {e}")
+                    await asyncio.sleep(self.postgres_client.retry_interval_sec)
+
+                except DATA_ERRORS as e:
+                    logger.warning(f"Batch rejected by table({table}) rows({len(rows)}): {e}, inserting the rows one at a time")
+                    await self._write_rows(table, rows)
+                    break
+
+    # -------------------------------------------------------------------------
+    #
+    async def _write_rows(self, table, rows) -> None:
+        """
+        Write the rows one at a time (one transaction per row).
+        The rows rejected by the database are logged, counted (rejected_events) and skipped.
+        """
+        for row in rows:
+            while True:
+                try:
+                    await self.postgres_client.insert_batch_with_uuid(table, [row])
+                    break
+
+                except DatabaseConnectionException as e:
+                    logger.error(f"PostgreSQL database unavailable, row kept for table({table}): {e}")
+                    await asyncio.sleep(self.postgres_client.retry_interval_sec)
+
+                except DATA_ERRORS as e:
+                    device, uuid, timestamp, data = row
+                    logger.error(f"Row rejected by table({table}) device({device}) uuid({uuid}): {e} data({str(data):.300})")
+                    self.rejected_events.inc()
+                    break
+
+    # -------------------------------------------------------------------------
+    #
+    async def load_config_data(self) -> bool:
+        """
+        Read config data from PostgreSQL database.
+        """
+        try:
+            result = await self.postgres_client.read_config(self.config_table, self.config_key)
+            if result is None or len(result) == 0:
+                logger.warning(f"Failed to load configuration data from PostgreSQL database table({self.config_table}) key({self.config_key})")
+                return await self.save_config_data(force=True)
+
+            return self._set_config_data(result)
+
+        except Exception as e:
+            logger.error(f"Failed to load configuration data: {e}")
+            return False
+
+    # -------------------------------------------------------------------------
+    #
+    async def save_config_data(self, force = False) -> bool:
+        """
+        Save config data to PostgreSQL database.
+        """
+        try:
+            data = self._get_config_data(force)
+            if data is None:
+                return True
+
+            return await self.postgres_client.upsert_config(self.config_table, self.config_key, data)
+
+        except Exception as e:
+            logger.error(f"Failed to save configuration data: {e}")
+            return False
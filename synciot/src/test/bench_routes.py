@@ -0,0 +1,132 @@
+'''
+Microbenchmark of the route resolution (RouteIndex) with 100+ routes.
+Compares the linear scan of the routes (previous SyncIoT.get_route) with the compiled index, with and without cache.
+
+python3 bench_routes.py [route_count] [event_count]
+'''
+# Do this first !
+import sys
+import os
+
+# Add parent directory to Python path to resolve imports
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+os.environ.setdefault("LOGGING_FILENAME", "")
+
+import time
+import random
+
+from services.route_index import RouteIndex
+
+DEFAULT_SCHEMA = "rci_capteurs"
+DEFAULT_TABLE = "rci_lost"
+DEFAULT_ACTION = "insert"
+
+# -----------------------------------------------------------------------------
+#
+def make_routes(route_count):
+    routes = []
+
+    for i in range(route_count):
+        routes.append({
+            "name": f"route_{i}",
+            "filters": [{"attribute": "type", "value": f"ca.qc.hydro.iot.rci.type_{i}"}],
+            "table": f"rci_type_{i}",
+            "action": "insert"
+        })
+
+    # A few multi-attribute routes (linear fallback)
+    for i in range(5):
+        routes.insert(i * 20, {
+            "name": f"source_{i}",
+            "filters": [
+                {"attribute": "type", "value": f"ca.qc.hydro.iot.rci.type_{i * 20}"},
+                {"attribute": "source", "value": f"device_{i}"}
+            ],
+            "table": f"rci_source_{i}",
+            "action": "insert"
+        })
+
+    return routes
+
+# -----------------------------------------------------------------------------
+#
+def make_events(route_count, event_count):
+    events = []
+
+    for i in range(event_count):
+        n = random.randint(0, route_count + 10)  # some events do not match any route
+        events.append({"type": f"ca.qc.hydro.iot.rci.type_{n}", "source": f"device_{random.randint(0, 20)}"})
+
+    return events
+
+# -----------------------------------------------------------------------------
+# Previous implementation: linear scan of all routes and filters
+def linear_get_table(routes, cloud_event):
+    table = f"{DEFAULT_SCHEMA}.{DEFAULT_TABLE}"
+    action = DEFAULT_ACTION
+
+    for route in routes:
+        filters = route.get("filters")
+
+        if filters is None:
+            continue
+
+        match = True
+        for filter in filters:
+            attr = filter.get("attribute", None)
+            value = filter.get("value", None)
+
+            if attr == None or value == None or cloud_event.get(attr, None) != value:
+                match = False
+                break
+
+        if match:
+            schema = route.get("schema", DEFAULT_SCHEMA)
+            table = f"{schema}.{route.get('table', table)}"
+            action = route.get("action", action)
+            break
+
+    return table, action
+
+# -----------------------------------------------------------------------------
+#
+def bench(name, get_table, events):
+    start = time.perf_counter()
+
+    for event in events:
+        get_table(event)
+
+    elapsed = time.perf_counter() - start
+    print(f"{name:<20} {elapsed * 1e6 / len(events):8.2f} us/event")
+
+    return elapsed
+
+# -----------------------------------------------------------------------------
+#
+def main():
+    route_count = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    event_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    routes = make_routes(route_count)
+    events = make_events(route_count, event_count)
+
+    index = RouteIndex(routes, DEFAULT_SCHEMA, DEFAULT_TABLE, DEFAULT_ACTION)
+    index_no_cache = RouteIndex(routes, DEFAULT_SCHEMA, DEFAULT_TABLE, DEFAULT_ACTION, cache_size=0)
+
+    for event in events:
+        if linear_get_table(routes, event) != index.get_table(event):
+            print(f"Mismatch for event {event}")
+            return 1
+
+    print(f"routes({len(routes)}) events({len(events)})")
+    linear = bench("linear", lambda event: linear_get_table(routes, event), events)
+    indexed = bench("index", index_no_cache.get_table, events)
+    cached = bench("index + cache", index.get_table, events)
+    print(f"speedup index({linear / indexed:.1f}x) index + cache({linear / cached:.1f}x)")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,24 @@
+"""
+JSON helpers using orjson when it is installed (pip install orjson), otherwise the standard json module.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# -------------------------------------------------------------------------------------------------
+#
+def loads(data):
+    """
+    Parse a JSON document (str or bytes).
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# -------------------------------------------------------------------------------------------------
+#
+def backend() -> str:
+    return "orjson" if orjson is not None else "json"
@@ -0,0 +1,152 @@
+"""
+BridgeAgent: broker agent of a pipeline running in a worker process (see processors/process_pipeline.py).
+
+IoTEdgeAgent and IoTDeviceAgent allow only one client per process: a pipeline running in a worker process
+cannot open its own client. The worker uses a BridgeAgent instead, the real agent runs in the Zeppelin process
+and the messages are forwarded through multiprocessing queues:
+- received messages: real agent -> rx queue -> BridgeAgent -> pipeline queue
+- published messages: BridgeAgent -> tx queue -> real agent -> reply queue (publish result) -> BridgeAgent
+
+publish() and publish_batch() wait for the result of the real agent (up to BRIDGE_REPLY_TIMEOUT_SEC), so the
+pipeline counts the messages not published (tx_message_error) and spools them (pipeline option "spool").
+A message whose result is not returned in time is reported as not published, but it may still be published
+by the real agent (and published twice if it is spooled).
+"""
+import os
+import queue
+import time
+from threading import Thread, Lock
+
+from .communication_interface import CommunicationInterface
+from .throttle import Throttle
+from utils.logger import get_logger
+
+logger = get_logger('BridgeAgent')
+
+BRIDGE_REPLY_TIMEOUT_SEC = float(os.getenv('BRIDGE_REPLY_TIMEOUT_SEC', 10.0))
+
+# -----------------------------------------------------------------------------
+#
+class BridgeAgent(CommunicationInterface, Throttle):
+    # Bridge queues of the worker process: role ('source' or 'destination') -> (rx queue, tx queue, reply queue)
+    # Set by the worker process entry point before the pipeline is created
+    _queues = {}
+
+	# -------------------------------------------------------------------------
+	#
+    def __init__(self, config:dict = {}):
+        Throttle.__init__(self, 0, 0)
+        self._role = config.get('bridge', None)
+        self._running = False
+        self._request_id = 0
+        self._mutex = Lock()  # one request waits for its reply at a time
+
+        if self._role not in BridgeAgent._queues:
+            raise Exception(f'no bridge queues for role({self._role})')
+
+        self._rx_queue, self._tx_queue, self._reply_queue = BridgeAgent._queues[self._role]
+        logger.info(f'bridge({self._role}) created')
+
+    # -------------------------------------------------------------------------
+    #
+    @staticmethod
+    def set_queues(role, rx_queue, tx_queue, reply_queue):
+        BridgeAgent._queues[role] = (rx_queue, tx_queue, reply_queue)
+
+	# -------------------------------------------------------------------------
+	#
+    def publish(self, topic, payload, **kwargs) -> bool:
+        return self._request(('publish', topic, payload, kwargs), False)
+
+	# -------------------------------------------------------------------------
+	#
+    def publish_batch(self, messages, **kwargs) -> int:
+        return self._request(('publish_batch', messages, kwargs), 0)
+
+	# -------------------------------------------------------------------------
+	# Send the request (operation, arguments...) to the real agent and return its result,
+	# or default if the result is not returned within BRIDGE_REPLY_TIMEOUT_SEC
+    def _request(self, request, default):
+        try:
+            self._mutex.acquire()
+
+            self._request_id += 1
+            request_id = self._request_id
+            self._tx_queue.put((request[0], request_id) + request[1:])
+
+            deadline = time.monotonic() + BRIDGE_REPLY_TIMEOUT_SEC
+
+            while True:
+                # The replies of the requests that timed out are discarded
+                reply_id, result = self._reply_queue.get(timeout=max(0, deadline - time.monotonic()))
+
+                if reply_id == request_id:
+                    return result
+
+        except queue.Empty:
+            logger.error(f'bridge({self._role}) no {request[0]} result after {BRIDGE_REPLY_TIMEOUT_SEC} sec')
+            return default
+
+        except Exception as ex:
+            logger.error(ex)
+            return default
+
+        finally:
+            self._mutex.release()
+
+	# -------------------------------------------------------------------------
+	# The topics are subscribed by the real agent in the Zeppelin process
+    def start_listening(self, topic, queue) -> bool:
+        try:
+            self._running = True
+            Thread(target=self._forward, args=(queue,), daemon=True).start()
+            logger.info(f'bridge({self._role}) listening on topic({topic})')
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+	# -------------------------------------------------------------------------
+	# Forward the messages received by the real agent to the pipeline queue
+    def _forward(self, queue):
+        while self._running:
+            try:
+                msg = self._rx_queue.get()
+
+                if msg == None:
+                    break
+
+                queue.put(msg)
+
+            except Exception as ex:
+                logger.error(ex)
+
+	# -------------------------------------------------------------------------
+	#
+    def disconnect(self):
+        self._running = False
+
+	# -------------------------------------------------------------------------
+	#
+    def get_device_id(self) -> str:
+        try:
+            return os.getenv('IOTEDGE_DEVICEID', '')
+        except Exception as ex:
+            logger.error(ex)
+            return ''
+
+    # -------------------------------------------------------------------------
+    # The received messages are throttled by the real agent
+    def set_max_msg_sec(self, max_msg_sec):
+        pass
+
+    # -------------------------------------------------------------------------
+    #
+    def set_sleep_sec(self, sleep_sec):
+        pass
+
+	# -------------------------------------------------------------------------
+	#
+    def set_metrics(self, metrics):
+        pass
@@ -3,6 +3,8 @@ from .iot_edge_agent import IoTEdgeAgent
 from .iot_device_agent import IoTDeviceAgent
 from.iot_hub_agent import IoTHubAgent
 from .void_agent import VoidAgent
+from .bridge_agent import BridgeAgent
+from .throttle import THROTTLE_MAX_DEFERRED, THROTTLE_POLICY
 from utils.logger import get_logger
 
 logger = get_logger('CommunicationFactory')
@@ -14,7 +16,7 @@ class CommunicationFactory:
     """
     Factory class to create communication agents based on the provided configuration.
     The factory method `get_client` takes a configuration dictionary and returns an instance of the appropriate communication agent class.
-    The supported classes are IoTEdgeAgent, IoTDeviceAgent, IoTHubAgent, MqttAgent, and VoidAgent.
+    The supported classes are IoTEdgeAgent, IoTDeviceAgent, IoTHubAgent, MqttAgent, VoidAgent and BridgeAgent.
     The configuration dictionary must contain a 'class' key that specifies the desired agent class.
     Class keys are:
         - IoTEdge
@@ -22,6 +24,7 @@ class CommunicationFactory:
         - IoTHub
         - MQTT
         - Void
+        - Bridge (set by ProcessPipeline in a worker process, see bridge_agent.py)
     """
 
     # -------------------------------------------------------------------------------------------------
@@ -73,12 +76,17 @@ class CommunicationFactory:
             elif d_class == 'VOID':
                 agent = VoidAgent()
 
+            elif d_class == 'BRIDGE':
+                agent = BridgeAgent(config)
+
             else:
                 logger.error(f"Insupported destination class({dest_class})")
 
             if agent != None:
                 agent.set_max_msg_sec(config.get('throttle_max_message_sec', 10))
                 agent.set_sleep_sec(config.get('throttle_sleep_sec', 1.0))
+                agent.set_burst(config.get('throttle_burst', config.get('throttle_max_message_sec', 10)))
+                agent.set_policy(config.get('throttle_policy', THROTTLE_POLICY), config.get('throttle_max_deferred', THROTTLE_MAX_DEFERRED))
 
             return agent
 
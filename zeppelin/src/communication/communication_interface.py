@@ -18,6 +18,21 @@ class CommunicationInterface(ABC):
     def publish(self, topic, payload) -> bool:
         pass
 
+    # -------------------------------------------------------------------------
+    # messages = list of (topic, payload)
+    # Return the number of messages published: the batch stops at the first message not published,
+    # so the messages[count:] can be retried (see Spool)
+    # Override this method to amortize locking, serialization and logging over the batch
+    def publish_batch(self, messages, **kwargs) -> int:
+        count = 0
+
+        for topic, payload in messages:
+            if not self.publish(topic, payload, **kwargs):
+                break
+            count += 1
+
+        return count
+
     # -------------------------------------------------------------------------
     # Set topic to None if you need to listen on all topics
     @abstractmethod
@@ -33,10 +33,12 @@ from threading import Lock
 from azure.iot.device import IoTHubDeviceClient, Message
 from .communication_interface import CommunicationInterface, ConnectionException
 from .throttle import Throttle
-from utils.logger import get_logger
+from .topic_router import TopicRouter
+from utils.logger import get_logger, LogSampler
 from metrics import Metrics
 
 logger = get_logger('IoTDeviceAgent')
+payload_sampler = LogSampler()
 
 AZIOT_CONFIG_PATH = os.getenv('AZIOT_CONFIG_PATH', '/aziot_config.toml')
 DEFAULT_SOURCE_TOPIC = 'none'
@@ -49,9 +51,11 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
     # Static variables
     _client = None
     _connected = False
-    # Mapping for topic/queue (hash)
-    _topics = {}
+    # Mapping for topic filter/queue (trie, MQTT wildcards)
+    _topics = TopicRouter()
     _mutex = Lock()
+    # Agents sharing the client: the client is disconnected with the last agent
+    _agents = []
     _connection_string = None
 
 	# -------------------------------------------------------------------------
@@ -59,6 +63,7 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
     def __init__(self):
         Throttle.__init__(self, 10, 1)
         self._metrics = None
+        self._listen_queue = None
 
         retry = 0
         connected = self._connect()
@@ -72,11 +77,33 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
         if not connected:
             raise ConnectionException('Cannot connect to IoT Hub!')
 
+        try:
+            IoTDeviceAgent._mutex.acquire()
+            IoTDeviceAgent._agents.append(self)
+        finally:
+            IoTDeviceAgent._mutex.release()
+
     # -------------------------------------------------------------------------
     #
     def disconnect(self):
         try:
             IoTDeviceAgent._mutex.acquire()
+
+            if self in IoTDeviceAgent._agents:
+                IoTDeviceAgent._agents.remove(self)
+
+            if self._listen_queue != None:
+                IoTDeviceAgent._topics.remove_target(self._listen_queue)
+
+            if len(IoTDeviceAgent._agents) > 0:
+                # The client is shared with other pipelines (ex: pipeline restarted by a configuration reload)
+                listeners = [agent for agent in IoTDeviceAgent._agents if agent._listen_queue != None]
+                if len(listeners) > 0 and IoTDeviceAgent._client != None:
+                    IoTDeviceAgent._client.on_message_received = listeners[-1]._on_message
+
+                logger.info(f'client kept connected for {len(IoTDeviceAgent._agents)} agents')
+                return
+
             if IoTDeviceAgent._connected or IoTDeviceAgent._client.connected:
                 IoTDeviceAgent._connected = False
                 IoTDeviceAgent._client.disconnect()
@@ -101,7 +128,8 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
             else:
                 data = payload
 
-            logger.info("Sending message to topic(%s) data(%.150s)...", topic, data)
+            if payload_sampler.is_enabled(logger):
+                logger.info("Sending message to topic(%s) data(%.150s)...", topic, data)
 
             msg = Message(data, message_id=None, content_encoding='utf-8', content_type='application/json', output_name=topic)
 
@@ -115,6 +143,40 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
         finally:
             IoTDeviceAgent._mutex.release()
 
+	# -------------------------------------------------------------------------
+	# messages = list of (topic, payload)
+	# One lock acquisition and one log line for the whole batch
+    def publish_batch(self, messages, **kwargs) -> int:
+        count = 0
+
+        try:
+            IoTDeviceAgent._mutex.acquire()
+
+            if not IoTDeviceAgent._connected:
+                logger.warning("Not connected to Iot Edge!")
+                return 0
+
+            for topic, payload in messages:
+                if not type(payload) is str:
+                    data = json.dumps(payload, ensure_ascii=False)
+                else:
+                    data = payload
+
+                msg = Message(data, message_id=None, content_encoding='utf-8', content_type='application/json', output_name=topic)
+
+                IoTDeviceAgent._client.send_message(msg)
+                count += 1
+
+            logger.info("Sent batch of %d messages", count)
+
+            return count
+
+        except Exception as ex:
+            logger.error(ex)
+            return count
+        finally:
+            IoTDeviceAgent._mutex.release()
+
 	# -------------------------------------------------------------------------
 	#
     def start_listening(self, topic, queue) -> bool:
@@ -129,19 +191,24 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
                 topic = 'none'
 
             logger.info(f'Listening on topic {topic}')
+            self.throttle_name = f'IoTDeviceAgent({topic})'
+            self._listen_queue = queue
             self._topic = topic
             self._queue = queue
 
             if type(topic) is str:
-                IoTDeviceAgent._topics[topic] = queue
+                topics = [topic]
             elif type(topic) is list:
-                for item in topic:
-                    if type(item) is str:
-                        IoTDeviceAgent._topics[item] = queue
-                    elif type(item) is tuple:
-                        IoTDeviceAgent._topics[item[0]] = queue
+                topics = [item if type(item) is str else item[0] for item in topic if type(item) in (str, tuple)]
             elif type(topic) is tuple:
-                IoTDeviceAgent._topics[topic[0]] = queue
+                topics = [topic[0]]
+            else:
+                topics = []
+
+            # A topic filter is routed to the last queue listening on it
+            for item in topics:
+                IoTDeviceAgent._topics.remove(item)
+                IoTDeviceAgent._topics.add(item, queue)
 
             IoTDeviceAgent._client.on_message_received = self._on_message
 
@@ -240,7 +307,6 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
         try:
             IoTDeviceAgent._mutex.acquire()
 
-            queue = None
             topic = message.input_name
             props = message.custom_properties
 
@@ -251,44 +317,39 @@ class IoTDeviceAgent(CommunicationInterface, Throttle):
                 if 'src_topic' in props:
                     topic = props['src_topic']
 
-            logger.info(f'Received message from topic({topic})')
+            logger.info('Received message from topic(%s)', topic)
 
-            if IoTDeviceAgent._topics != None:
-                for key in IoTDeviceAgent._topics:
-                    if key == topic:
-                        queue = IoTDeviceAgent._topics[key]
-                        break
+            queues = IoTDeviceAgent._topics.match(topic)
 
-            if queue == None:
+            if len(queues) == 0:
                 logger.warning(f'no destination queue found. discard message topic({topic}) props({props})')
                 return
 
-            payload = message.data.decode('utf8')
+            # The raw payload (bytes) is parsed by the pipeline thread, after the size check (as MqttAgent):
+            # an oversized message is never parsed and each pipeline parses its own payload (the processors modify it)
+            received = {}
+            received['payload'] = message.data
+            received['topic'] = topic
+            received['size'] = len(message.data)
+            received['dt'] = datetime.datetime.now()
+            received['props'] = props
 
-            try:
-                json_payload = json.loads(payload)
-            except Exception as ex:
-                logger.error(ex)
-                logger.warning(f'invalid json payload({payload})')
-                json_payload = payload
+            for queue in queues:
+                msg = dict(received)
 
-            msg = {}
-            msg['payload'] = json_payload
-            msg['topic'] = topic
-            msg['size'] = len(payload)
-            msg['dt'] = datetime.datetime.now()
-            msg['props'] = props
-
-            queue.put(msg)
-
-            if self.throttle() and self._metrics != None:
-                self._metrics.inc_counter('throttle_total')
+                if self.throttle_message(queue, msg) and self._metrics != None:
+                    self._metrics.inc_counter('throttle_total')
 
         except Exception as ex:
             logger.error(ex)
         finally:
             IoTDeviceAgent._mutex.release()
 
+	# -------------------------------------------------------------------------
+	# Release the messages deferred by the throttle
+    def handle_task(self):
+        self.release_deferred()
+
 	# -------------------------------------------------------------------------
 	#
     def get_device_id(self) -> str:
@@ -26,10 +26,12 @@ from threading import Lock
 from azure.iot.device import IoTHubModuleClient, Message, MethodResponse, MethodRequest
 from .communication_interface import CommunicationInterface, ConnectionException
 from .throttle import Throttle
-from utils.logger import get_logger
+from .topic_router import TopicRouter
+from utils.logger import get_logger, LogSampler
 from metrics import Metrics
 
 logger = get_logger('IoTEdgeAgent')
+payload_sampler = LogSampler()
 
 CONNECT_MAX_RETRY = 10
 CONNECT_INTERVAL = 5.0
@@ -44,11 +46,13 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
     _connecting = False
     _enable_direct_method = False
     _method_name = None
-    # Mapping for topic/queue (hash)
-    _topics = {}
+    # Mapping for topic filter/queue (trie, MQTT wildcards)
+    _topics = TopicRouter()
     # Mapping for direct method name/queue (hash)
     _methods = {}
     _mutex = Lock()
+    # Agents sharing the client: the client is disconnected with the last agent
+    _agents = []
     _queue = None # default queue
     _topic = None
 
@@ -57,6 +61,7 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
     def __init__(self, config:dict = {}):
         Throttle.__init__(self, 10, 1)
         self._metrics = None
+        self._listen_queue = None
         self._direct_method_name = None
 
         enable_direct_method = config.get("enable_direct_method", False)
@@ -80,6 +85,12 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
         if not connected:
             raise ConnectionException('Cannot connect to IoT Edge Hub!')
 
+        try:
+            IoTEdgeAgent._mutex.acquire()
+            IoTEdgeAgent._agents.append(self)
+        finally:
+            IoTEdgeAgent._mutex.release()
+
     # -------------------------------------------------------------------------
     #
     def enable_direct_method(self, method_name):
@@ -100,6 +111,28 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
     def disconnect(self):
         try:
             IoTEdgeAgent._mutex.acquire()
+
+            if self in IoTEdgeAgent._agents:
+                IoTEdgeAgent._agents.remove(self)
+
+            if self._listen_queue != None:
+                IoTEdgeAgent._topics.remove_target(self._listen_queue)
+
+                for key in [key for key, queue in IoTEdgeAgent._methods.items() if queue is self._listen_queue]:
+                    del IoTEdgeAgent._methods[key]
+
+                if IoTEdgeAgent._queue is self._listen_queue:
+                    IoTEdgeAgent._queue = None
+
+            if len(IoTEdgeAgent._agents) > 0:
+                # The client is shared with other pipelines (ex: pipeline restarted by a configuration reload)
+                listeners = [agent for agent in IoTEdgeAgent._agents if agent._listen_queue != None]
+                if len(listeners) > 0 and IoTEdgeAgent._client != None:
+                    IoTEdgeAgent._client.on_message_received = listeners[-1]._on_message
+
+                logger.info(f'client kept connected for {len(IoTEdgeAgent._agents)} agents')
+                return
+
             if IoTEdgeAgent._connected or IoTEdgeAgent._client.connected:
                 IoTEdgeAgent._connected = False
                 IoTEdgeAgent._client.disconnect()
@@ -124,7 +157,8 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
             else:
                 data = payload
 
-            logger.info("Sending message to topic(%s) data(%.150s)...", topic, data)
+            if payload_sampler.is_enabled(logger):
+                logger.info("Sending message to topic(%s) data(%.150s)...", topic, data)
 
             msg = Message(data, message_id=None, content_encoding='utf-8', content_type='application/json', output_name=topic)
 
@@ -138,6 +172,40 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
         finally:
             IoTEdgeAgent._mutex.release()
 
+	# -------------------------------------------------------------------------
+	# messages = list of (topic, payload)
+	# One lock acquisition and one log line for the whole batch
+    def publish_batch(self, messages, **kwargs) -> int:
+        count = 0
+
+        try:
+            IoTEdgeAgent._mutex.acquire()
+
+            if not IoTEdgeAgent._connected:
+                logger.warning("Not connected to Iot Edge!")
+                return 0
+
+            for topic, payload in messages:
+                if not type(payload) is str:
+                    data = json.dumps(payload, ensure_ascii=False)
+                else:
+                    data = payload
+
+                msg = Message(data, message_id=None, content_encoding='utf-8', content_type='application/json', output_name=topic)
+
+                IoTEdgeAgent._client.send_message_to_output(message=msg, output_name=topic)
+                count += 1
+
+            logger.info("Sent batch of %d messages", count)
+
+            return count
+
+        except Exception as ex:
+            logger.error(ex)
+            return count
+        finally:
+            IoTEdgeAgent._mutex.release()
+
 	# -------------------------------------------------------------------------
 	#
     def start_listening(self, topic, queue) -> bool:
@@ -149,19 +217,24 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
                 return False
 
             logger.info(f'Listening on topic {topic}')
+            self.throttle_name = f'IoTEdgeAgent({topic})'
+            self._listen_queue = queue
             IoTEdgeAgent._topic = topic
             IoTEdgeAgent._queue = queue
 
             if type(topic) is str:
-                IoTEdgeAgent._topics[topic] = queue
+                topics = [topic]
             elif type(topic) is list:
-                for item in topic:
-                    if type(item) is str:
-                        IoTEdgeAgent._topics[item] = queue
-                    elif type(item) is tuple:
-                        IoTEdgeAgent._topics[item[0]] = queue
+                topics = [item if type(item) is str else item[0] for item in topic if type(item) in (str, tuple)]
             elif type(topic) is tuple:
-                IoTEdgeAgent._topics[topic[0]] = queue
+                topics = [topic[0]]
+            else:
+                topics = []
+
+            # A topic filter is routed to the last queue listening on it
+            for item in topics:
+                IoTEdgeAgent._topics.remove(item)
+                IoTEdgeAgent._topics.add(item, queue)
 
             IoTEdgeAgent._client.on_message_received = self._on_message
 
@@ -307,38 +380,39 @@ class IoTEdgeAgent(CommunicationInterface, Throttle):
         try:
             IoTEdgeAgent._mutex.acquire()
 
-            queue = None
             topic = message.input_name
-            logger.info(f'Received message from topic({topic})')
+            logger.info('Received message from topic(%s)', topic)
 
-            if IoTEdgeAgent._topics != None:
-                for key in IoTEdgeAgent._topics:
-                    if key == topic:
-                        queue = IoTEdgeAgent._topics[key]
-                        break
+            queues = IoTEdgeAgent._topics.match(topic)
 
-            if queue == None:
+            if len(queues) == 0:
                 logger.warning(f'discard message from topic({topic})')
                 return
 
-            payload = message.data.decode('utf8')
-
-            msg = {}
-            msg['payload'] = json.loads(payload)
-            msg['topic'] = topic
-            msg['size'] = len(payload)
-            msg['dt'] = datetime.datetime.now()
+            # The raw payload (bytes) is parsed by the pipeline thread, after the size check (as MqttAgent):
+            # an oversized message is never parsed and each pipeline parses its own payload
+            received = {}
+            received['payload'] = message.data
+            received['topic'] = topic
+            received['size'] = len(message.data)
+            received['dt'] = datetime.datetime.now()
 
-            queue.put(msg)
+            for queue in queues:
+                msg = dict(received)
 
-            if self.throttle() and self._metrics != None:
-                self._metrics.inc_counter('throttle_total')
+                if self.throttle_message(queue, msg) and self._metrics != None:
+                    self._metrics.inc_counter('throttle_total')
 
         except Exception as ex:
             logger.error(ex)
         finally:
             IoTEdgeAgent._mutex.release()
 
+	# -------------------------------------------------------------------------
+	# Release the messages deferred by the throttle
+    def handle_task(self):
+        self.release_deferred()
+
 	# -------------------------------------------------------------------------
 	#
     def get_device_id(self) -> str:
@@ -38,26 +38,51 @@ Vous pouvez aussi ajouter le certificat du client dans le fichier de configurati
     "keepalive": 60,
     "qos": 1
 }
+
+Publication asynchrone (async_publish), pour QoS 1 et 2:
+"mqtt": {
+    "host": "127.0.0.1",
+    "port": 1883,
+    "id": "zeppelin_gen_dst",
+    "qos": 1,
+    "async_publish": true,
+    "max_inflight": 20,
+    "max_queued": 1000
+}
+publish() retourne dès que le message est confié à paho-mqtt, sans verrou global: au plus max_inflight messages
+sont en vol (non acquittés par le broker, PUBACK/PUBCOMP) et au plus max_queued messages attendent dans paho-mqtt
+(publish() retourne alors False). Les messages sont suivis jusqu'à l'acquittement (on_publish) et les messages non
+acquittés sont publiés de nouveau après une reconnexion.
+
+Connexion partagée (client_id_policy "shared"): les pipelines dont la configuration MQTT est identique (host, port,
+username, password, certificats, keepalive, async_publish) utilisent une seule connexion au broker (un seul client
+et un seul thread paho-mqtt), avec le client id shared_id (ou le id du premier pipeline):
+"mqtt": {
+    "host": "127.0.0.1",
+    "port": 1883,
+    "id": "zeppelin_gen_src",
+    "client_id_policy": "shared",
+    "shared_id": "zeppelin"
+}
+Les messages reçus sont distribués selon leur topic à la queue de chaque pipeline abonné. Avec client_id_policy
+"unique" (défaut), chaque pipeline a sa propre connexion.
 """
 
 import os
-import time
 import ssl
-from threading import Thread, Lock
 import datetime
 import json
-import paho.mqtt.client as mqtt
-from paho.mqtt.client import MQTTMessageInfo
 
-from .communication_interface import CommunicationInterface, ConnectionException
+from .communication_interface import CommunicationInterface
+from .mqtt_connection import MqttConnection
 from .throttle import Throttle
-from utils.logger import get_logger
+from utils.logger import get_logger, LogSampler
 from metrics import Metrics
 
 logger = get_logger("MqttAgent")
+payload_sampler = LogSampler()
 
-CONNECT_MAX_RETRY = 10
-CONNECT_INTERVAL = 5.0
+CLIENT_ID_POLICIES = ("unique", "shared")
 
 
 # -----------------------------------------------------------------------------
@@ -82,132 +107,71 @@ class MqttAgent(CommunicationInterface, Throttle):
         cert_reqs=ssl.CERT_NONE,
         ciphers=None,
         insecure=True,
+        async_publish=False,
+        max_inflight=20,
+        max_queued=1000,
+        client_id_policy="unique",
+        shared_id=None,
     ):
         Throttle.__init__(self, 10, 1)
         # initialize agent variables
-        self.mutex = Lock()
         self._metrics = None
-        self.client = None
         self.id = id
-        self.hostname = host
-        self.port = port
-        self.keepalive = keepalive
         self.retain = retain
         self.qos = qos
-        self.username = username
-        self.password = password
-        self.ca_certs = ca_certs
-        self.certfile = certfile
-        self.keyfile = keyfile
-        self.cert_reqs = cert_reqs
-        self.ciphers = ciphers
-        self.insecure = insecure
         self.topic = None
-        self.connected = False
-        self.subscribed = False
-
-        retry = 0
-        self.connected = self._connect()
-
-        while not self.connected and retry < CONNECT_MAX_RETRY:
-            time.sleep(CONNECT_INTERVAL)
-            retry += 1
-            logger.info(f"connect retry({retry})")
-            self.connected = self._connect()
-
-        if not self.connected:
-            raise ConnectionException("Cannot connect to MQTT Broker!")
+        self.queue = None
+        self.async_publish = async_publish
+        self.throttle_name = f"MqttAgent({self.id})"
+
+        if client_id_policy not in CLIENT_ID_POLICIES:
+            logger.error(f"id({self.id}) invalid client_id_policy({client_id_policy}), use unique")
+            client_id_policy = "unique"
+
+        settings = dict(
+            id=id,
+            host=host,
+            port=port,
+            keepalive=keepalive,
+            username=username,
+            password=password,
+            ca_certs=ca_certs,
+            certfile=certfile,
+            keyfile=keyfile,
+            cert_reqs=cert_reqs,
+            ciphers=ciphers,
+            insecure=insecure,
+            async_publish=async_publish,
+            max_inflight=max_inflight,
+            max_queued=max_queued,
+        )
+
+        key = None
+
+        if client_id_policy == "shared":
+            if shared_id != None:
+                settings["id"] = shared_id
+            # All the settings except the id of the pipeline
+            key = tuple(sorted((name, value) for name, value in settings.items() if name != "id" or shared_id != None))
+
+        # Raise ConnectionException if the broker is not reachable
+        self.connection = MqttConnection.acquire(self, key, **settings)
 
     # -------------------------------------------------------------------------
     #
-    def _connect(self) -> bool:
-        try:
-            self.mutex.acquire()
-
-            logger.info(f"id({self.id}) connecting to broker({self.hostname}:{self.port}) keepalive({self.keepalive})")
-
-            if self.client != None:
-                self.client.disconnect()
-                self.client = None
-                self.connected = False
-                time.sleep(CONNECT_INTERVAL)
-
-            self.client = mqtt.Client(client_id=self.id)
-            self.client.on_connect = self._on_connect
-            self.client.on_disconnect = self._on_disconnect
-            self.client.on_subscribe = self._on_subscribe
-            self.client.on_message = self._on_message
-
-            if self.username is not None and self.password is not None:
-                self.client.username_pw_set(self.username, self.password)
-
-            if self.ca_certs is not None:
-                self.client.tls_set(
-                    ca_certs=self.ca_certs,
-                    certfile=self.certfile,
-                    keyfile=self.keyfile,
-                    cert_reqs=self.cert_reqs,
-                    ciphers=self.ciphers,
-                    tls_version=ssl.PROTOCOL_TLSv1_2,
-                )
-                self.client.tls_insecure_set(self.insecure)
-
-            self.client.connect(self.hostname, port=self.port, keepalive=self.keepalive)
-
-            logger.info(f"id({self.id}) connected to broker({self.hostname}:{self.port}); loop_start()")
-            self.client.loop_start()
-
-            return True
-
-        except Exception as ex:
-            logger.error(ex)
-            return False
-
-        finally:
-            self.mutex.release()
+    @property
+    def connected(self) -> bool:
+        return self.connection.connected
 
     # -------------------------------------------------------------------------
-    #
-    def _reconnect(self) -> bool:
-        try:
-            logger.warning(f"id({self.id}) reconnecting to broker({self.hostname}:{self.port})")
-
-            retry = 0
-            self.connected = self._connect()
-
-            while not self.connected:
-                time.sleep(CONNECT_INTERVAL)
-                retry += 1
-                logger.info(f"connect retry({retry})")
-                self.connected = self._connect()
-
-            if self.connected:
-                if self.subscribed:
-                    self.client.subscribe(self.topic)
-                    logger.info(f"id({self.id}) Listening on topic {self.topic}")
-
-            return self.connected
-
-        except Exception as ex:
-            logger.error(ex)
-            return False
-
-    # -------------------------------------------------------------------------
-    #
+    # Release the connection, the shared connection is closed when its last agent is disconnected
     def disconnect(self):
-        self.client.disconnect()
-        self.connected = False
+        self.connection.release(self)
 
     # -------------------------------------------------------------------------
     # Set topic to None if you need to listen on all topics
     def start_listening(self, topic, queue) -> bool:
         try:
-            self.mutex.acquire()
-
-            if self.client == None:
-                logger.error("client is None")
-                return False
-
             if topic == None:
                 topic = "#"
 
@@ -228,28 +192,17 @@ class MqttAgent(CommunicationInterface, Throttle):
             logger.info(f"id({self.id}) Listening on topic {self.topic}")
 
             self.queue = queue
-            self.client.subscribe(self.topic)
-            self.subscribed = True
 
-            return True
+            return self.connection.subscribe(self)
 
         except Exception as ex:
             logger.error(ex)
             return False
 
-        finally:
-            self.mutex.release()
-
     # -------------------------------------------------------------------------
     #
     def publish(self, topic, payload, retain=None, qos=None) -> bool:
         try:
-            self.mutex.acquire()
-
-            if self.client == None or not self.connected:
-                logger.error(f"id({self.id}) not connected")
-                return False
-
             if retain == None:
                 retain = self.retain
 
@@ -261,103 +214,58 @@ class MqttAgent(CommunicationInterface, Throttle):
             else:
                 data = payload
 
-            logger.info(f"id({self.id}) Tx msg to ({topic}): %.300s...", data)
-
-            res: MQTTMessageInfo = self.client.publish(topic, data, retain=retain, qos=qos)
+            if payload_sampler.is_enabled(logger):
+                logger.info("id(%s) Tx msg to (%s): %.300s...", self.id, topic, data)
 
-            if res.is_published() or res.rc == 0:
-                logger.info(f"id({self.id}) Message({res.mid}) sent to ({topic})")
-                return True
-
-            logger.error(f"id({self.id}) Message({res.mid}) not sent to ({topic}) rc({res.rc})")
-
-            return False
+            return self.connection.publish(topic, data, retain, qos)
 
         except Exception as ex:
             logger.error(ex)
             return False
 
-        finally:
-            self.mutex.release()
-
     # -------------------------------------------------------------------------
-    #
-    def _on_connect(self, client, userdata, flags, reason_code):
+    # messages = list of (topic, payload)
+    def publish_batch(self, messages, retain=None, qos=None) -> int:
         try:
-            self.mutex.acquire()
-            logger.info(f"id({self.id}) connected; reason_code({reason_code})")
-
-            if reason_code != mqtt.CONNACK_ACCEPTED:
-                logger.error(f"id({self.id}) connection failed with reason_code({reason_code})")
-
-                self.connected = False
-
-                if reason_code == mqtt.CONNACK_REFUSED_PROTOCOL_VERSION:
-                    logger.error("Connection refused: unacceptable protocol version")
-                elif reason_code == mqtt.CONNACK_REFUSED_IDENTIFIER_REJECTED:
-                    logger.error("Connection refused: identifier rejected")
-                elif reason_code == mqtt.CONNACK_REFUSED_SERVER_UNAVAILABLE:
-                    logger.error("Connection refused: server unavailable")
-                elif reason_code == mqtt.CONNACK_REFUSED_BAD_USERNAME_PASSWORD:
-                    logger.error("Connection refused: bad username or password")
-                elif reason_code == mqtt.CONNACK_REFUSED_NOT_AUTHORIZED:
-                    logger.error("Connection refused: not authorized")
-
-                return
+            if retain == None:
+                retain = self.retain
 
-            if not self.connected:
-                self.connected = True
+            if qos == None:
+                qos = self.qos
 
-        except Exception as ex:
-            logger.error(ex)
+            batch = []
 
-        finally:
-            self.mutex.release()
+            for topic, payload in messages:
+                if not type(payload) is str:
+                    data = json.dumps(payload, ensure_ascii=False)
+                else:
+                    data = payload
 
-    # -------------------------------------------------------------------------
-    #
-    def _on_disconnect(self, client, userdata, flags, rc=0):
-        try:
-            self.mutex.acquire()
-            logger.warning(f"id({self.id}) disconnected")
+                batch.append((topic, data))
 
-            if self.connected:
-                self.connected = False
-                Thread(target=self._reconnect).start()
+            return self.connection.publish_batch(batch, retain, qos)
 
         except Exception as ex:
             logger.error(ex)
-
-        finally:
-            self.mutex.release()
+            return 0
 
     # -------------------------------------------------------------------------
-    #
-    def _on_subscribe(self, client, userdata, mid, reason_code_list):
-        try:
-            logger.info(
-                f"id({self.id}) Broker granted the following QoS({reason_code_list[0]}) for topic({self.topic})"
-            )
-
-        except Exception as ex:
-            logger.error(ex)
+    # Number of messages published and not acknowledged yet (async_publish), for all the agents of the connection
+    def get_unacked(self) -> int:
+        return self.connection.get_unacked()
 
     # -------------------------------------------------------------------------
-    #
-    def _on_message(self, client, userdata, message):
+    # Called by the connection for the messages received on a topic of the agent
+    def receive_message(self, message):
         try:
-            logger.info(f"Rx msg from topic({message.topic}): %.300s ...", message.payload.decode("utf8"))
-
-            payload = message.payload.decode("utf8")
+            # The raw payload (bytes) is parsed by the pipeline thread, after the size check
             msg = {}
             msg["topic"] = message.topic
-            msg["payload"] = json.loads(payload)
-            msg["size"] = len(payload)
+            msg["payload"] = message.payload
+            msg["size"] = len(message.payload)
             msg["dt"] = datetime.datetime.now()
 
-            self.queue.put(msg)
-
-            if self.throttle() and self._metrics != None:
+            if self.throttle_message(self.queue, msg) and self._metrics != None:
                 self._metrics.inc_counter("throttle_total")
 
         except Exception as ex:
@@ -372,6 +280,12 @@ class MqttAgent(CommunicationInterface, Throttle):
             logger.error(ex)
             return ""
 
+    # -------------------------------------------------------------------------
+    # Release the messages deferred by the throttle
+    def handle_task(self):
+        self.release_deferred()
+        self.connection.handle_task()
+
     # -------------------------------------------------------------------------
     #
     def set_max_msg_sec(self, max_msg_sec):
@@ -386,3 +300,4 @@ class MqttAgent(CommunicationInterface, Throttle):
     #
     def set_metrics(self, metrics: Metrics):
         self._metrics = metrics
+        self.connection.set_metrics(metrics)
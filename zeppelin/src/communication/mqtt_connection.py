@@ -0,0 +1,548 @@
+"""
+MqttConnection: connection to a MQTT broker (paho-mqtt client, network thread, reconnection), used by MqttAgent.
+
+With the client_id_policy "shared", the MqttAgent with the same broker settings (host, port, credentials, TLS,
+keepalive, async_publish) share one connection, registered in MqttConnection._registry:
+one TCP connection, one paho-mqtt network thread and one reconnection loop per broker.
+The received messages are dispatched to the agents by topic (TopicRouter), each agent throttles the messages
+of its pipeline queue. The connection is closed when its last agent is disconnected.
+
+With the client_id_policy "unique" (default), each MqttAgent has its own connection.
+"""
+import time
+import ssl
+from threading import Thread, Lock
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import MQTTMessageInfo
+
+from .communication_interface import ConnectionException
+from .topic_router import TopicRouter
+from utils.logger import get_logger
+
+logger = get_logger("MqttConnection")
+
+CONNECT_MAX_RETRY = 10
+CONNECT_INTERVAL = 5.0
+
+# -----------------------------------------------------------------------------
+#
+class MqttConnection:
+    # Shared connections: registry key -> MqttConnection
+    _registry = {}
+    _registry_mutex = Lock()
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(
+        self,
+        id=None,
+        host="127.0.0.1",
+        port=1883,
+        keepalive=60,
+        username=None,
+        password=None,
+        ca_certs=None,
+        certfile=None,
+        keyfile=None,
+        cert_reqs=ssl.CERT_NONE,
+        ciphers=None,
+        insecure=True,
+        async_publish=False,
+        max_inflight=20,
+        max_queued=1000,
+    ):
+        self.mutex = Lock()
+        self._metrics = None
+        self.client = None
+        self.id = id
+        self.name = f"MqttAgent({id})"
+        self.hostname = host
+        self.port = port
+        self.keepalive = keepalive
+        self.username = username
+        self.password = password
+        self.ca_certs = ca_certs
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.cert_reqs = cert_reqs
+        self.ciphers = ciphers
+        self.insecure = insecure
+        self.connected = False
+        self.async_publish = async_publish
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+        self.key = None           # registry key of a shared connection
+        self.agents = []          # MqttAgent using the connection
+        self.subscribers = []     # MqttAgent listening on topics
+        self.router = TopicRouter()  # topic filter -> MqttAgent
+        # async_publish: messages not acknowledged yet, (client, mid) -> (topic, data, retain, qos, publish time)
+        # Each paho-mqtt client numbers its messages from 1: the mids of the client of a reconnection and those
+        # of the previous client are tracked separately
+        self._inflight = {}
+        self._early_acks = set()  # (client, mid) acknowledged before publish() returned
+        self._inflight_mutex = Lock()
+        self.acked = 0
+
+        retry = 0
+        self.connected = self._connect()
+
+        while not self.connected and retry < CONNECT_MAX_RETRY:
+            time.sleep(CONNECT_INTERVAL)
+            retry += 1
+            logger.info(f"connect retry({retry})")
+            self.connected = self._connect()
+
+        if not self.connected:
+            raise ConnectionException("Cannot connect to MQTT Broker!")
+
+    # -------------------------------------------------------------------------
+    # Return the connection of an agent: the shared connection with the same settings if key is not None,
+    # otherwise a new connection. Raise ConnectionException if the broker is not reachable.
+    @staticmethod
+    def acquire(agent, key, **settings):
+        try:
+            MqttConnection._registry_mutex.acquire()
+
+            connection = MqttConnection._registry.get(key, None) if key != None else None
+
+            if connection == None:
+                connection = MqttConnection(**settings)
+
+                if key != None:
+                    connection.key = key
+                    MqttConnection._registry[key] = connection
+            else:
+                logger.info(f"id({connection.id}) shared with {len(connection.agents)} agents")
+
+            connection.agents.append(agent)
+
+            return connection
+
+        finally:
+            MqttConnection._registry_mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Remove the agent from the connection, disconnect from the broker when the last agent is released
+    def release(self, agent):
+        try:
+            MqttConnection._registry_mutex.acquire()
+
+            if agent in self.agents:
+                self.agents.remove(agent)
+
+            self.unsubscribe(agent)
+
+            if len(self.agents) > 0:
+                return
+
+            if self.key != None:
+                MqttConnection._registry.pop(self.key, None)
+
+            self.connected = False
+
+            if self.client != None:
+                self.client.disconnect()
+                self.client.loop_stop()
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            MqttConnection._registry_mutex.release()
+
+    # -------------------------------------------------------------------------
+    #
+    def _connect(self) -> bool:
+        try:
+            self.mutex.acquire()
+
+            logger.info(f"id({self.id}) connecting to broker({self.hostname}:{self.port}) keepalive({self.keepalive})")
+
+            if self.client != None:
+                self.client.disconnect()
+                self.client = None
+                self.connected = False
+                time.sleep(CONNECT_INTERVAL)
+
+            self.client = mqtt.Client(client_id=self.id)
+            self.client.on_connect = self._on_connect
+            self.client.on_disconnect = self._on_disconnect
+            self.client.on_subscribe = self._on_subscribe
+            self.client.on_message = self._on_message
+
+            if self.async_publish:
+                self.client.on_publish = self._on_publish
+                self.client.max_inflight_messages_set(self.max_inflight)
+                self.client.max_queued_messages_set(self.max_queued)
+
+            if self.username is not None and self.password is not None:
+                self.client.username_pw_set(self.username, self.password)
+
+            if self.ca_certs is not None:
+                self.client.tls_set(
+                    ca_certs=self.ca_certs,
+                    certfile=self.certfile,
+                    keyfile=self.keyfile,
+                    cert_reqs=self.cert_reqs,
+                    ciphers=self.ciphers,
+                    tls_version=ssl.PROTOCOL_TLSv1_2,
+                )
+                self.client.tls_insecure_set(self.insecure)
+
+            self.client.connect(self.hostname, port=self.port, keepalive=self.keepalive)
+
+            logger.info(f"id({self.id}) connected to broker({self.hostname}:{self.port}); loop_start()")
+            self.client.loop_start()
+
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    #
+    def _reconnect(self) -> bool:
+        try:
+            logger.warning(f"id({self.id}) reconnecting to broker({self.hostname}:{self.port})")
+
+            retry = 0
+            self.connected = self._connect()
+
+            while not self.connected:
+                time.sleep(CONNECT_INTERVAL)
+                retry += 1
+                logger.info(f"connect retry({retry})")
+                self.connected = self._connect()
+
+            if self.connected:
+                topics = self._get_topics()
+                if len(topics) > 0:
+                    self.client.subscribe(topics)
+                    logger.info(f"id({self.id}) Listening on topic {topics}")
+
+                if self.async_publish:
+                    self._requeue_inflight()
+
+            return self.connected
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+    # -------------------------------------------------------------------------
+    # Subscribe to the topics of the agent, its received messages are dispatched to agent.receive_message()
+    def subscribe(self, agent) -> bool:
+        try:
+            self.mutex.acquire()
+
+            if self.client == None:
+                logger.error("client is None")
+                return False
+
+            if agent not in self.subscribers:
+                self.subscribers.append(agent)
+
+            self.router.remove_target(agent)
+            for topic, _ in agent.topic:
+                self.router.add(topic, agent)
+
+            self.client.subscribe(agent.topic)
+
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Unsubscribe from the topics of the agent that no other agent listens on
+    def unsubscribe(self, agent) -> None:
+        try:
+            self.mutex.acquire()
+
+            if agent not in self.subscribers:
+                return
+
+            self.subscribers.remove(agent)
+            self.router.remove_target(agent)
+
+            used = set(self.router.get_filters())
+            topics = [topic for topic, _ in agent.topic if topic not in used]
+
+            if len(topics) > 0 and self.client != None and self.connected:
+                self.client.unsubscribe(topics)
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Topics of all the subscribers: list of (topic, qos), with the highest qos for a topic
+    def _get_topics(self) -> list:
+        topics = {}
+
+        for agent in self.subscribers:
+            for topic, qos in agent.topic:
+                topics[topic] = max(qos, topics.get(topic, 0))
+
+        return list(topics.items())
+
+    # -------------------------------------------------------------------------
+    #
+    def publish(self, topic, data, retain, qos) -> bool:
+        if self.async_publish:
+            return self._publish_async(topic, data, retain, qos)
+
+        try:
+            self.mutex.acquire()
+
+            if self.client == None or not self.connected:
+                logger.error(f"id({self.id}) not connected")
+                return False
+
+            res: MQTTMessageInfo = self.client.publish(topic, data, retain=retain, qos=qos)
+
+            if res.is_published() or res.rc == 0:
+                logger.info("id(%s) Message(%s) sent to (%s)", self.id, res.mid, topic)
+                return True
+
+            logger.error(f"id({self.id}) Message({res.mid}) not sent to ({topic}) rc({res.rc})")
+
+            return False
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    # messages = list of (topic, data)
+    # One lock acquisition and one log line for the whole batch
+    def publish_batch(self, messages, retain, qos) -> int:
+        if self.async_publish:
+            count = 0
+
+            for topic, data in messages:
+                if not self._publish_async(topic, data, retain, qos):
+                    break
+                count += 1
+
+            return count
+
+        try:
+            self.mutex.acquire()
+
+            if self.client == None or not self.connected:
+                logger.error(f"id({self.id}) not connected")
+                return 0
+
+            count = 0
+
+            for topic, data in messages:
+                res: MQTTMessageInfo = self.client.publish(topic, data, retain=retain, qos=qos)
+
+                if res.is_published() or res.rc == 0:
+                    count += 1
+                else:
+                    # The next messages are not published to keep the order
+                    logger.error(f"id({self.id}) Message({res.mid}) not sent to ({topic}) rc({res.rc})")
+                    break
+
+            logger.info(f"id({self.id}) Tx batch of {count}/{len(messages)} messages")
+
+            return count
+
+        except Exception as ex:
+            logger.error(ex)
+            return 0
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    # async_publish: hand the message to paho-mqtt and return without waiting for the network.
+    # The message is tracked until it is acknowledged (_on_publish)
+    def _publish_async(self, topic, data, retain, qos) -> bool:
+        try:
+            client = self.client
+
+            if client == None or not self.connected:
+                logger.error(f"id({self.id}) not connected")
+                return False
+
+            return self._send(client, topic, data, retain, qos, time.monotonic())
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+    # -------------------------------------------------------------------------
+    # _inflight_mutex must not be acquired: paho-mqtt calls _on_publish with its own lock acquired
+    def _send(self, client, topic, data, retain, qos, publish_time) -> bool:
+        res: MQTTMessageInfo = client.publish(topic, data, retain=retain, qos=qos)
+
+        # MQTT_ERR_NO_CONN: the message is tracked and published again after the reconnection
+        # MQTT_ERR_QUEUE_SIZE: more than max_queued messages wait in paho-mqtt
+        if res.rc != mqtt.MQTT_ERR_SUCCESS and res.rc != mqtt.MQTT_ERR_NO_CONN:
+            logger.error(f"id({self.id}) Message({res.mid}) not sent to ({topic}) rc({res.rc})")
+            return False
+
+        key = (client, res.mid)
+
+        with self._inflight_mutex:
+            if key in self._early_acks:
+                self._early_acks.discard(key)
+                self._acknowledge(publish_time)
+            else:
+                self._inflight[key] = (topic, data, retain, qos, publish_time)
+
+        return True
+
+    # -------------------------------------------------------------------------
+    # Called by paho-mqtt when the message is sent (QoS 0) or acknowledged by the broker (QoS 1 and 2)
+    def _on_publish(self, client, userdata, mid):
+        try:
+            key = (client, mid)
+
+            with self._inflight_mutex:
+                message = self._inflight.pop(key, None)
+
+                if message == None:
+                    self._early_acks.add(key)
+                    return
+
+                self._acknowledge(message[4])
+
+        except Exception as ex:
+            logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # _inflight_mutex must be acquired
+    def _acknowledge(self, publish_time):
+        self.acked += 1
+
+        if self._metrics != None:
+            self._metrics.mqtt_publish_acked_total.labels(self.name).inc()
+            self._metrics.mqtt_ack_latency.labels(self.name).observe(time.monotonic() - publish_time)
+
+    # -------------------------------------------------------------------------
+    # The messages not acknowledged by the previous clients are published again by the new client, in order.
+    # The messages already published by the new client are not affected.
+    def _requeue_inflight(self):
+        try:
+            client = self.client
+
+            with self._inflight_mutex:
+                messages = [message for key, message in self._inflight.items() if key[0] is not client]
+                self._inflight = {key: message for key, message in self._inflight.items() if key[0] is client}
+                self._early_acks = {key for key in self._early_acks if key[0] is client}
+
+            if len(messages) == 0:
+                return
+
+            logger.warning(f"id({self.id}) {len(messages)} messages not acknowledged, published again")
+
+            for topic, data, retain, qos, publish_time in sorted(messages, key=lambda message: message[4]):
+                self._send(client, topic, data, retain, qos, publish_time)
+
+        except Exception as ex:
+            logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # Number of messages published and not acknowledged yet (async_publish)
+    def get_unacked(self) -> int:
+        return len(self._inflight)
+
+    # -------------------------------------------------------------------------
+    #
+    def handle_task(self):
+        if self.async_publish and self._metrics != None:
+            self._metrics.mqtt_publish_unacked.labels(self.name).set(len(self._inflight))
+
+    # -------------------------------------------------------------------------
+    #
+    def set_metrics(self, metrics):
+        self._metrics = metrics
+
+    # -------------------------------------------------------------------------
+    #
+    def _on_connect(self, client, userdata, flags, reason_code):
+        try:
+            self.mutex.acquire()
+            logger.info(f"id({self.id}) connected; reason_code({reason_code})")
+
+            if reason_code != mqtt.CONNACK_ACCEPTED:
+                logger.error(f"id({self.id}) connection failed with reason_code({reason_code})")
+
+                self.connected = False
+
+                if reason_code == mqtt.CONNACK_REFUSED_PROTOCOL_VERSION:
+                    logger.error("Connection refused: unacceptable protocol version")
+                elif reason_code == mqtt.CONNACK_REFUSED_IDENTIFIER_REJECTED:
+                    logger.error("Connection refused: identifier rejected")
+                elif reason_code == mqtt.CONNACK_REFUSED_SERVER_UNAVAILABLE:
+                    logger.error("Connection refused: server unavailable")
+                elif reason_code == mqtt.CONNACK_REFUSED_BAD_USERNAME_PASSWORD:
+                    logger.error("Connection refused: bad username or password")
+                elif reason_code == mqtt.CONNACK_REFUSED_NOT_AUTHORIZED:
+                    logger.error("Connection refused: not authorized")
+
+                return
+
+            if not self.connected:
+                self.connected = True
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    #
+    def _on_disconnect(self, client, userdata, flags, rc=0):
+        try:
+            self.mutex.acquire()
+            logger.warning(f"id({self.id}) disconnected")
+
+            if self.connected:
+                self.connected = False
+                Thread(target=self._reconnect).start()
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    #
+    def _on_subscribe(self, client, userdata, mid, reason_code_list):
+        try:
+            logger.info(f"id({self.id}) Broker granted the following QoS({reason_code_list}) mid({mid})")
+
+        except Exception as ex:
+            logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # Dispatch the received message to the agents listening on a matching topic
+    def _on_message(self, client, userdata, message):
+        try:
+            logger.debug("Rx msg from topic(%s) size(%d): %.300r ...", message.topic, len(message.payload), message.payload)
+
+            for agent in self.router.match(message.topic):
+                agent.receive_message(message)
+
+        except Exception as ex:
+            logger.error(ex)
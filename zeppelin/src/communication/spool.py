@@ -0,0 +1,325 @@
+"""
+Spool: disk-backed store-and-forward buffer of the messages published by a pipeline (pipeline option "spool").
+
+The messages that cannot be published (destination broker disconnected, publish error) are appended to the spool,
+and so are the next messages while the spool is not empty, to keep the order. The pipeline drains the spool
+in order, at spool_drain_msg_sec messages per second, once the destination broker accepts the messages again.
+
+The spool is a directory of append-only segment files (one JSON record per line):
+- a new segment is created when the current one reaches segment_size_bytes;
+- a segment is deleted once all its messages are published;
+- the oldest segment is deleted (its messages are lost) when the spool exceeds max_size_bytes;
+- the read position is saved in the position file, the spool is recovered when the pipeline restarts
+  (the messages published after the last saved position may be published twice).
+
+fsync policy: "always" (each append), "interval" (at most once per SPOOL_FSYNC_INTERVAL_SEC) or "never" (OS cache).
+
+The spool directory (option "directory" or SPOOL_DIR) must be set explicitly and be on a persistent volume
+(ex: /config/spool in the IoT Edge deployment): a temporary directory (tmpfs) loses the messages on a restart.
+"""
+import os
+import time
+from threading import Lock
+
+from utils import fast_json
+from utils.logger import get_logger
+
+logger = get_logger('Spool')
+
+SPOOL_DIR = os.getenv('SPOOL_DIR', '')
+SPOOL_FSYNC_POLICIES = ('always', 'interval', 'never')
+SPOOL_FSYNC_INTERVAL_SEC = float(os.getenv('SPOOL_FSYNC_INTERVAL_SEC', 1.0))
+SEGMENT_SUFFIX = '.seg'
+POSITION_FILENAME = 'position'
+
+# -----------------------------------------------------------------------------
+#
+class Spool:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self, name, directory=SPOOL_DIR, segment_size_bytes=4*1024*1024, max_size_bytes=100*1024*1024, fsync='interval'):
+        self.name = name
+        self.directory = os.path.join(directory, name) if directory else None
+        self.segment_size_bytes = max(1, int(segment_size_bytes))
+        self.max_size_bytes = max(self.segment_size_bytes, int(max_size_bytes))
+        self.fsync = fsync
+        self.depth = 0           # messages in the spool
+        self.dropped = 0         # messages lost when the spool is full
+        self._segments = []      # sequence numbers of the segment files, oldest first
+        self._sizes = {}         # sequence number -> size in bytes
+        self._writer = None      # file of the last segment
+        self._read_offset = 0    # offset in the first segment
+        self._fsync_time = 0
+        self._mutex = Lock()
+
+        if fsync not in SPOOL_FSYNC_POLICIES:
+            logger.error(f'invalid spool fsync policy({fsync}), use interval')
+            self.fsync = 'interval'
+
+    # -------------------------------------------------------------------------
+    # Create the spool directory and recover the messages of a previous run
+    def open(self) -> bool:
+        if self.directory == None:
+            logger.error(f'spool({self.name}) directory not set (option directory or SPOOL_DIR)')
+            return False
+
+        try:
+            self._mutex.acquire()
+
+            os.makedirs(self.directory, exist_ok=True)
+
+            self._segments = sorted(int(file_name[:-len(SEGMENT_SUFFIX)]) for file_name in os.listdir(self.directory) if file_name.endswith(SEGMENT_SUFFIX))
+            self._sizes = {seq: os.path.getsize(self._segment_filename(seq)) for seq in self._segments}
+            self._read_offset = 0
+
+            position = self._load_position()
+            if position != None:
+                seq, offset = position
+                # Segments fully published before the stop
+                while len(self._segments) > 0 and self._segments[0] < seq:
+                    self._remove_segment()
+                if len(self._segments) > 0 and self._segments[0] == seq:
+                    self._read_offset = offset
+
+            self.depth = sum(self._count_records(seq, self._read_offset if i == 0 else 0) for i, seq in enumerate(self._segments))
+
+            logger.info(f'spool({self.directory}) opened with {self.depth} messages in {len(self._segments)} segments, fsync({self.fsync})')
+
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    #
+    def close(self):
+        try:
+            self._mutex.acquire()
+
+            if self._writer != None:
+                self._sync(force=True)
+                self._writer.close()
+                self._writer = None
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Append messages at the end of the spool. messages = list of (topic, payload, kwargs)
+    def append(self, messages) -> bool:
+        try:
+            self._mutex.acquire()
+
+            now = time.time()
+
+            for topic, payload, kwargs in messages:
+                line = (fast_json.dumps({'ts': now, 'topic': topic, 'payload': payload, 'kwargs': kwargs}) + '\n').encode('utf8')
+
+                if self._writer == None or self._sizes[self._segments[-1]] + len(line) > self.segment_size_bytes:
+                    self._new_segment()
+
+                self._writer.write(line)
+                self._sizes[self._segments[-1]] += len(line)
+                self.depth += 1
+
+            self._writer.flush()
+            self._sync()
+
+            while sum(self._sizes.values()) > self.max_size_bytes and len(self._segments) > 1:
+                dropped = self._count_records(self._segments[0], self._read_offset)
+                self._remove_segment()
+                self.depth -= dropped
+                self.dropped += dropped
+                logger.warning(f'spool({self.name}) full ({self.max_size_bytes} bytes), oldest {dropped} messages dropped')
+
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Return up to count messages from the start of the spool: list of (topic, payload, kwargs, ts)
+    # The messages stay in the spool until commit() is called
+    def peek(self, count) -> list:
+        try:
+            self._mutex.acquire()
+
+            messages = []
+
+            for i, seq in enumerate(self._segments):
+                with open(self._segment_filename(seq), 'rb') as file:
+                    file.seek(self._read_offset if i == 0 else 0)
+
+                    for line in file:
+                        if len(messages) >= count:
+                            return messages
+
+                        if not line.endswith(b'\n'):
+                            break
+
+                        record = self._parse(line)
+                        messages.append((record['topic'], record['payload'], record['kwargs'], record['ts']) if record != None else None)
+
+                if len(messages) >= count:
+                    break
+
+            return messages
+
+        except Exception as ex:
+            logger.error(ex)
+            return []
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Remove the first count messages (published) from the spool
+    def commit(self, count) -> None:
+        try:
+            self._mutex.acquire()
+
+            while count > 0 and len(self._segments) > 0:
+                seq = self._segments[0]
+
+                with open(self._segment_filename(seq), 'rb') as file:
+                    file.seek(self._read_offset)
+
+                    while count > 0:
+                        line = file.readline()
+                        # End of the segment, or record partially written before a crash
+                        if not line.endswith(b'\n'):
+                            break
+
+                        self._read_offset += len(line)
+                        self.depth -= 1
+                        count -= 1
+
+                # The last segment is kept: it is still written
+                if len(self._segments) == 1:
+                    break
+
+                if count > 0 or self._read_offset >= self._sizes[seq]:
+                    self._remove_segment()
+
+            self._save_position()
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Age in seconds of the oldest message, 0 if the spool is empty
+    def get_age(self) -> float:
+        if self.depth <= 0:
+            return 0
+
+        messages = self.peek(1)
+
+        if len(messages) == 0 or messages[0] == None:
+            return 0
+
+        return max(0, time.time() - messages[0][3])
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired
+    def _new_segment(self):
+        if self._writer != None:
+            self._sync(force=True)
+            self._writer.close()
+
+        seq = self._segments[-1] + 1 if len(self._segments) > 0 else 0
+        self._writer = open(self._segment_filename(seq), 'ab')
+        self._segments.append(seq)
+        self._sizes[seq] = 0
+
+        if len(self._segments) == 1:
+            self._read_offset = 0
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired
+    def _remove_segment(self):
+        seq = self._segments.pop(0)
+        del self._sizes[seq]
+        self._read_offset = 0
+
+        if len(self._segments) == 0 and self._writer != None:
+            self._writer.close()
+            self._writer = None
+
+        os.remove(self._segment_filename(seq))
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired
+    def _sync(self, force=False):
+        if self._writer == None or self.fsync == 'never':
+            return
+
+        now = time.monotonic()
+
+        if force or self.fsync == 'always' or now - self._fsync_time >= SPOOL_FSYNC_INTERVAL_SEC:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+            self._fsync_time = now
+
+    # -------------------------------------------------------------------------
+    #
+    def _segment_filename(self, seq) -> str:
+        return os.path.join(self.directory, f'{seq:010d}{SEGMENT_SUFFIX}')
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired. Number of complete records from offset.
+    def _count_records(self, seq, offset) -> int:
+        with open(self._segment_filename(seq), 'rb') as file:
+            file.seek(offset)
+            return sum(1 for line in file if line.endswith(b'\n'))
+
+    # -------------------------------------------------------------------------
+    #
+    def _parse(self, line):
+        try:
+            return fast_json.loads(line)
+
+        except Exception as ex:
+            logger.error(f'spool({self.name}) invalid record skipped: {ex}')
+            return None
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired
+    def _save_position(self):
+        file_name = os.path.join(self.directory, POSITION_FILENAME)
+
+        if len(self._segments) == 0:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            return
+
+        with open(file_name + '.tmp', 'w') as file:
+            file.write(f'{self._segments[0]} {self._read_offset}')
+
+        os.replace(file_name + '.tmp', file_name)
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired. Return (seq, offset) or None
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.directory, POSITION_FILENAME)) as file:
+                seq, offset = file.read().split()
+
+            return int(seq), int(offset)
+
+        except FileNotFoundError:
+            return None
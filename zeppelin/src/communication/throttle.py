@@ -1,9 +1,31 @@
+"""
+Throttle: token bucket rate limiter for the messages received from a broker.
+
+The bucket holds up to burst tokens and is refilled at max_msg_sec tokens per second.
+A received message consumes one token and is put in the pipeline queue. Without token, the message
+is handled according to the policy (it never sleeps: the callbacks run in the broker network thread):
+- spill: (default) the message is kept in memory (max_deferred messages) and released in order when tokens are
+         available, by the next received message or by handle_task(). The messages are written to a spill file
+         (THROTTLE_SPILL_DIR) when the deferred queue is full: no message is lost;
+- defer: like spill, but the message is dropped when the deferred queue is full;
+- drop:  the message is dropped.
+"""
+import os
+import json
 import time
+import datetime
+import tempfile
+import collections
 from threading import Lock
 from utils.logger import get_logger
 
 logger = get_logger('Throttle')
 
+THROTTLE_POLICIES = ('defer', 'drop', 'spill')
+THROTTLE_POLICY = os.getenv('THROTTLE_POLICY', 'spill')
+THROTTLE_MAX_DEFERRED = int(os.getenv('THROTTLE_MAX_DEFERRED', 1000))
+THROTTLE_SPILL_DIR = os.getenv('THROTTLE_SPILL_DIR', tempfile.gettempdir())
+
 # -----------------------------------------------------------------------------
 #
 class Throttle:
@@ -11,9 +33,21 @@ class Throttle:
 	#
     def __init__(self, max_msg_sec = 10, sleep_sec = 1.0) -> None:
         self.max_msg_sec = max_msg_sec
-        self.sleep_sec = sleep_sec
-        self._counter = 0
-        self._last_time = int(time.time())
+        self.sleep_sec = sleep_sec  # Not used: the throttle does not sleep anymore
+        self.burst = max_msg_sec
+        self.policy = THROTTLE_POLICY
+        self.max_deferred = THROTTLE_MAX_DEFERRED
+        self.throttle_name = self.__class__.__name__
+        self._metrics = None
+        self._tokens = float(self.burst)
+        self._last_time = time.monotonic()
+        self._deferred = collections.deque()  # (queue, message)
+        self._spill_queues = []  # queues of the spilled messages (index stored in the spill file)
+        self._spill_filename = os.path.join(THROTTLE_SPILL_DIR, f'zeppelin_throttle_{os.getpid()}_{id(self)}.jsonl')
+        self._spill_offset = 0
+        self._spilled = 0
+        self._dropped = 0
+        self._drop_log_time = 0
         self._mutex = Lock()
 
     # -------------------------------------------------------------------------
@@ -21,7 +55,11 @@ class Throttle:
         try:
             logger.info(f'Set max_msg_sec({max_msg_sec})')
             self._mutex.acquire()
+            # The burst follows the rate unless it was set explicitly
+            if self.burst == self.max_msg_sec:
+                self.burst = max_msg_sec
             self.max_msg_sec = max_msg_sec
+            self._tokens = min(self._tokens, float(self.burst))
 
         finally:
             self._mutex.release()
@@ -29,7 +67,7 @@ class Throttle:
     # -------------------------------------------------------------------------
     def set_sleep_sec(self, sleep_sec):
         try:
-            logger.info(f'Set sleep_sec({sleep_sec})')
+            logger.info(f'Set sleep_sec({sleep_sec}) (not used by the token bucket)')
             self._mutex.acquire()
             self.sleep_sec = sleep_sec
 
@@ -37,24 +75,72 @@ class Throttle:
             self._mutex.release()
 
     # -------------------------------------------------------------------------
-    def throttle(self) -> bool:
+    def set_burst(self, burst):
+        try:
+            logger.info(f'Set burst({burst})')
+            self._mutex.acquire()
+            self.burst = max(1, burst)
+            self._tokens = min(self._tokens, float(self.burst))
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    def set_policy(self, policy = THROTTLE_POLICY, max_deferred = THROTTLE_MAX_DEFERRED):
         try:
             self._mutex.acquire()
 
-            now = int(time.time())
+            if policy not in THROTTLE_POLICIES:
+                logger.error(f'invalid throttle policy({policy}), use spill')
+                policy = 'spill'
 
-            if now != self._last_time:
-                self._counter = 1
-                self._last_time = now
+            self.policy = policy
+            self.max_deferred = max(0, int(max_deferred))
+
+            logger.info(f'Throttle max_msg_sec({self.max_msg_sec}) burst({self.burst}) policy({self.policy}) max_deferred({self.max_deferred})' +
+                        (f' spill_dir({THROTTLE_SPILL_DIR})' if policy == 'spill' else ''))
+
+            # The messages are not lost with spill only
+            if self.max_msg_sec > 0 and policy != 'spill':
+                limit = '' if policy == 'drop' else f' once {self.max_deferred} messages are deferred'
+                logger.warning(f'Throttle policy({policy}): the messages received above {self.max_msg_sec} msg/sec are dropped{limit}')
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Put the message in the queue if a token is available, otherwise defer, drop or spill it.
+    # Return True if the message was throttled (not queued immediately).
+    def throttle_message(self, queue, msg) -> bool:
+        try:
+            self._mutex.acquire()
+
+            if self.max_msg_sec <= 0:
+                queue.put(msg)
                 return False
 
-            self._counter += 1
+            self._release()
 
-            if self._counter < self.max_msg_sec:
+            # The deferred messages are released first to keep the order
+            if len(self._deferred) == 0 and self._spilled == 0 and self._tokens >= 1:
+                self._tokens -= 1
+                queue.put(msg)
                 return False
 
-            logger.warning(f'Throttle: Sleeping for {self.sleep_sec} seconds. counter({self._counter}) max_msg_sec({self.max_msg_sec})')
-            time.sleep(self.sleep_sec)
+            if self.policy != 'drop' and self._spilled == 0 and len(self._deferred) < self.max_deferred:
+                self._deferred.append((queue, msg))
+                self._inc_counter('throttle_deferred_total')
+            elif self.policy == 'spill' and self._spill(queue, msg):
+                self._inc_counter('throttle_spilled_total')
+            else:
+                self._dropped += 1
+                self._inc_counter('throttle_dropped_total')
+
+                # At most one log line per second
+                if time.monotonic() - self._drop_log_time >= 1.0:
+                    logger.warning(f'Throttle: {self._dropped} messages dropped, last from topic({msg.get("topic")}) max_msg_sec({self.max_msg_sec}) burst({self.burst}) policy({self.policy})')
+                    self._drop_log_time = time.monotonic()
+                    self._dropped = 0
 
             return True
 
@@ -64,3 +150,108 @@ class Throttle:
 
         finally:
             self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Number of messages deferred or spilled, waiting for release_deferred()
+    def get_pending(self) -> int:
+        return len(self._deferred) + self._spilled
+
+    # -------------------------------------------------------------------------
+    # Release the deferred messages for which tokens are available. Called by handle_task().
+    def release_deferred(self) -> None:
+        try:
+            self._mutex.acquire()
+
+            self._release()
+
+            if self._metrics != None:
+                self._metrics.throttle_tokens.labels(self.throttle_name).set(self._tokens)
+                self._metrics.throttle_pending.labels(self.throttle_name).set(len(self._deferred) + self._spilled)
+
+        except Exception as ex:
+            logger.error(ex)
+
+        finally:
+            self._mutex.release()
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired
+    def _release(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._last_time) * self.max_msg_sec)
+        self._last_time = now
+
+        while self._tokens >= 1:
+            if len(self._deferred) == 0 and self._spilled > 0:
+                self._unspill()
+
+            if len(self._deferred) == 0:
+                break
+
+            queue, msg = self._deferred.popleft()
+            queue.put(msg)
+            self._tokens -= 1
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired
+    def _spill(self, queue, msg) -> bool:
+        try:
+            if queue not in self._spill_queues:
+                self._spill_queues.append(queue)
+
+            record = dict(msg)
+            record['dt'] = msg['dt'].isoformat()
+            record['_queue'] = self._spill_queues.index(queue)
+
+            if type(msg['payload']) is bytes:
+                record['payload'] = msg['payload'].decode('utf8')
+                record['_bytes'] = True
+
+            with open(self._spill_filename, 'a', encoding='utf8') as file:
+                file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+            self._spilled += 1
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired. Read back up to max_deferred spilled messages in the deferred queue.
+    def _unspill(self) -> None:
+        try:
+            with open(self._spill_filename, 'r', encoding='utf8') as file:
+                file.seek(self._spill_offset)
+
+                while self._spilled > 0 and len(self._deferred) < max(1, self.max_deferred):
+                    line = file.readline()
+                    if not line:
+                        break
+
+                    record = json.loads(line)
+                    queue = self._spill_queues[record.pop('_queue')]
+                    record['dt'] = datetime.datetime.fromisoformat(record['dt'])
+
+                    if record.pop('_bytes', False):
+                        record['payload'] = record['payload'].encode('utf8')
+
+                    self._deferred.append((queue, record))
+                    self._spilled -= 1
+
+                self._spill_offset = file.tell()
+
+            if self._spilled == 0:
+                os.remove(self._spill_filename)
+                self._spill_offset = 0
+
+        except Exception as ex:
+            logger.error(ex)
+            self._spilled = 0
+            self._spill_offset = 0
+
+    # -------------------------------------------------------------------------
+    #
+    def _inc_counter(self, name) -> None:
+        if self._metrics != None:
+            self._metrics.inc_counter(name)
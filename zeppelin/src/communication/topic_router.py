@@ -0,0 +1,164 @@
+"""
+TopicRouter: route the received topics to the targets (ex: pipeline queues, agents) subscribed with MQTT topic filters.
+
+The topic filters are stored in a trie of topic levels, with the MQTT wildcards:
+- '+' matches one level: 'sensors/+/temp' matches 'sensors/s1/temp';
+- '#' matches the parent level and all the sub-levels: 'sensors/#' matches 'sensors', 'sensors/s1/temp'.
+The topics starting with '$' (ex: '$SYS/broker') are not matched by a wildcard at the first level.
+
+match() visits at most 3 children per level (the level, '+' and '#'): its cost depends on the depth of the topic
+instead of the number of subscriptions. A target is returned once, even if several of its filters match the topic.
+"""
+from threading import Lock
+
+# -----------------------------------------------------------------------------
+#
+class _Node:
+    __slots__ = ('children', 'targets')
+
+    def __init__(self):
+        self.children = {}  # topic level -> _Node
+        self.targets = []   # targets of the filter ending at this node
+
+# -----------------------------------------------------------------------------
+#
+class TopicRouter:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self):
+        self._root = _Node()
+        self._filters = {}  # topic filter -> number of targets
+        self._mutex = Lock()
+
+    # -------------------------------------------------------------------------
+    # Route the topics matching topic_filter to target
+    def add(self, topic_filter, target) -> None:
+        with self._mutex:
+            node = self._root
+
+            for level in topic_filter.split('/'):
+                child = node.children.get(level, None)
+
+                if child == None:
+                    child = _Node()
+                    node.children[level] = child
+
+                node = child
+
+            if not any(item is target for item in node.targets):
+                node.targets.append(target)
+                self._filters[topic_filter] = self._filters.get(topic_filter, 0) + 1
+
+    # -------------------------------------------------------------------------
+    # Remove the route from topic_filter to target, or to all its targets if target is None
+    def remove(self, topic_filter, target=None) -> None:
+        with self._mutex:
+            levels = topic_filter.split('/')
+            path = [self._root]
+
+            for level in levels:
+                node = path[-1].children.get(level, None)
+
+                if node == None:
+                    return
+
+                path.append(node)
+
+            node = path[-1]
+            targets = [item for item in node.targets if target != None and item is not target]
+            removed = len(node.targets) - len(targets)
+            node.targets = targets
+
+            if removed == 0:
+                return
+
+            if len(targets) == 0:
+                del self._filters[topic_filter]
+            else:
+                self._filters[topic_filter] = len(targets)
+
+            # Remove the empty nodes
+            for i in range(len(levels), 0, -1):
+                node = path[i]
+
+                if len(node.targets) > 0 or len(node.children) > 0:
+                    break
+
+                del path[i - 1].children[levels[i - 1]]
+
+    # -------------------------------------------------------------------------
+    # Remove all the routes to target. Return the topic filters removed.
+    def remove_target(self, target) -> list:
+        topic_filters = [topic_filter for topic_filter in self.get_filters() if any(item is target for item in self._get_targets(topic_filter))]
+
+        for topic_filter in topic_filters:
+            self.remove(topic_filter, target)
+
+        return topic_filters
+
+    # -------------------------------------------------------------------------
+    # Return the targets of the filters matching topic, in the order they were added per filter
+    def match(self, topic) -> list:
+        with self._mutex:
+            targets = []
+            levels = topic.split('/')
+            # The wildcards do not match the topics starting with '$'
+            wildcards = not topic.startswith('$')
+            self._match(self._root, levels, 0, wildcards, targets)
+
+            if len(targets) > 1:
+                unique = {}
+                for target in targets:
+                    unique.setdefault(id(target), target)
+                targets = list(unique.values())
+
+            return targets
+
+    # -------------------------------------------------------------------------
+    # Mutex must be acquired
+    def _match(self, node, levels, index, wildcards, targets):
+        children = node.children
+
+        if wildcards:
+            child = children.get('#', None)
+            if child != None:
+                targets.extend(child.targets)
+
+        if index == len(levels):
+            targets.extend(node.targets)
+            return
+
+        child = children.get(levels[index], None)
+        if child != None:
+            self._match(child, levels, index + 1, True, targets)
+
+        if wildcards:
+            child = children.get('+', None)
+            if child != None:
+                self._match(child, levels, index + 1, True, targets)
+
+    # -------------------------------------------------------------------------
+    #
+    def _get_targets(self, topic_filter) -> list:
+        with self._mutex:
+            node = self._root
+
+            for level in topic_filter.split('/'):
+                node = node.children.get(level, None)
+
+                if node == None:
+                    return []
+
+            return list(node.targets)
+
+    # -------------------------------------------------------------------------
+    # Topic filters with at least one target
+    def get_filters(self) -> list:
+        with self._mutex:
+            return list(self._filters)
+
+    # -------------------------------------------------------------------------
+    #
+    def __len__(self) -> int:
+        return len(self._filters)
@@ -12,6 +12,11 @@ class VoidAgent(CommunicationInterface, Throttle):
     def publish(self, topic, payload) -> bool:
         return True
 
+    # -------------------------------------------------------------------------
+    #
+    def publish_batch(self, messages, **kwargs) -> int:
+        return len(messages)
+
     # -------------------------------------------------------------------------
     #
     def start_listening(self, topic, queue) -> bool :
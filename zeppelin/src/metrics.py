@@ -3,12 +3,19 @@ Expose Prometheus metrics from Zeppelin module
 '''
 
 from threading import Thread, Lock
-from prometheus_client import Counter, Info
+from prometheus_client import Counter, Gauge, Histogram, Info
 
 from utils.logger import get_logger, LOGGING_LEVEL
 
 logger = get_logger('Metrics', LOGGING_LEVEL)
 
+# Latency buckets in seconds (p50/p99 are computed with histogram_quantile() in Prometheus)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Counters also labelled per pipeline (see PipelineMetrics)
+PIPELINE_COUNTERS = ('rx_message_total', 'rx_message_over_size', 'rx_message_discarded', 'rx_message_error',
+                     'rx_message_valid', 'rx_message_invalid', 'tx_message_total', 'tx_message_error')
+
 
 # -----------------------------------------------------------------------------
 # Call inc_counter() to increment the counter
@@ -30,7 +37,16 @@ class Metrics:
         self.rx_message_valid = Counter('zeppelin_rx_message_valid', 'Total received message valid from Broker')
         self.rx_message_invalid = Counter('zeppelin_rx_message_invalid', 'Total received message invalid from Broker')
         self.tx_message_total = Counter('zeppelin_tx_message_total', 'Total sent message to Broker')
+        self.tx_message_error = Counter('zeppelin_tx_message_error', 'Total message not sent to Broker')
         self.throttle_total = Counter('zeppelin_throttle_total', 'Total throttle applied to received message from Broker')
+        self.throttle_deferred_total = Counter('zeppelin_throttle_deferred_total', 'Total received message deferred by the throttle')
+        self.throttle_dropped_total = Counter('zeppelin_throttle_dropped_total', 'Total received message dropped by the throttle')
+        self.throttle_spilled_total = Counter('zeppelin_throttle_spilled_total', 'Total received message spilled to disk by the throttle')
+        self.throttle_tokens = Gauge('zeppelin_throttle_tokens', 'Tokens available in the throttle bucket', ['broker'])
+        self.throttle_pending = Gauge('zeppelin_throttle_pending', 'Received message waiting in the throttle (deferred or spilled)', ['broker'])
+        self.mqtt_publish_acked_total = Counter('zeppelin_mqtt_publish_acked_total', 'Total message acknowledged by the MQTT Broker (async_publish)', ['broker'])
+        self.mqtt_publish_unacked = Gauge('zeppelin_mqtt_publish_unacked', 'Message published and not acknowledged yet by the MQTT Broker (async_publish)', ['broker'])
+        self.mqtt_ack_latency = Histogram('zeppelin_mqtt_ack_latency_seconds', 'Latency between publication and acknowledgement by the MQTT Broker (async_publish)', ['broker'], buckets=LATENCY_BUCKETS)
         self.rx_zigbee_message_total = Counter('zeppelin_rx_zigbee_message_total', 'Total Zigbee received message from Broker')
         self.rx_egauge_message_total = Counter('zeppelin_rx_egauge_message_total', 'Total eGauge received message from Broker')
         self.rx_c2d_message_total = Counter('zeppelin_rx_c2d_message_total', 'Total Cloud to Device received message from Broker')
@@ -40,6 +56,32 @@ class Metrics:
         self.tx_cmd_message_total = Counter('zeppelin_tx_cmd_message_total', 'Total Cloud to Edge (direct method) transmitted message')
         self.rx_cmd_message_total = Counter('zeppelin_rx_cmd_message_total', 'Total Cloud to Edge (direct method) received message')
         self.rx_generic_message_total = Counter('zeppelin_rx_generic_message_total', 'Total generic received message from Broker')
+        self.publish_latency = Histogram('zeppelin_publish_latency_seconds', 'Latency between message reception (enqueue) and publication to Broker', buckets=LATENCY_BUCKETS)
+        self.process_restart_total = Counter('zeppelin_process_restart_total', 'Total restart of pipeline worker processes')
+
+        # Per pipeline metrics, updated through PipelineMetrics (metrics.pipeline(name))
+        self.pipeline_rx_message_total = Counter('zeppelin_pipeline_rx_message_total', 'Total received message from Broker per pipeline', ['pipeline'])
+        self.pipeline_rx_message_over_size = Counter('zeppelin_pipeline_rx_message_over_size', 'Total received message with payload size exceeding maximum size per pipeline', ['pipeline'])
+        self.pipeline_rx_message_discarded = Counter('zeppelin_pipeline_rx_message_discarded', 'Total received message discarded per pipeline', ['pipeline'])
+        self.pipeline_rx_message_error = Counter('zeppelin_pipeline_rx_message_error', 'Total received message with processing error per pipeline', ['pipeline'])
+        self.pipeline_rx_message_valid = Counter('zeppelin_pipeline_rx_message_valid', 'Total received message valid per pipeline', ['pipeline'])
+        self.pipeline_rx_message_invalid = Counter('zeppelin_pipeline_rx_message_invalid', 'Total received message invalid per pipeline', ['pipeline'])
+        self.pipeline_tx_message_total = Counter('zeppelin_pipeline_tx_message_total', 'Total sent message to Broker per pipeline', ['pipeline'])
+        self.pipeline_tx_message_error = Counter('zeppelin_pipeline_tx_message_error', 'Total message not sent to Broker per pipeline', ['pipeline'])
+        self.pipeline_publish_latency = Histogram('zeppelin_pipeline_publish_latency_seconds', 'Latency between message reception (enqueue) and publication to Broker per pipeline', ['pipeline'], buckets=LATENCY_BUCKETS)
+        self.pipeline_queue_wait = Histogram('zeppelin_pipeline_queue_wait_seconds', 'Time spent by a received message in the pipeline queue', ['pipeline'], buckets=LATENCY_BUCKETS)
+        self.pipeline_stage_duration = Histogram('zeppelin_pipeline_stage_duration_seconds', 'Duration of the processing stages (assess, validate, normalize)', ['pipeline', 'stage'], buckets=LATENCY_BUCKETS)
+        self.pipeline_publish_duration = Histogram('zeppelin_pipeline_publish_duration_seconds', 'Duration of the publish (or publish batch) call to the destination Broker', ['pipeline'], buckets=LATENCY_BUCKETS)
+        self.pipeline_queue_depth = Gauge('zeppelin_pipeline_queue_depth', 'Received message waiting in the pipeline queues', ['pipeline'])
+        self.spool_message_total = Counter('zeppelin_spool_message_total', 'Total message written to the pipeline spool', ['pipeline'])
+        self.spool_dropped_total = Counter('zeppelin_spool_dropped_total', 'Total spooled message dropped because the spool was full', ['pipeline'])
+        self.spool_depth = Gauge('zeppelin_spool_depth', 'Message waiting in the pipeline spool', ['pipeline'])
+        self.spool_age = Gauge('zeppelin_spool_age_seconds', 'Age of the oldest message in the pipeline spool', ['pipeline'])
+
+    # -------------------------------------------------------------------------
+    # Metrics view of a pipeline
+    def pipeline(self, name):
+        return PipelineMetrics(self, name)
 
     # -------------------------------------------------------------------------
     # May not be required since the doc of prometheus_client says it is thread safe
@@ -61,8 +103,16 @@ class Metrics:
                 self.rx_message_invalid.inc()
             elif name == 'tx_message_total':
                 self.tx_message_total.inc()
+            elif name == 'tx_message_error':
+                self.tx_message_error.inc()
             elif name == 'throttle_total':
                 self.throttle_total.inc()
+            elif name == 'throttle_deferred_total':
+                self.throttle_deferred_total.inc()
+            elif name == 'throttle_dropped_total':
+                self.throttle_dropped_total.inc()
+            elif name == 'throttle_spilled_total':
+                self.throttle_spilled_total.inc()
             elif name == 'rx_zigbee_message_total':
                 self.rx_zigbee_message_total.inc()
             elif name == 'rx_egauge_message_total':
@@ -76,3 +126,196 @@ class Metrics:
         finally:
             self.mutex.release()
 
+
+    # -------------------------------------------------------------------------
+    # Apply the metric operations of a worker process (see MetricsProxy.flush)
+    def apply(self, operations) -> None:
+        for method, name, labels, value in operations:
+            try:
+                metric = getattr(self, name)
+
+                if len(labels) > 0:
+                    metric = metric.labels(*labels)
+
+                if method == 'inc':
+                    metric.inc(value)
+                elif method == 'set':
+                    metric.set(value)
+                elif method == 'observe':
+                    for item in value:
+                        metric.observe(item)
+
+            except Exception as ex:
+                logger.error(f'metric({name}): {ex}')
+
+
+# -----------------------------------------------------------------------------
+# Metrics of a pipeline running in a worker process.
+# Same interface as Metrics (metric.inc(), .set(), .observe(), .labels(), inc_counter()) but the operations
+# are aggregated locally and sent to the Zeppelin process by flush(), where Metrics.apply() updates
+# the Prometheus metrics. Thread safe.
+class MetricsProxy:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self, queue):
+        self._queue = queue
+        self._mutex = Lock()
+        self._counters = {}      # (name, labels) -> increment
+        self._gauges = {}        # (name, labels) -> last value
+        self._observations = {}  # (name, labels) -> [values]
+
+    # -------------------------------------------------------------------------
+    # Called for the metric attributes only (ex: metrics.rx_message_total)
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        metric = _MetricProxy(self, name, ())
+        self.__dict__[name] = metric
+        return metric
+
+    # -------------------------------------------------------------------------
+    # Metrics view of a pipeline
+    def pipeline(self, name):
+        return PipelineMetrics(self, name)
+
+    # -------------------------------------------------------------------------
+    #
+    def inc_counter(self, name):
+        self._add('inc', name, (), 1)
+
+    # -------------------------------------------------------------------------
+    #
+    def _add(self, method, name, labels, value) -> None:
+        key = (name, labels)
+
+        with self._mutex:
+            if method == 'inc':
+                self._counters[key] = self._counters.get(key, 0) + value
+            elif method == 'set':
+                self._gauges[key] = value
+            elif method == 'observe':
+                self._observations.setdefault(key, []).append(value)
+
+    # -------------------------------------------------------------------------
+    # Send the aggregated operations to the Zeppelin process
+    def flush(self) -> None:
+        try:
+            with self._mutex:
+                operations = [('inc', name, labels, value) for (name, labels), value in self._counters.items()]
+                operations += [('set', name, labels, value) for (name, labels), value in self._gauges.items()]
+                operations += [('observe', name, labels, values) for (name, labels), values in self._observations.items()]
+                self._counters = {}
+                self._gauges = {}
+                self._observations = {}
+
+            if len(operations) > 0:
+                self._queue.put(operations)
+
+        except Exception as ex:
+            logger.error(ex)
+
+
+# -----------------------------------------------------------------------------
+# Metrics of a pipeline, returned by Metrics.pipeline(name) or MetricsProxy.pipeline(name).
+# The counters of PIPELINE_COUNTERS and publish_latency update the global metric and the metric labelled
+# with the pipeline name. The other attributes are the global metrics.
+class PipelineMetrics:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._stages = {}
+        self.name = name
+
+        for counter in PIPELINE_COUNTERS:
+            setattr(self, counter, _PipelineMetric(getattr(metrics, counter), getattr(metrics, 'pipeline_' + counter).labels(name)))
+
+        self.publish_latency = _PipelineMetric(metrics.publish_latency, metrics.pipeline_publish_latency.labels(name))
+        self.queue_wait = metrics.pipeline_queue_wait.labels(name)
+        self.publish_duration = metrics.pipeline_publish_duration.labels(name)
+        self.queue_depth = metrics.pipeline_queue_depth.labels(name)
+
+    # -------------------------------------------------------------------------
+    # Called for the global metrics only (ex: metrics.throttle_tokens)
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(self._metrics, name)
+
+    # -------------------------------------------------------------------------
+    #
+    def stage_duration(self, stage):
+        metric = self._stages.get(stage, None)
+
+        if metric == None:
+            metric = self._metrics.pipeline_stage_duration.labels(self.name, stage)
+            self._stages[stage] = metric
+
+        return metric
+
+    # -------------------------------------------------------------------------
+    #
+    def inc_counter(self, name):
+        if name in PIPELINE_COUNTERS:
+            getattr(self, name).inc()
+        else:
+            self._metrics.inc_counter(name)
+
+
+# -----------------------------------------------------------------------------
+# Global metric and its pipeline labelled metric
+class _PipelineMetric:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self, metric, pipeline_metric):
+        self._metric = metric
+        self._pipeline_metric = pipeline_metric
+
+    # -------------------------------------------------------------------------
+    #
+    def inc(self, value=1):
+        self._metric.inc(value)
+        self._pipeline_metric.inc(value)
+
+    # -------------------------------------------------------------------------
+    #
+    def observe(self, value):
+        self._metric.observe(value)
+        self._pipeline_metric.observe(value)
+
+
+# -----------------------------------------------------------------------------
+#
+class _MetricProxy:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self, proxy:MetricsProxy, name, labels):
+        self._proxy = proxy
+        self._name = name
+        self._labels = labels
+
+    # -------------------------------------------------------------------------
+    #
+    def labels(self, *labels):
+        return _MetricProxy(self._proxy, self._name, tuple(labels))
+
+    # -------------------------------------------------------------------------
+    #
+    def inc(self, value=1):
+        self._proxy._add('inc', self._name, self._labels, value)
+
+    # -------------------------------------------------------------------------
+    #
+    def set(self, value):
+        self._proxy._add('set', self._name, self._labels, value)
+
+    # -------------------------------------------------------------------------
+    #
+    def observe(self, value):
+        self._proxy._add('observe', self._name, self._labels, value)
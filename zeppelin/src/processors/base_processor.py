@@ -6,28 +6,85 @@ JSON FILE TO SCHEMA
 https://json-to-schema.itential.io/
 '''
 
-import copy
+import os
 import json
 import time
 import datetime
 import uuid
-from threading import Thread, Lock
-from queue import SimpleQueue
+from threading import Thread, Lock, local
+from queue import SimpleQueue, Empty
 
-from utils.logger import get_logger, LOGGING_LEVEL
+from utils.logger import get_logger, LogSampler, LOGGING_LEVEL
+from utils import fast_json
 from .processor_interface import ProcessorInterface
 from .rules_processor import RulesProcessor
 from communication.communication_factory import CommunicationFactory
-from jsonschema import validate
+from communication.spool import Spool, SPOOL_DIR
+from jsonschema.validators import validator_for
 from metrics import Metrics
 
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
 
 logger = get_logger('BaseProcessor', LOGGING_LEVEL)
+payload_sampler = LogSampler()
+
+# blocking_wait: interval between the broker tasks of an idle pipeline
+TASK_INTERVAL_SEC = float(os.getenv('TASK_INTERVAL_SEC', 1.0))
+
+# -----------------------------------------------------------------------------
+# State of the message being processed. A new context is created for each message, in the thread processing it
+# (the pipeline thread, or a worker thread with the pipeline option workers > 1).
+class MessageContext:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self, dt = None):
+        self.payload = None
+        self.data = None
+        self.compressed = False
+        self.is_base64 = False
+        self.source_topic = None
+        self.device_model = ''
+        self.values = None
+        self.data_type = None
+        self.data_fields = None
+        self.device_config = None
+        self.dest_device_id = None
+        self.dt = dt
+
+# -----------------------------------------------------------------------------
+# Processor attribute stored in the MessageContext of the current thread
+def _message_attribute(name):
+    def fget(self):
+        return getattr(self._get_context(), name)
+
+    def fset(self, value):
+        setattr(self._get_context(), name, value)
+
+    return property(fget, fset)
 
 # -----------------------------------------------------------------------------
 #
 class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
 
+    # Per-message state (see MessageContext)
+    payload = _message_attribute('payload')
+    data = _message_attribute('data')
+    compressed = _message_attribute('compressed')
+    is_base64 = _message_attribute('is_base64')
+    source_topic = _message_attribute('source_topic') # last message source topic
+    device_model = _message_attribute('device_model')
+    values = _message_attribute('values')
+    data_type = _message_attribute('data_type')
+    data_fields = _message_attribute('data_fields')
+    device_config = _message_attribute('device_config')
+    _dest_device_id = _message_attribute('dest_device_id')
+    _message_dt = _message_attribute('dt')
+
     # -------------------------------------------------------------------------
     #
     def __init__(self):
@@ -36,13 +93,24 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
         self.config = {}
         self.running = False
         self.interval_sec = 0.1
+        self.blocking_wait = False  # Wake up as soon as a message is queued instead of polling every interval_sec
+        self.task_interval_sec = TASK_INTERVAL_SEC  # Interval between broker handle_task() calls in blocking_wait mode, when idle
+        self._next_task_time = 0
         self.max_payload_size_bytes = 0
+        self.publish_batch_size = 1  # > 1: messages are published with dst_broker.publish_batch()
+        self.workers = 1  # > 1: messages are processed by worker threads, see _dispatch_message()
+        self._worker_queues = []
+        self._worker_threads = []
+        self._reconfigure_request = None  # (config, pipeline) applied by the pipeline thread
+        self.spool_config = None  # Pipeline option "spool": store-and-forward of the messages not published, see communication/spool.py
+        self.spool = None
+        self._spool_drain_time = 0
         self.mutex = Lock()
         self.name = ''
-        self.device_model = ''
         self.device_id = ''
         self.pipeline = {}
         self.schema = None
+        self.schema_validator = None  # Compiled once per configuration load, see _compile_schema()
         self.rules = {}
         self.src_broker_config = None
         self.dst_broker_config = None
@@ -53,11 +121,6 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
         self.topics = []
         self.dest_topic = None
         self.cloud_event = {}
-        self.payload = None
-        self.data = None
-        self.source_topic = None # last message source topic
-        self.compressed = False
-        self.is_base64 = False
         self.src_has_cloud_event = True # Controlled with source broker config (has_cloud_event)
 
     # -------------------------------------------------------------------------
@@ -67,7 +130,8 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
     def init(self, config, pipeline, metrics:Metrics) -> bool:
         try:
             self.pipeline = pipeline
-            self.metrics = metrics
+            # Counters and histograms labelled with the pipeline name (see metrics.PipelineMetrics)
+            self.metrics = metrics.pipeline(pipeline.get('name', ''))
 
             if not self._load_config(config, pipeline):
                 return False
@@ -97,7 +161,16 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             logger.info(f'pipeline({pipeline})')
 
             self.interval_sec = pipeline.get('thread_interval_sec', self.interval_sec)
+            self.blocking_wait = bool(pipeline.get('blocking_wait', self.blocking_wait))
+            self.task_interval_sec = float(pipeline.get('task_interval_sec', self.task_interval_sec))
             self.max_payload_size_bytes = int(pipeline.get('max_payload_size_bytes', self.max_payload_size_bytes))
+            self.publish_batch_size = max(1, int(pipeline.get('publish_batch_size', self.publish_batch_size)))
+            self.workers = max(1, int(pipeline.get('workers', self.workers)))
+
+            self.spool_config = pipeline.get('spool', None)
+            if self.spool_config != None and not type(self.spool_config) is dict:
+                logger.error(f'invalid spool({self.spool_config})')
+                return False
 
             global_validation_rules = config.get('global_validation_rules', None)
             if global_validation_rules == None or not type(global_validation_rules) is dict:
@@ -132,6 +205,7 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
 
             self.name = pipeline.get('name', '')
 
+            self.topics = []
             topic = self.src_broker_config.get('topic', None)
             if topic != None and len(topic) > 0:
                 self.topics.append(topic)
@@ -153,6 +227,8 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             if self.schema == None:
                 logger.warning('no schema')
 
+            self.schema_validator = self._compile_schema(self.schema, pipeline.get('schema_validator', 'jsonschema'))
+
             config_filename = pipeline.get('config', None)
 
             if config_filename != None and len(config_filename) > 0:
@@ -175,6 +251,28 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             logger.error(ex)
             return False
 
+    # -------------------------------------------------------------------------
+    # Return a function validating an instance against the schema (raises an exception if invalid).
+    # The schema is checked against its metaschema and the validator is built once, here.
+    # schema_validator: 'jsonschema' (default) or 'fastjsonschema' (code-generated validator, pip install fastjsonschema)
+    def _compile_schema(self, schema, schema_validator='jsonschema'):
+        if schema == None:
+            return None
+
+        if schema_validator == 'fastjsonschema':
+            if fastjsonschema != None:
+                logger.info('schema compiled with fastjsonschema')
+                return fastjsonschema.compile(schema)
+
+            logger.warning('fastjsonschema is not installed, using jsonschema')
+
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+
+        logger.info(f'schema compiled with {validator_class.__name__}')
+
+        return validator_class(schema).validate
+
     # -------------------------------------------------------------------------
     #
     def _open_broker(self) -> bool:
@@ -195,6 +293,9 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
                 logger.error(f'cannot create destination broker agent from configuration({self.dst_broker_config})')
                 return False
 
+            if self.spool_config != None and not self._open_spool():
+                return False
+
             self.src_broker.start_listening(self.topics, self.queue)
 
             return True
@@ -216,10 +317,31 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
                 self.dst_broker.disconnect()
                 self.dst_broker = None
 
+            if self.spool != None:
+                self.spool.close()
+                self.spool = None
 
         except Exception as ex:
             logger.error(ex)
 
+    # -------------------------------------------------------------------------
+    #
+    def _open_spool(self) -> bool:
+        self.spool = Spool(self.name,
+                           directory=self.spool_config.get('directory', SPOOL_DIR),
+                           segment_size_bytes=float(self.spool_config.get('segment_size_mb', 4)) * 1024 * 1024,
+                           max_size_bytes=float(self.spool_config.get('max_size_mb', 100)) * 1024 * 1024,
+                           fsync=self.spool_config.get('fsync', 'interval'))
+
+        if not self.spool.open():
+            logger.error(f'cannot open spool({self.spool.directory})')
+            self.spool = None
+            return False
+
+        self._spool_drain_time = time.monotonic()
+
+        return True
+
     # -------------------------------------------------------------------------
     #
     def run(self):
@@ -232,23 +354,29 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
                 logger.error(f'cannot open broker')
                 return
 
+            logger.info(f'{self.name} blocking_wait({self.blocking_wait}) thread_interval_sec({self.interval_sec}) task_interval_sec({self.task_interval_sec}) workers({self.workers})')
+
+            self._start_workers()
+
             while self.running:
 
                 try:
-                    self._handle_queue()
+                    if self.blocking_wait:
+                        self._wait_queue()
+                    else:
+                        self._handle_queue()
 
-                    if self.src_broker != None:
-                        self.src_broker.handle_task()
+                    self._handle_broker_task()
+                    self._apply_reconfigure()
 
-                    if self.dst_broker != None:
-                        self.dst_broker.handle_task()
-
-                    if self.interval_sec > 0:
+                    if not self.blocking_wait and self.interval_sec > 0:
                         time.sleep(self.interval_sec)
 
                 except Exception as ex:
                     logger.error(ex)
 
+            self._stop_workers()
+
             # Disconnect from message broker
             self._close_broker()
 
@@ -258,6 +386,42 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             self.running = False
             logger.error(ex)
 
+    # -------------------------------------------------------------------------
+    # Request a new configuration for this pipeline. The brokers must be unchanged: they stay connected.
+    # The configuration is applied by the pipeline thread, between two messages (see _apply_reconfigure)
+    def reconfigure(self, config, pipeline):
+        try:
+            self.mutex.acquire()
+            self._reconfigure_request = (config, pipeline)
+
+        finally:
+            self.mutex.release()
+
+    # -------------------------------------------------------------------------
+    #
+    def _apply_reconfigure(self):
+        try:
+            self.mutex.acquire()
+            request = self._reconfigure_request
+            self._reconfigure_request = None
+
+        finally:
+            self.mutex.release()
+
+        if request == None:
+            return
+
+        config, pipeline = request
+        logger.info(f'{self.name} reconfigure')
+
+        # The workers process their queued messages with the current configuration
+        self._stop_workers()
+
+        if not self.init(config, pipeline, self.metrics):
+            logger.error(f'{self.name} reconfigure failed')
+
+        self._start_workers()
+
     # -------------------------------------------------------------------------
     #
     def stop(self):
@@ -268,6 +432,8 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
 
             if self.running:
                 self.running = False
+                # Wake up the thread if it is waiting on the queue
+                self.queue.put(None)
                 return True
 
             return False
@@ -287,21 +453,223 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             while not self.queue.empty():
                 msg = self.queue.get(block = False)
 
-                if msg == None:
+                if not self._dispatch_message(msg):
                     return
 
-                self.metrics.rx_message_total.inc()
+        except Exception as ex:
+            logger.error(ex)
+            return
+
+        finally:
+            # Publish the messages of the drained queue together
+            if len(self._publish_pending) > 0:
+                self._flush_publish()
+
+	# -------------------------------------------------------------------------
+	# Block until a message is received or until the next broker task is due,
+	# then process every message available in the queue
+    def _wait_queue(self):
+        try:
+            timeout = self._next_task_time - time.monotonic()
+
+            if timeout <= 0:
+                return
+
+            try:
+                msg = self.queue.get(timeout = timeout)
+            except Empty:
+                return
 
-                self.payload = None
-                self.data = None
-                self.compressed = False
+            if not self._dispatch_message(msg):
+                return
 
-                self._on_message_received(msg)
+            self._handle_queue()
 
         except Exception as ex:
             logger.error(ex)
             return
 
+	# -------------------------------------------------------------------------
+	# Return False if the message is None (stop requested)
+    def _handle_message(self, msg) -> bool:
+        if msg == None:
+            return False
+
+        self.metrics.rx_message_total.inc()
+
+        dt = msg.get('dt', None)
+        if dt != None:
+            self.metrics.queue_wait.observe((datetime.datetime.now() - dt).total_seconds())
+
+        self._get_local().context = MessageContext(dt)
+
+        self._on_message_received(msg)
+
+        return True
+
+	# -------------------------------------------------------------------------
+	# Process the message in this thread, or queue it to a worker thread (workers > 1).
+	# The messages with the same key are processed by the same worker, in order.
+	# Return False if the message is None (stop requested)
+    def _dispatch_message(self, msg) -> bool:
+        if self.workers <= 1 or msg == None:
+            return self._handle_message(msg)
+
+        self._worker_queues[hash(self._get_message_key(msg)) % self.workers].put(msg)
+
+        return True
+
+	# -------------------------------------------------------------------------
+	# Ordering key of a message: the cloud event source if the payload is already parsed, otherwise the topic
+	# (ex: zigbee2mqtt/<device>). The raw payloads (bytes) are parsed by the workers.
+    def _get_message_key(self, msg):
+        payload = msg.get('payload', None)
+
+        if type(payload) is dict:
+            source = payload.get('source', None)
+            if type(source) is str:
+                return source
+
+        return msg.get('topic', None)
+
+	# -------------------------------------------------------------------------
+	#
+    def _start_workers(self):
+        self._worker_queues = []
+        self._worker_threads = []
+
+        if self.workers <= 1:
+            return
+
+        for index in range(self.workers):
+            worker_queue = SimpleQueue()
+            worker = Thread(target=self._run_worker, args=(worker_queue,), name=f'{self.name}-worker-{index}', daemon=True)
+            self._worker_queues.append(worker_queue)
+            self._worker_threads.append(worker)
+            worker.start()
+
+        logger.info(f'{self.name} {self.workers} workers started')
+
+	# -------------------------------------------------------------------------
+	# Process the queued messages, then stop
+    def _stop_workers(self):
+        for worker_queue in self._worker_queues:
+            worker_queue.put(None)
+
+        for worker in self._worker_threads:
+            worker.join()
+
+        self._worker_queues = []
+        self._worker_threads = []
+
+	# -------------------------------------------------------------------------
+	#
+    def _run_worker(self, worker_queue):
+        while True:
+            try:
+                msg = worker_queue.get()
+
+                if not self._handle_message(msg):
+                    break
+
+                # Publish the messages together while the worker queue is drained
+                if worker_queue.empty() and len(self._publish_pending) > 0:
+                    self._flush_publish()
+
+            except Exception as ex:
+                logger.error(ex)
+
+        if len(self._publish_pending) > 0:
+            self._flush_publish()
+
+	# -------------------------------------------------------------------------
+	# Per-thread state: message context and pending batch of messages to publish
+    def _get_local(self):
+        thread_local = self.__dict__.get('_local', None)
+
+        if thread_local == None:
+            thread_local = self.__dict__.setdefault('_local', local())
+
+        return thread_local
+
+	# -------------------------------------------------------------------------
+	#
+    def _get_context(self) -> MessageContext:
+        thread_local = self._get_local()
+        context = getattr(thread_local, 'context', None)
+
+        if context == None:
+            context = thread_local.context = MessageContext()
+
+        return context
+
+    # -------------------------------------------------------------------------
+    # (topic, payload, publish kwargs, message dt) of the current thread
+    @property
+    def _publish_pending(self) -> list:
+        thread_local = self._get_local()
+        pending = getattr(thread_local, 'publish_pending', None)
+
+        if pending == None:
+            pending = thread_local.publish_pending = []
+
+        return pending
+
+    @_publish_pending.setter
+    def _publish_pending(self, pending):
+        self._get_local().publish_pending = pending
+
+	# -------------------------------------------------------------------------
+	# Parse the payload received as bytes or str (ex: MqttAgent) in the pipeline thread.
+	# Called after the size check: an oversized message is never decoded.
+    def _load_payload(self, message) -> bool:
+        payload = message['payload']
+
+        if type(payload) is bytes or type(payload) is str:
+            try:
+                self.payload = fast_json.loads(payload)
+            except Exception as ex:
+                logger.error(f'invalid json payload from topic({message.get("topic", None)}): {ex} payload(%.300s)', payload)
+                self.metrics.rx_message_invalid.inc()
+                return False
+
+        return True
+
+	# -------------------------------------------------------------------------
+	# In blocking_wait mode, broker tasks are called every task_interval_sec when idle,
+	# or every thread_interval_sec while messages wait for them (throttle, spool)
+    def _handle_broker_task(self):
+        try:
+            if self.blocking_wait:
+                now = time.monotonic()
+
+                if now < self._next_task_time:
+                    return
+
+                self._next_task_time = now + (self.interval_sec if self._has_pending_tasks() else self.task_interval_sec)
+
+            self.metrics.queue_depth.set(self.queue.qsize() + sum(queue.qsize() for queue in self._worker_queues))
+
+            if self.src_broker != None:
+                self.src_broker.handle_task()
+
+            if self.dst_broker != None:
+                self.dst_broker.handle_task()
+
+            if self.spool != None:
+                self._drain_spool()
+
+        except Exception as ex:
+            logger.error(ex)
+
+	# -------------------------------------------------------------------------
+	# Messages deferred by the throttle of the brokers or waiting in the spool
+    def _has_pending_tasks(self) -> bool:
+        if self.spool != None and self.spool.depth > 0:
+            return True
+
+        return any(broker != None and broker.get_pending() > 0 for broker in (self.src_broker, self.dst_broker))
+
 	# -------------------------------------------------------------------------
 	# Process received message from broker
     def _on_message_received(self, message) -> None:
@@ -316,7 +684,11 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
                 self.metrics.rx_message_over_size.inc()
                 return
 
-            cloud_event = copy.deepcopy(self.cloud_event)
+            if not self._load_payload(message):
+                return
+
+            # Shallow template merge: only top-level attributes of the outgoing envelope are set per message
+            cloud_event = dict(self.cloud_event)
             if self.src_has_cloud_event:
                 cloud_event['source'] = self.payload.get('source', None)
                 cloud_event['compressed'] = self.payload.get('compressed', False)
@@ -329,15 +701,15 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
                 self.compressed =  False
                 self.is_base64 = False
 
-            if not self.assess():
+            if not self._run_stage('assess', self.assess):
                 self.metrics.rx_message_invalid.inc()
                 return
 
-            if not self.validate():
+            if not self._run_stage('validate', self.validate):
                 self.metrics.rx_message_invalid.inc()
                 return False
 
-            if not self.normalize():
+            if not self._run_stage('normalize', self.normalize):
                 self.metrics.rx_message_invalid.inc()
                 return False
 
@@ -348,8 +720,9 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             if pub_data != None:
                 self.metrics.rx_message_valid.inc()
 
+                # tx_message_total is counted when the message is sent (_publish, _flush_publish)
                 if self._publish_payload(self.get_destination_topic(), pub_data, cloud_event):
-                    self.metrics.tx_message_total.inc()
+                    self._observe_latency(message)
 
             else:
                 self.metrics.rx_message_error.inc()
@@ -358,6 +731,17 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             self.metrics.rx_message_error.inc()
             logger.error(ex)
 
+    # -------------------------------------------------------------------------
+    # Run a processing stage (assess, validate, normalize) and observe its duration
+    def _run_stage(self, stage, func) -> bool:
+        start = time.perf_counter()
+
+        try:
+            return func()
+
+        finally:
+            self.metrics.stage_duration(stage).observe(time.perf_counter() - start)
+
     # -------------------------------------------------------------------------
     #
     def get_destination_topic(self) -> str:
@@ -382,17 +766,190 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             if payload == None:
                 return False
 
-            logger.info(f'topic({topic}) payload(%.300s)', payload)
-            logger.debug(f'data({data})')
+            if payload_sampler.is_enabled(logger):
+                logger.info('topic(%s) payload(%.300s)', topic, payload)
+            logger.debug('data(%s)', data)
 
-            self.dst_broker.publish(topic, payload)
+            return self._publish(topic, payload)
 
-            return True
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+    # -------------------------------------------------------------------------
+    # Publish to the destination broker, or add the message to the pending batch
+    # (published by _flush_publish()) if publish_batch_size > 1.
+    # With a spool, a message not published is spooled (and True is returned)
+    # tx_message_total and tx_message_error are counted here, or by _flush_publish() for a batch,
+    # or by _drain_spool() for the spooled messages
+    def _publish(self, topic, payload, **kwargs) -> bool:
+        if self.publish_batch_size <= 1:
+            if self._use_spool():
+                return self._spool_messages([(topic, payload, kwargs)])
+
+            start = time.perf_counter()
+            result = self.dst_broker.publish(topic, payload, **kwargs)
+            self.metrics.publish_duration.observe(time.perf_counter() - start)
+
+            if result:
+                self.metrics.tx_message_total.inc()
+                return True
+
+            if self.spool != None:
+                return self._spool_messages([(topic, payload, kwargs)])
+
+            self.metrics.tx_message_error.inc()
+            return False
+
+        self._publish_pending.append((topic, payload, kwargs, self._message_dt))
+
+        if len(self._publish_pending) >= self.publish_batch_size:
+            self._flush_publish()
+
+        return True
+
+    # -------------------------------------------------------------------------
+    # Publish the pending messages; consecutive messages with the same publish options are sent in one batch
+    def _flush_publish(self) -> None:
+        try:
+            pending = self._publish_pending
+            self._publish_pending = []
+
+            start = 0
+            while start < len(pending):
+                kwargs = pending[start][2]
+                end = start + 1
+
+                while end < len(pending) and pending[end][2] == kwargs:
+                    end += 1
+
+                batch = pending[start:end]
+
+                if self._use_spool():
+                    count = 0
+                else:
+                    publish_start = time.perf_counter()
+                    count = self.dst_broker.publish_batch([(topic, payload) for topic, payload, _, _ in batch], **kwargs)
+                    self.metrics.publish_duration.observe(time.perf_counter() - publish_start)
+
+                if count > 0:
+                    self.metrics.tx_message_total.inc(count)
+
+                if count < len(batch):
+                    if self.spool != None:
+                        self._spool_messages([(topic, payload, kwargs) for topic, payload, kwargs, _ in batch[count:]])
+                    else:
+                        logger.error(f'{len(batch) - count}/{len(batch)} messages not published')
+                        self.metrics.tx_message_error.inc(len(batch) - count)
+
+                now = datetime.datetime.now()
+                for _, _, _, dt in batch:
+                    if dt != None:
+                        self.metrics.publish_latency.observe((now - dt).total_seconds())
+
+                start = end
 
         except Exception as ex:
             logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # The messages are spooled while the spool is not empty, to keep the order,
+    # or always in spool mode "always" (the spool smooths the bursts at drain_msg_sec)
+    def _use_spool(self) -> bool:
+        if self.spool == None:
+            return False
+
+        return self.spool.depth > 0 or self.spool_config.get('mode', 'fallback') == 'always'
+
+    # -------------------------------------------------------------------------
+    # messages = list of (topic, payload, kwargs)
+    # The spooled messages are counted in tx_message_total when they are published by _drain_spool()
+    def _spool_messages(self, messages) -> bool:
+        dropped = self.spool.dropped
+
+        if not self.spool.append(messages):
+            logger.error(f'{len(messages)} messages not spooled')
+            self.metrics.tx_message_error.inc(len(messages))
             return False
 
+        self.metrics.spool_message_total.labels(self.name).inc(len(messages))
+
+        if self.spool.dropped > dropped:
+            # Messages lost, never published
+            self.metrics.spool_dropped_total.labels(self.name).inc(self.spool.dropped - dropped)
+            self.metrics.tx_message_error.inc(self.spool.dropped - dropped)
+
+        return True
+
+    # -------------------------------------------------------------------------
+    # Publish the spooled messages, in order, at drain_msg_sec messages per second.
+    # Called by _handle_broker_task(): the drain stops at the first message not published and is retried on the next task.
+    def _drain_spool(self) -> None:
+        try:
+            now = time.monotonic()
+            drain_msg_sec = float(self.spool_config.get('drain_msg_sec', 100))
+            count = min(int((now - self._spool_drain_time) * drain_msg_sec), max(1, int(drain_msg_sec)))
+
+            if self.spool.depth > 0 and count >= 1:
+                self._spool_drain_time = now
+                messages = self.spool.peek(count)
+                published = 0
+
+                while published < len(messages):
+                    # Invalid record (logged by the spool)
+                    if messages[published] == None:
+                        self.metrics.tx_message_error.inc()
+                        published += 1
+                        continue
+
+                    kwargs = messages[published][2]
+                    end = published + 1
+
+                    while end < len(messages) and messages[end] != None and messages[end][2] == kwargs:
+                        end += 1
+
+                    batch = [(topic, payload) for topic, payload, _, _ in messages[published:end]]
+                    sent = self.dst_broker.publish_batch(batch, **kwargs)
+                    published += sent
+
+                    if sent > 0:
+                        self.metrics.tx_message_total.inc(sent)
+
+                    if sent < len(batch):
+                        break
+
+                if published > 0:
+                    self.spool.commit(published)
+                    logger.info(f'{self.name} {published} spooled messages published, {self.spool.depth} left')
+                else:
+                    # Destination broker still unavailable
+                    self._spool_drain_time = now + float(self.spool_config.get('retry_interval_sec', 1.0))
+
+            elif self.spool.depth == 0:
+                self._spool_drain_time = now
+
+            self.metrics.spool_depth.labels(self.name).set(self.spool.depth)
+            self.metrics.spool_age.labels(self.name).set(self.spool.get_age())
+
+        except Exception as ex:
+            logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # Enqueue to publish latency. message['dt'] is set by the broker agent when the message is queued.
+    # With publish_batch_size > 1, the latency is observed when the batch is published (_flush_publish).
+    def _observe_latency(self, message) -> None:
+        try:
+            if self.publish_batch_size > 1:
+                return
+
+            dt = message.get('dt', None)
+
+            if dt != None:
+                self.metrics.publish_latency.observe((datetime.datetime.now() - dt).total_seconds())
+
+        except Exception as ex:
+            logger.error(ex)
+
     # -------------------------------------------------------------------------
     #
     def _get_cloud_event(self, cloud_event, data) -> object:
@@ -427,13 +984,15 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
             if not self.check_schema():
                 return False
 
+            # The received payload is read-only: self.data references it (no copy).
+            # normalize() must build a new object instead of modifying self.data in place.
             if self.src_has_cloud_event:
                 if self.is_base64:
-                    self.data = copy.deepcopy(self.payload.get('data_base64', None))
+                    self.data = self.payload.get('data_base64', None)
                 else:
-                    self.data = copy.deepcopy(self.payload.get('data', None))
+                    self.data = self.payload.get('data', None)
             else:
-                self.data = copy.deepcopy(self.payload)
+                self.data = self.payload
 
             if self.data == None:
                 logger.error('no data')
@@ -502,11 +1061,11 @@ class BaseProcessor(ProcessorInterface, RulesProcessor, Thread):
     #
     def check_schema(self) -> bool:
         try:
-            if self.schema == None:
+            if self.schema_validator == None:
                 logger.info('no schema')
                 return True
 
-            validate(instance = self.payload, schema = self.schema)
+            self.schema_validator(self.payload)
 
             return True
 
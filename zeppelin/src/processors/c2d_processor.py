@@ -1,10 +1,9 @@
-import copy
-
-from utils.logger import get_logger, LOGGING_LEVEL
+from utils.logger import get_logger, LogSampler, LOGGING_LEVEL
 from .base_processor import BaseProcessor
 from metrics import Metrics
 
 logger = get_logger("C2DProcessor", LOGGING_LEVEL)
+payload_sampler = LogSampler()
 
 # -----------------------------------------------------------------------------
 #
@@ -38,26 +37,29 @@ class C2DProcessor(BaseProcessor):
                 self.metrics.rx_message_over_size.inc()
                 return
 
+            if not self._load_payload(message):
+                return
+
             self.compressed =  self.payload.get('compressed', False)
             self.is_base64 = 'data_base64' in self.payload
 
             if props != None:
-                logger.info(f"props({props})")
+                logger.info("props(%s)", props)
 
-            if not self.assess():
+            if not self._run_stage('assess', self.assess):
                 self.metrics.rx_message_invalid.inc()
                 return
 
-            if not self.validate():
+            if not self._run_stage('validate', self.validate):
                 self.metrics.rx_message_invalid.inc()
                 return False
 
-            if not self.normalize():
+            if not self._run_stage('normalize', self.normalize):
                 self.metrics.rx_message_invalid.inc()
                 return False
 
-            # we publish original data with the provided cloud_event
-            pub_data = copy.deepcopy(self.payload)
+            # we publish original data with the provided cloud_event (read-only, not copied)
+            pub_data = self.payload
 
             dest_topic = self.dest_topic
 
@@ -75,7 +77,7 @@ class C2DProcessor(BaseProcessor):
                 self.metrics.rx_message_valid.inc()
 
                 if self._publish_payload(dest_topic, pub_data):
-                    self.metrics.tx_message_total.inc()
+                    self._observe_latency(message)
 
             else:
                 self.metrics.rx_message_error.inc()
@@ -89,11 +91,10 @@ class C2DProcessor(BaseProcessor):
     def _publish_payload(self, topic, data) -> bool:
         try:
 
-            logger.info(f"topic({topic}) payload(%.300s)", data)
+            if payload_sampler.is_enabled(logger):
+                logger.info("topic(%s) payload(%.300s)", topic, data)
 
-            self.dst_broker.publish(topic, data)
-
-            return True
+            return self._publish(topic, data)
 
         except Exception as ex:
             logger.error(ex)
@@ -27,7 +27,7 @@ class EgaugeProcessor(BaseProcessor):
 
             self.device_model = 'egauge'
 
-            logger.info(f'device_model({self.device_model})')
+            logger.info('device_model(%s)', self.device_model)
 
             return True
 
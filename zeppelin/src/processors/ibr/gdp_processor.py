@@ -1,8 +1,8 @@
-import copy
-from utils.logger import get_logger, LOGGING_LEVEL
+from utils.logger import get_logger, LogSampler, LOGGING_LEVEL
 from ..base_processor import BaseProcessor
 
 logger = get_logger('GDPProcessor', LOGGING_LEVEL)
+payload_sampler = LogSampler()
 
 # -----------------------------------------------------------------------------
 #
@@ -34,30 +34,32 @@ class GDPProcessor(BaseProcessor):
                 self.metrics.rx_message_over_size.inc()
                 return
 
+            if not self._load_payload(message):
+                return
+
             self.compressed =  self.payload.get('compressed', False)
             self.is_base64 = 'data_base64' in self.payload
 
-            if not self.assess():
+            if not self._run_stage('assess', self.assess):
                 self.metrics.rx_message_invalid.inc()
                 return
 
-            if not self.validate():
+            if not self._run_stage('validate', self.validate):
                 self.metrics.rx_message_invalid.inc()
                 return False
 
-            if not self.normalize():
+            if not self._run_stage('normalize', self.normalize):
                 self.metrics.rx_message_invalid.inc()
                 return False
 
-            # we publish original data without the provided cloud_event
-            payload = copy.deepcopy(self.payload)
-            pub_data = payload.get("data", None)
+            # we publish original data without the provided cloud_event (read-only, not copied)
+            pub_data = self.payload.get("data", None)
 
             if pub_data != None:
                 self.metrics.rx_message_valid.inc()
 
                 if self._publish_payload(self.dest_topic, pub_data):
-                    self.metrics.tx_message_total.inc()
+                    self._observe_latency(message)
 
             else:
                 self.metrics.rx_message_error.inc()
@@ -71,11 +73,10 @@ class GDPProcessor(BaseProcessor):
     def _publish_payload(self, topic, data) -> bool:
         try:
 
-            logger.info(f"topic({topic}) payload({data})")
-
-            self.dst_broker.publish(topic, data, retain = True)
+            if payload_sampler.is_enabled(logger):
+                logger.info("topic(%s) payload(%s)", topic, data)
 
-            return True
+            return self._publish(topic, data, retain = True)
 
         except Exception as ex:
             logger.error(ex)
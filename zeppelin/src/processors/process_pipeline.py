@@ -0,0 +1,422 @@
+"""
+ProcessPipeline: run a pipeline in a worker process (pipeline option "process": true).
+
+The pipeline processor (BaseProcessor thread) runs in a separate Python process, so CPU heavy pipelines
+(schema validation, normalization) do not compete for the GIL with the other pipelines.
+
+ProcessPipeline is created by Zeppelin instead of the processor and supervises the worker process:
+- the worker process is started with the spawn method and restarted when it exits unexpectedly;
+- the metrics of the worker (MetricsProxy) are sent periodically and applied to the metrics of the
+  Zeppelin process, exposed by the Prometheus server;
+- the brokers that allow only one client per process (IoTEdge, IoTDevice) stay in the Zeppelin process:
+  the worker uses a BridgeAgent and the messages are forwarded through multiprocessing queues; the publish
+  result of the real agent is returned to the worker (reply queue).
+"""
+import os
+import time
+import queue
+import multiprocessing
+from threading import Thread, Lock
+
+from communication.communication_factory import CommunicationFactory
+from processors.processor_factory import ProcessorFactory
+from communication.bridge_agent import BridgeAgent
+from utils.logger import get_logger, LOGGING_LEVEL
+from metrics import Metrics, MetricsProxy
+
+logger = get_logger('ProcessPipeline', LOGGING_LEVEL)
+
+# Broker classes kept in the Zeppelin process and bridged to the worker process
+BRIDGED_CLASSES = ('IOTEDGE', 'IOTDEVICE')
+
+PROCESS_RESTART_INTERVAL_SEC = float(os.getenv('PROCESS_RESTART_INTERVAL_SEC', 5.0))
+PROCESS_STOP_TIMEOUT_SEC = float(os.getenv('PROCESS_STOP_TIMEOUT_SEC', 10.0))
+METRICS_FLUSH_INTERVAL_SEC = 1.0
+SUPERVISOR_INTERVAL_SEC = 0.5
+
+# -----------------------------------------------------------------------------
+#
+class ProcessPipeline:
+
+    # -------------------------------------------------------------------------
+    #
+    def __init__(self):
+        self.name = ''
+        self.config = {}
+        self.pipeline = {}
+        self.worker_pipeline = {}
+        self.metrics:Metrics = None
+        self.running = False
+        self.context = multiprocessing.get_context('spawn')
+        self.supervisor = None
+        # The process, its stop event and its queues are created for each start of the worker process:
+        # a killed process may leave them locked
+        self.process = None
+        self.stop_event = None
+        self.metrics_queue = None
+        # role -> {'config', 'agent', 'local': queue of the agent (source), 'rx', 'tx', 'reply': queues of the worker process}
+        self.bridges = {}
+        self.bridges_mutex = Lock()  # the queues of the worker process are replaced while the bridge threads use them
+
+    # -------------------------------------------------------------------------
+    # config = zeppelin global config file
+    # pipeline = pipeline object from pipelines[]
+    #
+    def init(self, config, pipeline, metrics:Metrics) -> bool:
+        try:
+            self.config = config
+            self.pipeline = pipeline
+            self.metrics = metrics
+            self.name = pipeline.get('name', '')
+            self.worker_pipeline = dict(pipeline)
+
+            for role, key in (('source', 'source_broker'), ('destination', 'destination_broker')):
+                broker_config = pipeline.get(key, None)
+
+                if not type(broker_config) is dict:
+                    logger.error(f'invalid {key}({broker_config})')
+                    return False
+
+                broker_class = str(broker_config.get('class', '')).strip().upper().replace(' ', '').replace('-', '').replace('_', '')
+
+                if broker_class in BRIDGED_CLASSES:
+                    logger.info(f'{self.name} {key} class({broker_class}) bridged to the worker process')
+                    self.worker_pipeline[key] = dict(broker_config, **{'class': 'bridge', 'bridge': role})
+                    self.bridges[role] = {'config': broker_config, 'agent': None, 'local': queue.SimpleQueue(), 'rx': None, 'tx': None, 'reply': None}
+
+                    if role == 'destination' and pipeline.get('spool', None) != None:
+                        logger.warning(f'{self.name} spool with a bridged destination: a message without publish result after BRIDGE_REPLY_TIMEOUT_SEC is spooled and may be published twice')
+
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+    # -------------------------------------------------------------------------
+    #
+    def start(self):
+        self.running = True
+        self.supervisor = Thread(target=self._supervise, name=f'{self.name}-supervisor')
+        self.supervisor.start()
+
+    # -------------------------------------------------------------------------
+    #
+    def stop(self):
+        logger.info(f'{self.name} process stop requested')
+        self.running = False
+
+        if self.stop_event != None:
+            self.stop_event.set()
+
+    # -------------------------------------------------------------------------
+    #
+    def join(self, timeout=None):
+        if self.supervisor != None:
+            self.supervisor.join(timeout)
+
+    # -------------------------------------------------------------------------
+    #
+    def is_alive(self) -> bool:
+        return self.supervisor != None and self.supervisor.is_alive()
+
+    # -------------------------------------------------------------------------
+    # Start the worker process, restart it when it exits and apply its metrics
+    def _supervise(self):
+        try:
+            if not self._open_bridges():
+                logger.error(f'{self.name} cannot open bridged broker')
+                self.running = False
+                return
+
+            restart_time = 0
+
+            while self.running:
+                if self.process == None or not self.process.is_alive():
+                    now = time.monotonic()
+
+                    if self.process != None and restart_time == 0:
+                        logger.error(f'{self.name} worker process exited with code({self.process.exitcode}), restart in {PROCESS_RESTART_INTERVAL_SEC} sec')
+                        restart_time = now + PROCESS_RESTART_INTERVAL_SEC
+
+                    if now >= restart_time:
+                        if self.process != None:
+                            self.metrics.process_restart_total.inc()
+                        self._start_process()
+                        restart_time = 0
+
+                self._apply_metrics(self.metrics_queue, SUPERVISOR_INTERVAL_SEC)
+
+                for bridge in self.bridges.values():
+                    bridge['agent'].handle_task()
+
+            self._stop_process()
+            self._close_bridges()
+
+            logger.info(f'{self.name} process stopped')
+
+        except Exception as ex:
+            self.running = False
+            logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    #
+    def _start_process(self):
+        old_metrics_queue = self.metrics_queue
+        old_bridge_queues = self._get_bridge_queues()
+
+        self.stop_event = self.context.Event()
+        self.metrics_queue = self.context.Queue()
+
+        # The messages in transit are forwarded to the new queues, the old ones are released after the swap
+        with self.bridges_mutex:
+            for bridge in self.bridges.values():
+                bridge['rx'] = self.context.Queue()
+                bridge['tx'] = self.context.Queue()
+                bridge['reply'] = self.context.Queue()
+
+        self._release_queues(old_metrics_queue, old_bridge_queues)
+
+        bridge_queues = self._get_bridge_queues()
+
+        self.process = self.context.Process(
+            target=run_pipeline_process,
+            args=(self.config, self.worker_pipeline, self.metrics_queue, self.stop_event, bridge_queues),
+            name=f'zeppelin-{self.name}',
+            daemon=True)
+
+        self.process.start()
+        logger.info(f'{self.name} worker process started pid({self.process.pid})')
+
+    # -------------------------------------------------------------------------
+    #
+    def _stop_process(self):
+        if self.process == None:
+            return
+
+        self.stop_event.set()
+        self.process.join(PROCESS_STOP_TIMEOUT_SEC)
+
+        if self.process.is_alive():
+            logger.warning(f'{self.name} worker process did not stop, terminate')
+            self.process.terminate()
+            self.process.join()
+
+        with self.bridges_mutex:
+            bridge_queues = self._get_bridge_queues()
+            for bridge in self.bridges.values():
+                bridge['rx'] = bridge['tx'] = bridge['reply'] = None
+
+        self._release_queues(self.metrics_queue, bridge_queues)
+        self.metrics_queue = None
+
+    # -------------------------------------------------------------------------
+    # role -> (rx, tx, reply) queues of the worker process
+    def _get_bridge_queues(self) -> dict:
+        return {role: (bridge['rx'], bridge['tx'], bridge['reply']) for role, bridge in self.bridges.items()}
+
+    # -------------------------------------------------------------------------
+    # Apply the last metrics and publish the last messages of the stopped worker process, then close its queues
+    def _release_queues(self, metrics_queue, bridge_queues):
+        if metrics_queue != None:
+            self._apply_metrics(metrics_queue, 0)
+            metrics_queue.close()
+
+        for role, (rx_queue, tx_queue, reply_queue) in bridge_queues.items():
+            if tx_queue != None:
+                # No reply: the tx_message_total/tx_message_error of these messages are counted here
+                self._publish_requests(self.bridges[role], tx_queue, None, 0)
+                tx_queue.close()
+
+            if reply_queue != None:
+                reply_queue.cancel_join_thread()
+                reply_queue.close()
+
+            if rx_queue != None:
+                # The messages not read by the worker process are lost
+                rx_queue.cancel_join_thread()
+                rx_queue.close()
+
+    # -------------------------------------------------------------------------
+    #
+    def _apply_metrics(self, metrics_queue, timeout):
+        try:
+            operations = metrics_queue.get(timeout=timeout) if timeout > 0 else metrics_queue.get_nowait()
+
+            while True:
+                self.metrics.apply(operations)
+                operations = metrics_queue.get_nowait()
+
+        except (queue.Empty, OSError, ValueError):
+            pass
+
+        except Exception as ex:
+            logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # Create the bridged brokers in this process
+    def _open_bridges(self) -> bool:
+        try:
+            for role, bridge in self.bridges.items():
+                agent = CommunicationFactory.get_client(bridge['config'])
+
+                if agent == None:
+                    logger.error(f'cannot create broker agent from configuration({bridge["config"]})')
+                    return False
+
+                bridge['agent'] = agent
+                agent.set_metrics(self.metrics)
+
+                if role == 'source':
+                    topics = []
+                    topic = bridge['config'].get('topic', None)
+                    if topic != None and len(topic) > 0:
+                        topics.append(topic)
+
+                    agent.start_listening(topics, bridge['local'])
+                    Thread(target=self._forward_bridge, args=(bridge,), name=f'{self.name}-bridge-rx', daemon=True).start()
+                else:
+                    Thread(target=self._publish_bridge, args=(bridge,), name=f'{self.name}-bridge-tx', daemon=True).start()
+
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+    # -------------------------------------------------------------------------
+    #
+    def _close_bridges(self):
+        for bridge in self.bridges.values():
+            try:
+                if bridge['agent'] != None:
+                    bridge['agent'].disconnect()
+                    bridge['agent'] = None
+
+            except Exception as ex:
+                logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # Forward the messages received by the bridged source broker to the worker process
+    def _forward_bridge(self, bridge):
+        while self.running:
+            try:
+                msg = bridge['local'].get(timeout=SUPERVISOR_INTERVAL_SEC)
+
+                with self.bridges_mutex:
+                    if bridge['rx'] != None:
+                        bridge['rx'].put(msg)
+                    else:
+                        logger.error(f'{self.name} worker process stopped, message discarded')
+
+            except queue.Empty:
+                pass
+
+            except Exception as ex:
+                logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # Publish the messages forwarded by the BridgeAgent of the worker process
+    def _publish_bridge(self, bridge):
+        while self.running:
+            with self.bridges_mutex:
+                tx_queue, reply_queue = bridge['tx'], bridge['reply']
+
+            if tx_queue == None:
+                time.sleep(SUPERVISOR_INTERVAL_SEC)
+                continue
+
+            self._publish_requests(bridge, tx_queue, reply_queue, SUPERVISOR_INTERVAL_SEC)
+
+    # -------------------------------------------------------------------------
+    # Publish the requests of the tx queue, wait up to timeout for the first one.
+    # The result is returned to the BridgeAgent in reply_queue, or counted here if reply_queue is None.
+    def _publish_requests(self, bridge, tx_queue, reply_queue, timeout):
+        try:
+            request = tx_queue.get(timeout=timeout) if timeout > 0 else tx_queue.get_nowait()
+
+            while True:
+                agent = bridge['agent']
+                result = 0
+
+                if request[0] == 'publish':
+                    _, request_id, topic, payload, kwargs = request
+                    messages = [(topic, payload)]
+                else:
+                    _, request_id, messages, kwargs = request
+
+                try:
+                    if agent == None:
+                        logger.error(f'{self.name} bridged broker closed, {len(messages)} messages discarded')
+                    elif request[0] == 'publish':
+                        result = agent.publish(topic, payload, **kwargs)
+                    else:
+                        result = agent.publish_batch(messages, **kwargs)
+
+                except Exception as ex:
+                    # The result (0) is returned anyway, the BridgeAgent is waiting for it
+                    logger.error(ex)
+
+                if reply_queue != None:
+                    reply_queue.put((request_id, result))
+                else:
+                    self._count_published(len(messages), int(result))
+
+                request = tx_queue.get_nowait()
+
+        except (queue.Empty, OSError, ValueError):
+            pass
+
+        except Exception as ex:
+            logger.error(ex)
+
+    # -------------------------------------------------------------------------
+    # Messages published after the worker process exited
+    def _count_published(self, count, published):
+        metrics = self.metrics.pipeline(self.name)
+
+        if published > 0:
+            metrics.tx_message_total.inc(published)
+
+        if published < count:
+            metrics.tx_message_error.inc(count - published)
+
+
+# -----------------------------------------------------------------------------
+# Entry point of the worker process
+def run_pipeline_process(config, pipeline, metrics_queue, stop_event, bridge_queues):
+    name = pipeline.get('name', '')
+
+    try:
+        metrics = MetricsProxy(metrics_queue)
+
+        for role, (rx_queue, tx_queue, reply_queue) in bridge_queues.items():
+            BridgeAgent.set_queues(role, rx_queue, tx_queue, reply_queue)
+
+        proc = ProcessorFactory.get_processor(pipeline['class'])
+
+        if proc == None or not proc.init(config, pipeline, metrics):
+            logger.error(f'{name} processor init failed in worker process')
+            exit(1)
+
+        proc.start()
+        logger.info(f'{name} worker process running pid({os.getpid()})')
+
+        while not stop_event.wait(METRICS_FLUSH_INTERVAL_SEC):
+            metrics.flush()
+
+            if not proc.is_alive():
+                logger.error(f'{name} processor thread stopped')
+                metrics.flush()
+                exit(1)
+
+            if not multiprocessing.parent_process().is_alive():
+                logger.error(f'{name} Zeppelin process stopped')
+                break
+
+        proc.stop()
+        proc.join()
+        metrics.flush()
+
+    except Exception as ex:
+        logger.error(ex)
@@ -62,7 +62,7 @@ class ZigbeeProcessor(BaseProcessor):
 
             self.device_model = subject.upper()
 
-            logger.info(f'device_model({self.device_model})')
+            logger.info('device_model(%s)', self.device_model)
 
             if self.config == None:
                 logger.error(f'invalid config({self.config})')
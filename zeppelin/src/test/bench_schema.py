@@ -0,0 +1,105 @@
+'''
+Benchmark of the JSON schema validation (BaseProcessor.check_schema) on the shipped schemas.
+Compares jsonschema.validate() per message (previous implementation) with the validators
+compiled once by BaseProcessor._compile_schema() (jsonschema and fastjsonschema).
+
+python3 bench_schema.py [message_count]
+'''
+# Do this first !
+import sys
+import os
+
+# Add parent directory to Python path to resolve imports
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from utils.logger import set_log_filename
+set_log_filename('bench-schema.log')
+
+import copy
+import json
+import time
+from jsonschema import validate
+
+from processors.base_processor import BaseProcessor, fastjsonschema
+
+ZEPPELIN_DIR = os.path.dirname(parent_dir)
+SCHEMAS_DIR = os.path.join(ZEPPELIN_DIR, 'config', 'schemas')
+SAMPLES_DIR = os.path.join(ZEPPELIN_DIR, 'doc', 'data')
+
+BENCHMARKS = [
+    ('zigbee', 'zigbee-schema.json', 'zigbee-sample-1.json'),
+    ('egauge', 'egauge-schema.json', 'egauge-sample.json'),
+]
+
+# -----------------------------------------------------------------------------
+# The samples are IoT Hub records; the message is in Body
+def load_message(filename):
+    with open(os.path.join(SAMPLES_DIR, filename)) as f:
+        message = json.load(f)['Body']
+
+    # The eGauge sample is not normalized: value_type is required by the schema
+    for item in message.get('data', {}).get('values', []):
+        if 'value_type' not in item:
+            value = item.get('value', None)
+            item['value_type'] = 'string' if type(value) is str else 'int' if type(value) is int else 'float'
+
+    return message
+
+# -----------------------------------------------------------------------------
+#
+def bench(name, validator, message, count):
+    validator(message)
+
+    start = time.perf_counter()
+
+    for i in range(count):
+        validator(message)
+
+    elapsed = time.perf_counter() - start
+    print(f'    {name:<28} {count / elapsed:12.0f} msg/sec')
+
+    return elapsed
+
+# -----------------------------------------------------------------------------
+#
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    processor = BaseProcessor()
+
+    for name, schema_filename, sample_filename in BENCHMARKS:
+        with open(os.path.join(SCHEMAS_DIR, schema_filename)) as f:
+            schema = json.load(f)
+
+        message = load_message(sample_filename)
+
+        invalid_message = copy.deepcopy(message)
+        invalid_message['specversion'] = 1
+
+        print(f'{name}: {schema_filename} {sample_filename}')
+
+        validators = [('jsonschema.validate (before)', lambda instance: validate(instance = instance, schema = schema))]
+        validators.append(('compiled jsonschema', processor._compile_schema(schema, 'jsonschema')))
+        if fastjsonschema != None:
+            validators.append(('compiled fastjsonschema', processor._compile_schema(schema, 'fastjsonschema')))
+
+        elapsed = None
+        for validator_name, validator in validators:
+            try:
+                validator(invalid_message)
+                print(f'    {validator_name}: invalid message accepted!')
+                return 1
+            except Exception:
+                pass
+
+            result = bench(validator_name, validator, message, count)
+            if elapsed == None:
+                elapsed = result
+            else:
+                print(f'    {"":<28} {elapsed / result:12.1f}x')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+'''
+Benchmark of the dispatch of the received topics to the pipelines (TopicRouter).
+Compares a linear scan of the subscriptions with paho-mqtt topic_matches_sub() (previous implementation)
+with the topic trie of TopicRouter.match(), for thousands of subscriptions with wildcards ('+', '#').
+
+python3 bench_topic_router.py [subscription_count] [message_count]
+'''
+# Do this first !
+import sys
+import os
+
+# Add parent directory to Python path to resolve imports
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(parent_dir)
+
+from utils.logger import set_log_filename
+set_log_filename('bench-topic-router.log')
+
+import random
+import time
+import paho.mqtt.client as mqtt
+
+from communication.topic_router import TopicRouter
+
+SITES = 20
+DEVICES = 500
+MEASURES = ['temperature', 'humidity', 'power', 'energy', 'voltage']
+# The linear scan is slow: it is measured on the first messages only
+LINEAR_MAX_MESSAGES = 200
+
+# -----------------------------------------------------------------------------
+# Subscriptions of the pipelines: list of (topic filter, queue)
+def create_subscriptions(count):
+    subscriptions = []
+
+    for i in range(count):
+        site = f'site{i % SITES}'
+        device = f'device{(i // SITES) % DEVICES}'
+        measure = MEASURES[i % len(MEASURES)]
+        kind = i % 4
+
+        if kind == 0:
+            topic_filter = f'zeppelin/{site}/{device}/{measure}'
+        elif kind == 1:
+            topic_filter = f'zeppelin/{site}/+/{measure}'
+        elif kind == 2:
+            topic_filter = f'zeppelin/{site}/{device}/#'
+        else:
+            topic_filter = f'zeppelin/+/{device}/{measure}'
+
+        subscriptions.append((topic_filter, f'queue{i}'))
+
+    return subscriptions
+
+# -----------------------------------------------------------------------------
+#
+def create_topics(count):
+    random.seed(0)
+    return [f'zeppelin/site{random.randrange(SITES)}/device{random.randrange(DEVICES)}/{random.choice(MEASURES)}' for i in range(count)]
+
+# -----------------------------------------------------------------------------
+#
+def linear_match(subscriptions, topic):
+    return [queue for topic_filter, queue in subscriptions if mqtt.topic_matches_sub(topic_filter, topic)]
+
+# -----------------------------------------------------------------------------
+#
+def bench(name, match, topics):
+    start = time.perf_counter()
+    matches = 0
+
+    for topic in topics:
+        matches += len(match(topic))
+
+    elapsed = time.perf_counter() - start
+    print(f'    {name:<28} {len(topics) / elapsed:12.0f} msg/sec ({matches} matches)')
+
+    return elapsed
+
+# -----------------------------------------------------------------------------
+#
+def main():
+    subscription_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    subscriptions = create_subscriptions(subscription_count)
+    topics = create_topics(message_count)
+
+    router = TopicRouter()
+    for topic_filter, queue in subscriptions:
+        router.add(topic_filter, queue)
+
+    # Same queues as the linear scan
+    for topic in topics[:100]:
+        if sorted(router.match(topic)) != sorted(linear_match(subscriptions, topic)):
+            print(f'invalid match for topic({topic})!')
+            return 1
+
+    print(f'{subscription_count} subscriptions ({len(router)} topic filters), {message_count} messages')
+
+    linear_topics = topics[:LINEAR_MAX_MESSAGES]
+    elapsed = bench('topic_matches_sub (before)', lambda topic: linear_match(subscriptions, topic), linear_topics)
+    result = bench('TopicRouter.match', router.match, topics)
+    print(f'    {"":<28} {(elapsed / len(linear_topics)) / (result / len(topics)):12.1f}x')
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,15 @@
 '''
 Load config file
-Detect changes in config file (based on file size and timestamp)
+Detect changes in config files (based on a hash of their content)
+
+The files are checked when FileWatcher reports an event (inotify) or periodically when inotify is not available.
+A file that is not valid JSON (ex: partially written) is not reported as modified: it is checked again on the next event.
 '''
 import os
+import json
+import hashlib
 from .logger import get_logger
+from .file_watcher import FileWatcher
 
 # ---------------------------------------------------------------------------------
 #
@@ -22,6 +28,8 @@ class ConfigManager:
             self.file_name = file_name
             self.size = -1
             self.timestamp = 0
+            self.hash = None
+            self.invalid_hash = None   # hash of the last invalid content, logged once
             self.stat()
 
         # -------------------------------------------------------------------------
@@ -31,6 +39,9 @@ class ConfigManager:
                 self.size = os.path.getsize(self.file_name)
                 self.timestamp = os.path.getmtime(self.file_name)
 
+                with open(self.file_name, 'rb') as f:
+                    self.hash = hashlib.sha256(f.read()).hexdigest()
+
                 return True
 
             except Exception as ex:
@@ -38,38 +49,62 @@ class ConfigManager:
                 return False
 
         # -------------------------------------------------------------------------
-        #
+        # The file is modified when its content changed and is valid JSON
         def is_modified(self):
             try:
-                size = self.size
-                timestamp = self.timestamp
-                self.stat()
+                with open(self.file_name, 'rb') as f:
+                    content = f.read()
+
+                content_hash = hashlib.sha256(content).hexdigest()
+
+                if content_hash == self.hash:
+                    return False
+
+                try:
+                    json.loads(content)
+
+                except ValueError as ex:
+                    if content_hash != self.invalid_hash:
+                        self.logger.warning(f'file_name({self.file_name}) modification ignored, invalid or incomplete JSON({ex})')
+                        self.invalid_hash = content_hash
 
-                if size != self.size or timestamp != self.timestamp:
-                    self.logger.info(f'file_name({self.file_name}) modification detected')
-                    return True
+                    return False
 
+                self.hash = content_hash
+                self.size = len(content)
+                self.timestamp = os.path.getmtime(self.file_name)
+                self.logger.info(f'file_name({self.file_name}) modification detected')
+
+                return True
+
+            except FileNotFoundError:
+                # Removed, or being replaced: checked again on the next event
                 return False
 
             except Exception as ex:
                 self.logger.error(ex)
                 return False
-            
+
     # -------------------------------------------------------------------------
     #
     def __init__(self):
         self.logger = get_logger('ConfigManager')
         self.logger.info('constructor called')
         self.config_files = []
+        self.watcher = FileWatcher()
 
     # -------------------------------------------------------------------------
     #
     def add(self, file_name):
         try:
+            if file_name in self.get_files():
+                return
+
             self.logger.info(f'file_name({file_name})')
 
             file = ConfigManager.ConfigFile(file_name)
             self.config_files.append(file)
+            self.watcher.add(file_name)
 
         except Exception as ex:
             self.logger.error(ex)
@@ -105,3 +140,25 @@ class ConfigManager:
         except Exception as ex:
             self.logger.error(ex)
             return None
+
+    # -------------------------------------------------------------------------
+    # Wait up to timeout sec for modified files, return the list of modified file names (empty on timeout)
+    def wait_modified(self, timeout):
+        try:
+            # Watch again the directories removed and created back
+            for file in self.config_files:
+                self.watcher.add(file.file_name)
+
+            if not self.watcher.wait(timeout):
+                return []
+
+            return self.get_modified()
+
+        except Exception as ex:
+            self.logger.error(ex)
+            return None
+
+    # -------------------------------------------------------------------------
+    # Return the list of monitored file names
+    def get_files(self):
+        return [file.file_name for file in self.config_files]
@@ -0,0 +1,28 @@
+"""
+JSON helpers using orjson when it is installed (pip install orjson), otherwise the standard json module.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# -----------------------------------------------------------------------------
+# Parse a JSON document (str or bytes)
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# -----------------------------------------------------------------------------
+# Serialize obj to a JSON string
+def dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode('utf8')
+    return json.dumps(obj, ensure_ascii=False)
+
+# -----------------------------------------------------------------------------
+#
+def backend() -> str:
+    return 'orjson' if orjson is not None else 'json'
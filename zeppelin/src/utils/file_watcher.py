@@ -0,0 +1,158 @@
+'''
+Wait for changes of files, with inotify (Linux) or by polling.
+
+The directories of the files are watched: editors and Kubernetes ConfigMaps replace the files (rename, symlink swap)
+instead of writing them in place. Any event in a watched directory wakes up wait(): the caller checks the content
+of its files (see ConfigManager).
+
+The events are debounced: wait() returns once no event was received for CONFIG_DEBOUNCE_SEC, so a file written
+in several steps is checked once the write is complete.
+
+When inotify is not available (not Linux, limit of watches reached), wait() returns every CONFIG_POLL_INTERVAL_SEC.
+'''
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+from .logger import get_logger
+
+CONFIG_DEBOUNCE_SEC = float(os.getenv('CONFIG_DEBOUNCE_SEC', 0.2))
+CONFIG_DEBOUNCE_MAX_SEC = float(os.getenv('CONFIG_DEBOUNCE_MAX_SEC', 2.0))
+CONFIG_POLL_INTERVAL_SEC = float(os.getenv('CONFIG_POLL_INTERVAL_SEC', 1.0))
+
+# inotify events, see /usr/include/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+READ_SIZE = 64 * 1024
+
+# ---------------------------------------------------------------------------------
+#
+class FileWatcher:
+
+    # -----------------------------------------------------------------------------
+    #
+    def __init__(self):
+        self.logger = get_logger('FileWatcher')
+        self.fd = None
+        self.watches = {}  # directory -> watch descriptor
+        self.libc = None
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+            self.libc = libc
+            self.fd = fd
+            self.logger.info('inotify enabled')
+
+        except Exception as ex:
+            self.logger.warning(f'inotify not available({ex}), polling every {CONFIG_POLL_INTERVAL_SEC} sec')
+
+    # -----------------------------------------------------------------------------
+    # Watch the directory of the file
+    def add(self, file_name) -> bool:
+        try:
+            if self.fd == None:
+                return False
+
+            directory = os.path.dirname(os.path.abspath(file_name))
+
+            if directory in self.watches:
+                return True
+
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_WATCH_MASK)
+
+            if wd < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, f'inotify_add_watch({directory}): {os.strerror(error)}')
+
+            self.watches[directory] = wd
+            self.logger.info(f'watching directory({directory})')
+
+            return True
+
+        except Exception as ex:
+            # The events of the directory are lost: fall back to polling
+            self.logger.error(f'{ex}, polling every {CONFIG_POLL_INTERVAL_SEC} sec')
+            self.close()
+            return False
+
+    # -----------------------------------------------------------------------------
+    # Wait up to timeout sec for changes. Return True when the files must be checked.
+    def wait(self, timeout) -> bool:
+        try:
+            if self.fd == None:
+                time.sleep(min(timeout, CONFIG_POLL_INTERVAL_SEC))
+                return True
+
+            if not self._read_events(timeout):
+                return False
+
+            # Debounce: wait until the writes are complete
+            deadline = time.monotonic() + CONFIG_DEBOUNCE_MAX_SEC
+            while time.monotonic() < deadline and self._read_events(CONFIG_DEBOUNCE_SEC):
+                pass
+
+            return True
+
+        except Exception as ex:
+            self.logger.error(ex)
+            self.close()
+            return True
+
+    # -----------------------------------------------------------------------------
+    # Read the pending events, wait up to timeout sec for the first one. Return True if events were read.
+    def _read_events(self, timeout) -> bool:
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+
+        if len(readable) == 0:
+            return False
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+
+        except BlockingIOError:
+            return False
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_IGNORED:
+                # The directory was removed or unmounted: watch it again on the next add()
+                self.watches = {directory: value for directory, value in self.watches.items() if value != wd}
+                self.logger.warning(f'watch({wd}) removed')
+
+        return True
+
+    # -----------------------------------------------------------------------------
+    #
+    def close(self):
+        try:
+            if self.fd != None:
+                os.close(self.fd)
+
+        except OSError as ex:
+            if ex.errno != errno.EBADF:
+                self.logger.error(ex)
+
+        self.fd = None
+        self.watches = {}
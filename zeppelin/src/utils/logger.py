@@ -1,27 +1,145 @@
 import os
 import sys
+import time
+import atexit
+import itertools
 import logging
+import logging.handlers
+from queue import SimpleQueue
+from threading import Lock
 
 LOGGING_FORMAT = '%(asctime)s %(levelname)7s [%(filename)20s:%(lineno)4s - %(name)s.%(funcName)s()] %(message)s'
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 LOGGING_LEVEL = os.getenv('LoglevelApp', logging.INFO)
 LOGGING_FILENAME = 'app.log'
 LOGGING_STDOUT = True
+# The handlers (file, stdout) write in a QueueListener thread instead of the thread logging the record
+LOGGING_ASYNC = os.getenv('LOGGING_ASYNC', 'true').lower() == 'true'
+# Max INFO and DEBUG records per second per logger, 0: no limit (warnings and errors are never limited)
+LOGGING_RATE_LIMIT = float(os.getenv('LOGGING_RATE_LIMIT', 0))
+# Log 1 payload dump out of LOGGING_PAYLOAD_SAMPLE (see LogSampler)
+LOGGING_PAYLOAD_SAMPLE = int(os.getenv('LOGGING_PAYLOAD_SAMPLE', 1))
 
 LOGGING_FILENAME = os.getenv('LOGGING_FILENAME', LOGGING_FILENAME)
 
-if len(LOGGING_FILENAME) > 0:
-    logging.basicConfig(filename=LOGGING_FILENAME, datefmt=DATE_FORMAT,
-                        filemode='a', format=LOGGING_FORMAT, force=False)
-else:
-    logging.basicConfig(format=LOGGING_FORMAT, datefmt=DATE_FORMAT, force=False)
+_root_listeners = []
+
+# -------------------------------------------------------------------------------------------------
+# Queue the records for a QueueListener. The message is merged with its args here since the args
+# (ex: payload dict) may be modified once the record is queued; the handlers format the record
+# (time, location, exception) and write it in the listener thread.
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+# -------------------------------------------------------------------------------------------------
+# Return a handler writing to handler in a QueueListener thread
+def _async_handler(handler, listeners):
+    queue = SimpleQueue()
+    listener = logging.handlers.QueueListener(queue, handler, respect_handler_level=True)
+    listener.start()
+    listeners.append(listener)
+    return _QueueHandler(queue)
+
+# -------------------------------------------------------------------------------------------------
+#
+def _stop_listeners(listeners):
+    for listener in listeners:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+    listeners.clear()
 
 # -------------------------------------------------------------------------------------------------
 #
+def _configure_root(force):
+    _stop_listeners(_root_listeners)
+
+    if len(LOGGING_FILENAME) > 0:
+        logging.basicConfig(filename=LOGGING_FILENAME, datefmt=DATE_FORMAT,
+                            filemode='a', format=LOGGING_FORMAT, force=force)
+    else:
+        logging.basicConfig(format=LOGGING_FORMAT, datefmt=DATE_FORMAT, force=force)
+
+    if LOGGING_ASYNC:
+        root = logging.getLogger()
+        root.handlers = [handler if isinstance(handler, _QueueHandler) else _async_handler(handler, _root_listeners) for handler in root.handlers]
+
+_configure_root(force=False)
+
+_stdout_listeners = []
+_stdout_handler = logging.StreamHandler(sys.stdout)
+if LOGGING_ASYNC:
+    _stdout_handler = _async_handler(_stdout_handler, _stdout_listeners)
+
+# Write the queued records at exit
+atexit.register(_stop_listeners, _stdout_listeners)
+atexit.register(_stop_listeners, _root_listeners)
+
+# -------------------------------------------------------------------------------------------------
+# Token bucket limiting the INFO and DEBUG records of a logger to rate records per second.
+# The number of suppressed records is reported in the next record logged.
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self._tokens = float(rate)
+        self._last_time = time.monotonic()
+        self._suppressed = 0
+        self._mutex = Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        with self._mutex:
+            now = time.monotonic()
+            self._tokens = min(float(self.rate), self._tokens + (now - self._last_time) * self.rate)
+            self._last_time = now
+
+            if self._tokens < 1:
+                self._suppressed += 1
+                return False
+
+            self._tokens -= 1
+
+            if self._suppressed > 0:
+                record.msg = f'[{self._suppressed} records suppressed] ' + str(record.msg)
+                self._suppressed = 0
+
+        return True
+
+# -------------------------------------------------------------------------------------------------
+# Sample the records logged for each message (ex: payload dumps): is_enabled() returns True
+# for 1 call out of every, when the level is enabled
+class LogSampler:
+
+    def __init__(self, every=LOGGING_PAYLOAD_SAMPLE):
+        self.every = max(1, int(every))
+        self._count = itertools.count()
+
+    def is_enabled(self, logger, level=logging.INFO) -> bool:
+        if not logger.isEnabledFor(level):
+            return False
+
+        return self.every == 1 or next(self._count) % self.every == 0
+
+# -------------------------------------------------------------------------------------------------
+# The handler and filter are added once per logger: get_logger() may be called several times with the same name
 def get_logger(name, level=LOGGING_LEVEL):
     logger = logging.getLogger(name)
-    if LOGGING_STDOUT:
-        logger.addHandler(logging.StreamHandler(sys.stdout))
+
+    if LOGGING_STDOUT and _stdout_handler not in logger.handlers:
+        logger.addHandler(_stdout_handler)
+
+    if LOGGING_RATE_LIMIT > 0 and not any(isinstance(f, RateLimitFilter) for f in logger.filters):
+        logger.addFilter(RateLimitFilter(LOGGING_RATE_LIMIT))
+
     logger.setLevel(level)
     return logger
 
@@ -30,5 +148,4 @@ def get_logger(name, level=LOGGING_LEVEL):
 def set_log_filename(filename):
     global LOGGING_FILENAME
     LOGGING_FILENAME = filename
-    logging.basicConfig(filename=LOGGING_FILENAME, datefmt=DATE_FORMAT,
-                        filemode='a', format=LOGGING_FORMAT, force=True)
+    _configure_root(force=True)
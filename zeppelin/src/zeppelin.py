@@ -11,12 +11,12 @@ Plusieur métriques sont exposées par ce module via Prometheus.
 '''
 import os
 import json
-import time
 from prometheus.prometheus import PrometheusServer
 
 from utils.logger import get_logger, LOGGING_LEVEL
 from utils.config_manager import ConfigManager
 from processors.processor_factory import ProcessorFactory
+from processors.process_pipeline import ProcessPipeline
 from metrics import Metrics
 from _version import __version__
 
@@ -96,6 +96,92 @@ class Zeppelin:
             logger.error(ex)
             return False
 
+    # -------------------------------------------------------------------------
+    # Apply the modified configuration files to the running pipelines:
+    # - a pipeline is kept as is when its configuration, its files (json_schema, config) and the global settings are unchanged;
+    # - a pipeline with the same class and brokers is reconfigured: it keeps its connections and its queue;
+    # - otherwise the pipeline is restarted, and the removed pipelines are stopped.
+    # The running pipeline is kept when the new configuration is invalid.
+    def reload(self, modified_files) -> bool:
+        try:
+            logger.info(f'Zeppelin reload modified files({modified_files})')
+
+            old_config = self.config
+            old_processors = {proc.name: proc for proc in self.processors}
+
+            # self.config and self.pipelines are not modified when the configuration is invalid
+            if CONFIG_FILENAME in modified_files and not self._load_config():
+                logger.error('invalid configuration, running pipelines are kept')
+                return False
+
+            global_changed = self._get_global_config(old_config) != self._get_global_config(self.config)
+            processors = []
+
+            for pipeline in self.pipelines:
+                name = pipeline['name']
+                proc = old_processors.pop(name, None)
+
+                if proc == None:
+                    logger.info(f'pipeline({name}) added')
+                    proc = self._create_processor(pipeline)
+                    if proc != None:
+                        proc.start()
+                        processors.append(proc)
+                    continue
+
+                files = [pipeline.get('json_schema', None), pipeline.get('config', None)]
+                files_changed = any(file in modified_files for file in files if file != None and len(file) > 0)
+
+                if proc.pipeline == pipeline and not files_changed and not global_changed:
+                    processors.append(proc)
+                    continue
+
+                new_proc = self._create_processor(pipeline)
+
+                if new_proc == None:
+                    logger.error(f'pipeline({name}) invalid configuration, running pipeline is kept')
+                    processors.append(proc)
+                elif self._can_reconfigure(proc.pipeline, pipeline):
+                    logger.info(f'pipeline({name}) reconfigured')
+                    proc.reconfigure(self.config, pipeline)
+                    processors.append(proc)
+                else:
+                    logger.info(f'pipeline({name}) restarted')
+                    proc.stop()
+                    proc.join()
+                    new_proc.start()
+                    processors.append(new_proc)
+
+            for name, proc in old_processors.items():
+                logger.info(f'pipeline({name}) removed')
+                proc.stop()
+                proc.join()
+
+            self.processors = processors
+
+            return True
+
+        except Exception as ex:
+            logger.error(ex)
+            return False
+
+    # -------------------------------------------------------------------------
+    # The global settings shared by all the pipelines (global_validation_rules, ...)
+    def _get_global_config(self, config) -> dict:
+        return {key: value for key, value in config.items() if key not in ('pipelines', 'sources', 'version', 'version_date')}
+
+    # -------------------------------------------------------------------------
+    # A running pipeline can be reconfigured without reconnecting when its class and its brokers are unchanged
+    def _can_reconfigure(self, old_pipeline, new_pipeline) -> bool:
+        if old_pipeline.get('process', False) or new_pipeline.get('process', False):
+            return False
+
+        for key in ('class', 'source_broker', 'destination_broker'):
+            if old_pipeline.get(key, None) != new_pipeline.get(key, None):
+                return False
+
+        return True
+
     # -------------------------------------------------------------------------
     #
     def _load_config(self) -> bool:
@@ -108,23 +194,25 @@ class Zeppelin:
                 logger.error(f'invalid config({config})')
                 return False
 
+            pipelines = None
+            if 'pipelines' in config:
+                pipelines = config.get('pipelines', None)
+            elif 'sources' in config:   # la premiere version de zeppelin.json utilisait 'sources' au lieu de 'pipelines'
+                pipelines = config.get('sources', None)
+
+            if pipelines == None or not type(pipelines) is list or len(pipelines) == 0:
+                logger.error(f'invalid pipelines({pipelines})')
+                return False
+
+            # The configuration is applied only once it is valid (reload keeps the running configuration otherwise)
             self.config = config
+            self.pipelines = pipelines
             version = self.config.get('version', '')
             version_date = self.config.get('version_date', '')
 
             self.metrics.version.info({'version': version, 'version_date': version_date, 'module': 'zeppelin'})
             logger.info(f'version({version}) version_date({version_date})')
 
-            self.pipelines = None
-            if 'pipelines' in config:
-                self.pipelines = config.get('pipelines', None)
-            elif 'sources' in config:   # la premiere version de zeppelin.json utilisait 'sources' au lieu de 'pipelines'
-                self.pipelines = config.get('sources', None)
-
-            if self.pipelines == None or not type(self.pipelines) is list or len(self.pipelines) == 0:
-                logger.error(f'invalid pipelines({self.pipelines})')
-                return False
-
             return True
 
         except Exception as ex:
@@ -137,17 +225,9 @@ class Zeppelin:
         try:
 
             for source in self.pipelines:
-
-                sclass = source['class']
-                name = source['name']
-                proc = ProcessorFactory.get_processor(sclass)
+                proc = self._create_processor(source)
 
                 if proc == None:
-                    logger.error(f'invalid source class({sclass}) name({name})')
-                    return False
-
-                if not proc.init(self.config, source, self.metrics):
-                    logger.error(f'processor init failed for class({sclass}) name({name})')
                     return False
 
                 self.processors.append(proc)
@@ -158,6 +238,34 @@ class Zeppelin:
             logger.error(ex)
             return False
 
+    # -------------------------------------------------------------------------
+    # Create and initialize the processor of a pipeline, return None on error
+    def _create_processor(self, source):
+        try:
+            sclass = source['class']
+            name = source['name']
+
+            # Run the pipeline in a worker process
+            if source.get('process', False):
+                logger.info(f'pipeline({name}) runs in a worker process')
+                proc = ProcessPipeline()
+            else:
+                proc = ProcessorFactory.get_processor(sclass)
+
+            if proc == None:
+                logger.error(f'invalid source class({sclass}) name({name})')
+                return None
+
+            if not proc.init(self.config, source, self.metrics):
+                logger.error(f'processor init failed for class({sclass}) name({name})')
+                return None
+
+            return proc
+
+        except Exception as ex:
+            logger.error(ex)
+            return None
+
 # -----------------------------------------------------------------------------
 # Build a list of files to monitor for changes
 def get_monitoring_files():
@@ -232,18 +340,15 @@ def main():
             exit(3)
 
         while True:
-            if config_manager.is_modified():
-                logger.info('config file modified')
-                z.stop()
-
-                z = Zeppelin()
-                if not z.init():
-                    exit(2)
+            modified_files = config_manager.wait_modified(CHECK_CONFIG_INTERVAL_SEC)
 
-                if not z.start():
-                    exit(3)
+            if modified_files != None and len(modified_files) > 0:
+                logger.info(f'config files modified({modified_files})')
+                z.reload(modified_files)
 
-            time.sleep(CHECK_CONFIG_INTERVAL_SEC)
+                # Monitor the files of the new pipelines
+                for file in get_monitoring_files():
+                    config_manager.add(file)
 
     except Exception as e:
         logger.error(str(e))